@@ -0,0 +1,283 @@
+""" Shards a corpus over several worker processes, each with its own llm and embedder on its own device(s).
+
+    main process    feeds the shared work queue and collects the results into the run ledger and extraction store
+    N workers       take paper paths from the work queue and extract them (DiseaseTheoryPipeline.extract_record)
+    graph writer    the only process talking to neo4j, writes the results in batches (GraphBuilder.populate_graph_from_forms)
+
+Workers are started with the spawn method (needed for cuda), so make_worker and make_graph_builder must be picklable,
+e.g. module level classes or functools.partial. See benchmarks/corpus_scaling.py for a run on CPU with fake models.
+
+    summary = run_corpus(paper_paths, PipelineWorkerFactory(), functools.partial(GraphBuilder, neo4j_config),
+                         devices=device_plan(gpus_per_worker=2), ledger_path="run.sqlite", results_store_path="results/")
+"""
+import multiprocessing
+import queue
+import time
+import traceback
+
+import torch
+
+from .pipeline import DiseaseTheoryPipeline, get_paper_id, VERSION
+from .run_ledger import RunLedger, EXTRACT, GRAPH_WRITE
+from .extraction_store import ExtractionStore, get_schema_version
+from .profiler.metadata_schemas.disease_theory_schema_optimal import DiseaseTheorySchema
+
+
+def device_plan(n_workers = None, gpus_per_worker = 1):
+    """
+    (llm_device, embedding_device) per worker. Every worker gets gpus_per_worker gpus of its own,
+    with 2 the llm is on the first and the embedder on the second gpu of the pair.
+    Without gpus: n_workers (default 1) cpu workers.
+    """
+    n_gpus = torch.cuda.device_count()
+    if n_gpus == 0:
+        return [("cpu", "cpu")] * (n_workers or 1)
+    max_workers = n_gpus // gpus_per_worker
+    if n_workers is None:
+        n_workers = max_workers
+    if n_workers < 1 or n_workers > max_workers:
+        raise ValueError(f"{n_gpus} gpus allow 1 to {max_workers} workers with {gpus_per_worker} gpus each, got {n_workers}")
+    return [(f"cuda:{i * gpus_per_worker}", f"cuda:{(i + 1) * gpus_per_worker - 1}") for i in range(n_workers)]
+
+
+class PipelineWorkerFactory():
+    """ make_worker building an extraction-only DiseaseTheoryPipeline on the worker's devices.
+    pipeline_kwargs go to DiseaseTheoryPipeline, except the ledger and store, which belong to the main process.
+    pydantic_form is the schema the workers extract, run_corpus versions the extraction store by it.
+    incremental is not supported: the workers have no ledger or store to reuse fields from, use process_corpus for it """
+    def __init__(self, **pipeline_kwargs):
+        if pipeline_kwargs.get("incremental"):
+            raise ValueError("incremental=True is not supported by corpus_runner workers (they have no previous extractions), "
+                             "use DiseaseTheoryPipeline.process_corpus for incremental runs")
+        self.pipeline_kwargs = pipeline_kwargs
+        form_filler = pipeline_kwargs.get("form_filler")
+        self.pydantic_form = form_filler.pydantic_form if form_filler is not None else DiseaseTheorySchema
+
+    def __call__(self, worker_id, devices):
+        llm_device, embedding_device = devices
+        return DiseaseTheoryPipeline(None, llm_device=llm_device, embedding_device=embedding_device, **self.pipeline_kwargs)
+
+
+def _worker_loop(worker_id, devices, make_worker, work_queue, result_queue):
+    """ messages to the main process are (kind, worker_id, item, payload) """
+    try:
+        worker = make_worker(worker_id, devices)
+    except Exception:
+        result_queue.put(("worker_failed", worker_id, None, traceback.format_exc()))
+        return
+    while True:
+        paper_path = work_queue.get()
+        if paper_path is None:
+            break
+        result_queue.put(("started", worker_id, paper_path, None))
+        try:
+            record = worker.extract_record(paper_path)
+        except Exception:
+            result_queue.put(("extract_failed", worker_id, paper_path, traceback.format_exc()))
+            continue
+        result_queue.put(("extracted", worker_id, paper_path, record))
+
+
+def _graph_writer_loop(make_graph_builder, write_queue, result_queue, batch_size, flush_seconds):
+    """ writes records from write_queue in batches of batch_size, or whatever arrived within flush_seconds. None ends it """
+    graph_builder = make_graph_builder()
+    batch = []
+    while True:
+        timed_out = False
+        try:
+            record = write_queue.get(timeout=flush_seconds)
+        except queue.Empty:
+            record, timed_out = None, True
+        if record is not None:
+            batch.append(record)
+        finished = record is None and not timed_out
+        if batch and (finished or timed_out or len(batch) >= batch_size):
+            paper_ids = [batch_record["paper_id"] for batch_record in batch]
+            try:
+                graph_builder.populate_graph_from_forms(batch)
+                result_queue.put(("written", None, paper_ids, None))
+            except Exception:
+                result_queue.put(("write_failed", None, paper_ids, traceback.format_exc()))
+            batch = []
+        if finished:
+            break
+    graph_builder.close()
+
+
+def run_corpus(paper_paths, make_worker, make_graph_builder, devices = None, ledger_path = None, results_store_path = None,
+               max_attempts = 3, graph_batch_size = 64, flush_seconds = 1.0, pydantic_form = None, verbose = True):
+    """
+    Extracts paper_paths with one worker per entry of devices (default device_plan()) and writes them to the graph.
+
+    make_worker(worker_id, devices) is called once in every worker process and returns an object with
+    extract_record(paper_path) (DiseaseTheoryPipeline or a stand-in), make_graph_builder() is called in the writer process.
+    With a ledger, finished papers are skipped and extracted-but-unwritten ones are only written, as in process_corpus
+    (without its incremental mode, finished papers are not checked for changed field fingerprints).
+    Failed extractions are retried up to max_attempts (counting earlier runs), on any worker.
+    pydantic_form: schema of the extracted forms, for the extraction store's schema version. By default make_worker's
+    pydantic_form (as PipelineWorkerFactory has), else DiseaseTheorySchema.
+    Returns a summary with counts, papers per worker and throughput.
+    """
+    start = time.perf_counter()
+    devices = devices or device_plan()
+    context = multiprocessing.get_context("spawn")
+    work_queue, write_queue, result_queue = context.Queue(), context.Queue(), context.Queue()
+
+    ledger = RunLedger(ledger_path) if ledger_path else None
+    results_store = None
+    if results_store_path:
+        if pydantic_form is None:
+            pydantic_form = getattr(make_worker, "pydantic_form", DiseaseTheorySchema)
+        results_store = ExtractionStore(results_store_path, schema_version=get_schema_version(pydantic_form),
+                                        pipeline_version=VERSION)
+
+    summary = {"papers": 0, "skipped": 0, "extracted": 0, "extract_failed": 0, "written": 0, "write_failed": 0,
+               "per_worker": {worker_id : 0 for worker_id in range(len(devices))}, "devices": devices}
+    attempts = {}
+    to_extract = []
+    to_write = []
+    if ledger is not None and ledger.reset_interrupted() and verbose:
+        print("Resuming interrupted run")
+    for paper_path in dict.fromkeys(paper_paths):
+        paper_id = get_paper_id(paper_path)
+        summary["papers"] += 1
+        if ledger is None:
+            to_extract.append(paper_path)
+            continue
+        ledger.register(paper_id, paper_path)
+        attempts[paper_path] = ledger.attempts(paper_id, EXTRACT)
+        if ledger.is_done(paper_id):
+            summary["skipped"] += 1
+        elif ledger.is_done(paper_id, EXTRACT):
+            if ledger.attempts(paper_id, GRAPH_WRITE) < max_attempts:
+                to_write.append(ledger.load_record(paper_id))
+        elif attempts[paper_path] < max_attempts:
+            to_extract.append(paper_path)
+
+    writer = context.Process(target=_graph_writer_loop, args=(make_graph_builder, write_queue, result_queue, graph_batch_size, flush_seconds))
+    writer.start()
+    workers = {}
+    for worker_id, worker_devices in enumerate(devices):
+        workers[worker_id] = context.Process(target=_worker_loop, args=(worker_id, worker_devices, make_worker, work_queue, result_queue))
+        workers[worker_id].start()
+    if verbose:
+        print(f"Started {len(workers)} workers on {devices}, {len(to_extract)} papers to extract, {len(to_write)} to write")
+
+    pending_extract = set(to_extract)
+    pending_write = set()
+    in_flight = {} # worker_id -> paper_path
+    stopped_workers = set()
+    first_started = None # throughput is also reported without worker startup (model loading)
+
+    def submit_write(record):
+        if ledger is not None:
+            ledger.start(record["paper_id"], GRAPH_WRITE)
+        pending_write.add(record["paper_id"])
+        write_queue.put(record)
+
+    def extraction_failed(paper_path, error):
+        paper_id = get_paper_id(paper_path)
+        if ledger is not None:
+            ledger.fail(paper_id, EXTRACT, error)
+            attempts[paper_path] = ledger.attempts(paper_id, EXTRACT) # counted by ledger.start
+        else:
+            attempts[paper_path] = attempts.get(paper_path, 0) + 1
+        if attempts[paper_path] < max_attempts and len(stopped_workers) < len(workers):
+            work_queue.put(paper_path) # retried by whichever worker is free
+            return
+        if verbose:
+            print(f"Extraction failed for {paper_path}: {error.strip().splitlines()[-1] if error.strip() else error}")
+        pending_extract.discard(paper_path)
+        summary["extract_failed"] += 1
+
+    for paper_path in to_extract:
+        work_queue.put(paper_path)
+    for record in to_write:
+        submit_write(record)
+
+    sentinels_sent = False
+    while pending_extract or pending_write:
+        if not pending_extract and not sentinels_sent:
+            for _ in workers:
+                work_queue.put(None)
+            sentinels_sent = True
+        try:
+            kind, worker_id, item, payload = result_queue.get(timeout=1.0)
+        except queue.Empty:
+            # workers that died (oom, segfault, ...) without reporting
+            for worker_id, process in workers.items():
+                if worker_id not in stopped_workers and not process.is_alive():
+                    stopped_workers.add(worker_id)
+                    if worker_id in in_flight:
+                        extraction_failed(in_flight.pop(worker_id), f"worker {worker_id} died with exit code {process.exitcode}")
+            if pending_extract and len(stopped_workers) == len(workers):
+                for paper_path in list(pending_extract):
+                    extraction_failed(paper_path, "no workers left")
+            if pending_write and not writer.is_alive():
+                for paper_id in pending_write:
+                    if ledger is not None:
+                        ledger.fail(paper_id, GRAPH_WRITE, f"graph writer died with exit code {writer.exitcode}")
+                summary["write_failed"] += len(pending_write)
+                pending_write.clear()
+            continue
+
+        if kind == "worker_failed":
+            print(f"Worker {worker_id} failed to start:\n{payload}")
+            stopped_workers.add(worker_id)
+        elif kind == "started":
+            first_started = first_started or time.perf_counter()
+            in_flight[worker_id] = item
+            if ledger is not None:
+                ledger.start(get_paper_id(item), EXTRACT)
+        elif kind == "extract_failed":
+            in_flight.pop(worker_id, None)
+            extraction_failed(item, payload)
+        elif kind == "extracted":
+            in_flight.pop(worker_id, None)
+            pending_extract.discard(item)
+            summary["extracted"] += 1
+            summary["per_worker"][worker_id] += 1
+            record = payload
+            if results_store is not None:
+                results_store.append(record["paper_id"], record["form"], record["evidence"], record["reasoning"],
+                                     timings=record.get("timings"), field_fingerprints=record.get("field_fingerprints"))
+            if ledger is not None:
+                ledger.save_extraction(record["paper_id"], record["form"], record["evidence"], record["reasoning"],
+                                       record.get("timings"), record.get("field_fingerprints"))
+                ledger.finish(record["paper_id"], EXTRACT)
+            submit_write(record)
+        elif kind in ("written", "write_failed"):
+            for paper_id in item:
+                pending_write.discard(paper_id)
+                if ledger is not None:
+                    if kind == "written":
+                        ledger.finish(paper_id, GRAPH_WRITE)
+                    else:
+                        ledger.fail(paper_id, GRAPH_WRITE, payload)
+            summary[kind] += len(item)
+            if kind == "write_failed" and verbose:
+                print(f"Graph write failed for {len(item)} papers:\n{payload}")
+
+    if not sentinels_sent:
+        for _ in workers:
+            work_queue.put(None)
+    write_queue.put(None)
+    writer.join()
+    for process in workers.values():
+        process.join(timeout=60)
+        if process.is_alive():
+            process.terminate()
+
+    if results_store is not None:
+        results_store.close()
+    if ledger is not None:
+        summary["ledger"] = ledger.summary()
+        ledger.close()
+    end = time.perf_counter()
+    summary["seconds"] = end - start
+    summary["startup_seconds"] = (first_started or end) - start
+    summary["papers_per_second"] = summary["extracted"] / summary["seconds"]
+    summary["processing_papers_per_second"] = summary["extracted"] / max(end - (first_started or end), 1e-9)
+    if verbose:
+        print(f"Extracted {summary['extracted']} papers ({summary['extract_failed']} failed) in {summary['seconds']:.1f}s")
+    return summary
@@ -0,0 +1,118 @@
+""" Append-only store of extraction results (form, evidence, reasoning per paper), so the graph can be rebuilt
+from it after a schema mapping change or a database migration, without running the llm again.
+
+Records are json lines in compressed shards, zstd (.jsonl.zst) if zstandard is installed, gzip (.jsonl.gz) otherwise.
+Every writer gets its own shard, so several processes can write to the same store directory. When reading,
+the newest record of a paper wins.
+
+    store = ExtractionStore("results/")
+    store.append(paper_id, form_dict, evidence, reasoning)
+    store.close()
+    rebuild_graph_from_store(store, GraphBuilder(neo4j_config))
+"""
+import glob
+import gzip
+import io
+import json
+import os
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .profiler.form_filling.response_cache import schema_fingerprint
+
+
+def get_schema_version(pydantic_form):
+    """ short fingerprint of the extraction schema, stored with every record """
+    return schema_fingerprint(pydantic_form)[:12]
+
+
+class ExtractionStore():
+    def __init__(self, directory, schema_version = None, pipeline_version = None, flush_every = 16, compression = None):
+        """ compression: "zstd" or "gzip", default zstd if available """
+        self.directory = directory
+        self.schema_version = schema_version
+        self.pipeline_version = pipeline_version
+        self.flush_every = flush_every
+        self.compression = compression or ("zstd" if zstandard is not None else "gzip")
+        if self.compression == "zstd" and zstandard is None:
+            raise ImportError("compression='zstd' needs the zstandard package")
+        os.makedirs(directory, exist_ok=True)
+        self.buffer = []
+        self.shard_path = None
+
+    def append(self, paper_id, form_dict, evidence = None, reasoning = None, **extra):
+        self.buffer.append({
+            "paper_id": paper_id,
+            "schema_version": self.schema_version,
+            "pipeline_version": self.pipeline_version,
+            "created": time.time(),
+            "form": form_dict,
+            "evidence": evidence or {},
+            "reasoning": reasoning or {},
+            **extra,
+        })
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """ writes the buffered records as one compressed frame (zstd) or member (gzip) appended to this writer's shard """
+        if not self.buffer:
+            return
+        data = "".join(json.dumps(record, default=str) + "\n" for record in self.buffer).encode("utf-8")
+        if self.shard_path is None:
+            suffix = ".jsonl.zst" if self.compression == "zstd" else ".jsonl.gz"
+            self.shard_path = os.path.join(self.directory, f"extractions-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}{suffix}")
+        compressed = zstandard.ZstdCompressor(level=10).compress(data) if self.compression == "zstd" else gzip.compress(data)
+        with open(self.shard_path, "ab") as f:
+            f.write(compressed)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+    def shards(self):
+        return sorted(glob.glob(os.path.join(self.directory, "extractions-*.jsonl.zst")) +
+                      glob.glob(os.path.join(self.directory, "extractions-*.jsonl.gz")))
+
+    def iter_records(self):
+        """ every record in every shard (including this writer's buffer), in write order per shard """
+        self.flush()
+        for path in self.shards():
+            with open(path, "rb") as f:
+                if path.endswith(".zst"):
+                    if zstandard is None:
+                        raise ImportError(f"reading {path} needs the zstandard package")
+                    stream = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+                else:
+                    stream = gzip.GzipFile(fileobj=f)
+                for line in io.TextIOWrapper(stream, encoding="utf-8"):
+                    if line.strip():
+                        yield json.loads(line)
+
+    def latest(self, schema_version = None):
+        """ {paper_id: newest record}, optionally only records of schema_version """
+        records = {}
+        for record in self.iter_records():
+            if schema_version is not None and record.get("schema_version") != schema_version:
+                continue
+            current = records.get(record["paper_id"])
+            if current is None or record["created"] >= current["created"]:
+                records[record["paper_id"]] = record
+        return records
+
+
+def rebuild_graph_from_store(store, graph_builder, schema_version = None, batch_size = 500, verbose = True):
+    """ bulk loads the newest record of every paper into the graph. Returns the number of papers loaded """
+    records = list(store.latest(schema_version).values())
+    start = time.perf_counter()
+    for i in range(0, len(records), batch_size):
+        graph_builder.populate_graph_from_forms(records[i:i + batch_size])
+        if verbose:
+            print(f"Rebuilt graph for {min(i + batch_size, len(records))}/{len(records)} papers")
+    if verbose:
+        print(f"Rebuilt graph from {len(records)} papers in {time.perf_counter() - start:.1f}s")
+    return len(records)
@@ -3,11 +3,65 @@ from typing import Dict, List, Optional
 import logging
 import json
 
+from .metrics import metrics
+
 NOT_MENTIONED_VARIATIONS = {"not present", "not mentioned", "not mentioned in the paper", "n/a", "", None}
 
+def normalize_and_split_values(value_input):
+    """Accept a raw string or a python list of strings and return a list of
+    lowercase, de-duplicated terms suitable for KG nodes."""
+    if value_input is None:
+        return []
+    if isinstance(value_input, list):
+        raw_items = value_input
+    else:
+        raw_items = value_input.split(",")
+
+    items = [item.strip().lower() for item in raw_items if isinstance(item, str) and item.strip()]
+    cleaned_items = [itm for itm in items if itm not in NOT_MENTIONED_VARIATIONS]
+    return list(dict.fromkeys(cleaned_items))
+
+FIELD_TO_GRAPH_MAPPING = {
+    "etiology_factor":      ("EtiologyFactor",      "HAS_ETIOLOGY_FACTOR"),
+    "diagnostic_method":    ("DiagnosticMethod",    "HAS_DIAGNOSTIC_METHOD"),
+    "biomarker":            ("Biomarker",           "HAS_BIOMARKER"),
+    "treatment_intervention": ("TreatmentIntervention", "HAS_TREATMENT"),
+    "prognostic_indicator": ("PrognosticIndicator", "HAS_PROGNOSTIC_INDICATOR"),
+}
+
+def relationship_query(node_label, rel_type, unwind=False):
+    """MERGE of one disease -> item relationship, appending source paper, evidence and reasoning.
+    With unwind=True the parameters come as a list $rows instead, one query for many relationships."""
+    prefix = "$"
+    cypher = ""
+    if unwind:
+        prefix = "row."
+        cypher = "UNWIND $rows AS row\n"
+    return cypher + f"""
+    MATCH (d:Disease {{name: {prefix}disease_name}})
+    MERGE (item_node:{node_label} {{name: {prefix}item_name}})
+    MERGE (d)-[r:{rel_type}]->(item_node)
+    ON CREATE SET
+        r.sources  = [{prefix}paper_id_for_graph],
+        r.evidence = CASE WHEN {prefix}evidence_quote IS NULL THEN [] ELSE [{prefix}evidence_quote] END,
+        r.reasoning = CASE WHEN {prefix}reasoning_text IS NULL THEN [] ELSE [{prefix}reasoning_text] END
+    ON MATCH SET
+        r.sources  = CASE WHEN {prefix}paper_id_for_graph IN r.sources THEN r.sources
+                          ELSE r.sources + {prefix}paper_id_for_graph END,
+        r.evidence = CASE WHEN {prefix}evidence_quote IS NULL OR {prefix}evidence_quote IN r.evidence THEN r.evidence
+                          ELSE r.evidence + {prefix}evidence_quote END,
+        r.reasoning = CASE WHEN {prefix}reasoning_text IS NULL OR {prefix}reasoning_text IN r.reasoning THEN r.reasoning
+                          ELSE r.reasoning + {prefix}reasoning_text END
+    """
+
 class GraphBuilder:
-    def __init__(self, neo4j_config):
-        """Initialize with config dict containing uri, user, password"""
+    def __init__(self, neo4j_config, driver=None):
+        """Initialize with config dict containing uri, user, password.
+        An already created driver (or a stand-in with the same session interface) can be passed instead.
+        With neo4j_config None and no driver, nothing is written."""
+        if driver is not None or neo4j_config is None:
+            self.driver = driver # no config: extraction only, e.g. in corpus_runner workers
+            return
         try:
             self.driver = GraphDatabase.driver(
                 neo4j_config["uri"], 
@@ -23,18 +77,7 @@ class GraphBuilder:
             self.driver = None
 
     def _normalize_and_split_values(self, value_input):
-        """Accept a raw string or a python list of strings and return a list of
-        lowercase, de-duplicated terms suitable for KG nodes."""
-        if value_input is None:
-            return []
-        if isinstance(value_input, list):
-            raw_items = value_input
-        else:
-            raw_items = value_input.split(",")
-
-        items = [item.strip().lower() for item in raw_items if isinstance(item, str) and item.strip()]
-        cleaned_items = [itm for itm in items if itm not in NOT_MENTIONED_VARIATIONS]
-        return list(dict.fromkeys(cleaned_items))
+        return normalize_and_split_values(value_input)
 
     def populate_graph_from_form(self, form_dict, paper_id_for_graph, evidence_dict=None, reasoning_dict=None):
         """
@@ -45,83 +88,126 @@ class GraphBuilder:
             paper_id_for_graph: Paper identifier
             evidence_dict: Field -> {term -> evidence_quote} mapping
             reasoning_dict: Field -> reasoning_text mapping (from CoT)
+
+        Raises RuntimeError without a driver or if any relationship failed, so the run ledger records the write as failed.
         """
+        with metrics.timer("graph_populate_seconds"):
+            return self._populate_graph_from_form(form_dict, paper_id_for_graph, evidence_dict, reasoning_dict)
+
+    def _populate_graph_from_form(self, form_dict, paper_id_for_graph, evidence_dict=None, reasoning_dict=None):
         if not self.driver:
-            print("GraphBuilder: Neo4j driver not available.")
-            return
+            raise RuntimeError("GraphBuilder: Neo4j driver not available.")
         if not form_dict:
             print(f"GraphBuilder: Empty form_dict for paper_id {paper_id_for_graph}. Skipping.")
             return
 
+        processed_disease_names, rows_by_field = self._relationship_rows(form_dict, paper_id_for_graph, evidence_dict, reasoning_dict)
+        if not processed_disease_names:
+            print(f"GraphBuilder: No valid disease_name for paper {paper_id_for_graph}.")
+            return
+
         with self.driver.session(database="neo4j") as session:
-            disease_name_str = form_dict.get("disease_name")
-            processed_disease_names = self._normalize_and_split_values(disease_name_str)
-            if not processed_disease_names:
-                print(f"GraphBuilder: No valid disease_name for paper {paper_id_for_graph}.")
-                return
-            
             # Handle multiple diseases and merge duplicates
             for disease_name in processed_disease_names:
                 session.run("MERGE (d:Disease {name: $disease_name})", disease_name=disease_name)
-            
-            primary_disease_name = processed_disease_names[0]
-
-            field_to_graph_mapping = {
-                "etiology_factor":      ("EtiologyFactor",      "HAS_ETIOLOGY_FACTOR"),
-                "diagnostic_method":    ("DiagnosticMethod",    "HAS_DIAGNOSTIC_METHOD"),
-                "biomarker":            ("Biomarker",           "HAS_BIOMARKER"),
-                "treatment_intervention": ("TreatmentIntervention", "HAS_TREATMENT"),
-                "prognostic_indicator": ("PrognosticIndicator", "HAS_PROGNOSTIC_INDICATOR"),
-            }
-
-            for field_key, (node_label, rel_type) in field_to_graph_mapping.items():
-                value_string = form_dict.get(field_key)
-                items = self._normalize_and_split_values(value_string)
-
-                field_evidence = {}
-                if evidence_dict and field_key in evidence_dict:
-                    field_evidence = {k.lower(): v for k, v in evidence_dict[field_key].items()}
-
-                field_reasoning = ""
-                if reasoning_dict and field_key in reasoning_dict:
-                    field_reasoning = reasoning_dict[field_key]
-
-                for item_name in items:
-                    item_lower = item_name.lower()
-                    raw_evidence_detail = field_evidence.get(item_lower)
-                    
-                    evidence_to_store = None
-                    if isinstance(raw_evidence_detail, dict):
-                        evidence_to_store = json.dumps(raw_evidence_detail)
-                    elif isinstance(raw_evidence_detail, str):
-                        evidence_to_store = raw_evidence_detail
-
-                    reasoning_to_store = field_reasoning if field_reasoning else None
-
-                    cypher_rel = f"""
-                    MATCH (d:Disease {{name: $disease_name}})
-                    MERGE (item_node:{node_label} {{name: $item_name}})
-                    MERGE (d)-[r:{rel_type}]->(item_node)
-                    ON CREATE SET
-                        r.sources  = [$paper_id_for_graph],
-                        r.evidence = CASE WHEN $evidence_quote IS NULL THEN [] ELSE [$evidence_quote] END,
-                        r.reasoning = CASE WHEN $reasoning_text IS NULL THEN [] ELSE [$reasoning_text] END
-                    ON MATCH SET
-                        r.sources  = CASE WHEN $paper_id_for_graph IN r.sources THEN r.sources
-                                          ELSE r.sources + $paper_id_for_graph END,
-                        r.evidence = CASE WHEN $evidence_quote IS NULL OR $evidence_quote IN r.evidence THEN r.evidence
-                                          ELSE r.evidence + $evidence_quote END,
-                        r.reasoning = CASE WHEN $reasoning_text IS NULL OR $reasoning_text IN r.reasoning THEN r.reasoning
-                                          ELSE r.reasoning + $reasoning_text END
-                    """
+
+            errors = []
+            for field_key, (node_label, rel_type) in FIELD_TO_GRAPH_MAPPING.items():
+                cypher_rel = relationship_query(node_label, rel_type)
+                for row in rows_by_field[field_key]:
                     try:
-                        session.run(cypher_rel,
-                                    disease_name=primary_disease_name,
-                                    item_name=item_name,
-                                    paper_id_for_graph=paper_id_for_graph,
-                                    evidence_quote=evidence_to_store,
-                                    reasoning_text=reasoning_to_store)
+                        session.run(cypher_rel, **row)
+                        metrics.inc("graph_relationships_written", field=field_key)
                     except Exception as e:
-                        print(f"ERROR running Cypher for item '{item_name}' (field: {field_key}, paper: {paper_id_for_graph}): {e}")
+                        metrics.inc("graph_write_errors")
+                        errors.append(e)
+                        print(f"ERROR running Cypher for item '{row['item_name']}' (field: {field_key}, paper: {paper_id_for_graph}): {e}")
+
+            # the other relationships are still written (MERGE, so a retry does not duplicate them), but the paper is not done
+            if errors:
+                raise RuntimeError(f"GraphBuilder: {len(errors)} relationships of paper {paper_id_for_graph} failed, first error: {errors[0]}")
+            print(f"GraphBuilder: Finished processing data for paper_id {paper_id_for_graph}")
+
+    def _relationship_rows(self, form_dict, paper_id_for_graph, evidence_dict=None, reasoning_dict=None):
+        """Disease names of the form, and per field the parameter rows of its relationships (linked to the first disease)."""
+        processed_disease_names = self._normalize_and_split_values(form_dict.get("disease_name"))
+        rows_by_field = {field_key: [] for field_key in FIELD_TO_GRAPH_MAPPING}
+        if not processed_disease_names:
+            return processed_disease_names, rows_by_field
+        primary_disease_name = processed_disease_names[0]
+
+        for field_key in FIELD_TO_GRAPH_MAPPING:
+            items = self._normalize_and_split_values(form_dict.get(field_key))
+
+            field_evidence = {}
+            if evidence_dict and field_key in evidence_dict:
+                field_evidence = {k.lower(): v for k, v in evidence_dict[field_key].items()}
+
+            field_reasoning = ""
+            if reasoning_dict and field_key in reasoning_dict:
+                field_reasoning = reasoning_dict[field_key]
+
+            for item_name in items:
+                raw_evidence_detail = field_evidence.get(item_name.lower())
+
+                evidence_to_store = None
+                if isinstance(raw_evidence_detail, dict):
+                    evidence_to_store = json.dumps(raw_evidence_detail)
+                elif isinstance(raw_evidence_detail, str):
+                    evidence_to_store = raw_evidence_detail
+
+                rows_by_field[field_key].append({
+                    "disease_name": primary_disease_name,
+                    "item_name": item_name,
+                    "paper_id_for_graph": paper_id_for_graph,
+                    "evidence_quote": evidence_to_store,
+                    "reasoning_text": field_reasoning if field_reasoning else None,
+                })
+        return processed_disease_names, rows_by_field
+
+    def populate_graph_from_forms(self, records):
+        """
+        Bulk version of populate_graph_from_form, one UNWIND query per relationship type for the whole batch
+        instead of one query per relationship. Same resulting graph.
+
+        Args:
+            records: dicts with paper_id, form, and optionally evidence and reasoning (as in the extraction store)
+
+        Raises RuntimeError without a driver or if any relationship type failed, after trying the others.
+        """
+        with metrics.timer("graph_populate_batch_seconds"):
+            return self._populate_graph_from_forms(records)
+
+    def _populate_graph_from_forms(self, records):
+        if not self.driver:
+            raise RuntimeError("GraphBuilder: Neo4j driver not available.")
+
+        disease_names = []
+        rows_by_field = {field_key: [] for field_key in FIELD_TO_GRAPH_MAPPING}
+        for record in records:
+            if not record.get("form"):
+                continue
+            names, rows = self._relationship_rows(record["form"], record["paper_id"], record.get("evidence"), record.get("reasoning"))
+            disease_names.extend(names)
+            for field_key, field_rows in rows.items():
+                rows_by_field[field_key].extend(field_rows)
+
+        with self.driver.session(database="neo4j") as session:
+            session.run("UNWIND $names AS disease_name MERGE (d:Disease {name: disease_name})",
+                        names=list(dict.fromkeys(disease_names)))
+            failed_fields = {}
+            for field_key, (node_label, rel_type) in FIELD_TO_GRAPH_MAPPING.items():
+                if not rows_by_field[field_key]:
+                    continue
+                try:
+                    session.run(relationship_query(node_label, rel_type, unwind=True), rows=rows_by_field[field_key])
+                    metrics.inc("graph_relationships_written", len(rows_by_field[field_key]), field=field_key)
+                except Exception as e:
+                    metrics.inc("graph_write_errors")
+                    failed_fields[field_key] = e
+                    print(f"ERROR running batched Cypher for field {field_key} ({len(rows_by_field[field_key])} relationships): {e}")
 
-            print(f"GraphBuilder: Finished processing data for paper_id {paper_id_for_graph}")
\ No newline at end of file
+        # a failed field is missing for every paper of the batch, so the whole batch has to be written again
+        if failed_fields:
+            raise RuntimeError(f"GraphBuilder: batched write of {len(records)} papers failed for fields {list(failed_fields)}, "
+                               f"first error: {next(iter(failed_fields.values()))}")
@@ -0,0 +1,166 @@
+""" Lightweight timers, counters and histograms for finding out where the time goes in a run.
+
+Disabled by default, in which case every call returns right after a single attribute check.
+Enable with the environment variable KNOWDISEASE_METRICS=1 or metrics.enable(), then export with
+metrics.to_prometheus() (Prometheus text format) or metrics.write_jsonl(path) (one snapshot per line).
+
+    from .metrics import metrics
+    with metrics.timer("retrieval_seconds"):
+        ...
+    metrics.inc("papers_processed")
+    metrics.observe("prompt_tokens", n_tokens)
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+# seconds, also used for token counts etc. (values above the last bucket only end up in +Inf)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 1000, 2500, 5000)
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class _NullTimer():
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer():
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.metrics.observe(self.name, self.seconds, **self.labels)
+        return False
+
+
+class Histogram():
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """ upper bucket bound containing quantile q (bucket resolution only) """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.bucket_counts):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics():
+    def __init__(self, enabled = False, profile_prefill = False):
+        self.enabled = enabled
+        self.profile_prefill = profile_prefill # separate prefill timing of llm calls, costs an extra forward pass per call
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, value = 1, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def timer(self, name, **labels):
+        """ context manager observing the elapsed seconds into histogram name """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            typed = set()
+            for key, value in sorted(self.counters.items()):
+                name = key.split("{")[0]
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{key} {value}")
+            for key, histogram in sorted(self.histograms.items()):
+                name, _, labels = key.partition("{")
+                labels = labels.rstrip("}")
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, n in zip(histogram.buckets + (float("inf"),), histogram.bucket_counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    bucket_labels = (labels + "," if labels else "") + f'le="{le}"'
+                    lines.append(f"{name}_bucket{{{bucket_labels}}} {cumulative}")
+                suffix = "{" + labels + "}" if labels else ""
+                lines.append(f"{name}_sum{suffix} {histogram.sum}")
+                lines.append(f"{name}_count{suffix} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "timestamp": time.time(),
+                "counters": dict(self.counters),
+                "histograms": {key : {"count": h.count, "sum": h.sum, "p50": h.quantile(0.5), "p95": h.quantile(0.95)}
+                               for key, h in self.histograms.items()},
+            }
+
+    def write_jsonl(self, path):
+        with open(path, "a") as f:
+            f.write(json.dumps(self.snapshot()) + "\n")
+
+    def write_prometheus(self, path):
+        """ e.g. into the node_exporter textfile collector directory """
+        with open(path, "w") as f:
+            f.write(self.to_prometheus())
+
+
+metrics = Metrics(
+    enabled = os.environ.get("KNOWDISEASE_METRICS", "0").lower() in ("1", "true", "yes"),
+    profile_prefill = os.environ.get("KNOWDISEASE_METRICS_PREFILL", "0").lower() in ("1", "true", "yes"),
+)
@@ -1,14 +1,21 @@
 import os
 import json
+import time
 import nltk
 
 from .data.xml_loader import load_xml
 from .profiler.model_init import initialize_llm
-from .profiler.form_filling.form_filling import SequentialFormFiller
+from .profiler.form_filling.form_filling import SequentialFormFiller, WholeFormFiller
+from .profiler.form_filling.response_cache import ResponseCache
 from .profiler.context_shortening.context_shortening import Retrieval
+from .profiler.context_shortening.context_packing import ContextPacker
 from .profiler.metadata_schemas.disease_theory_schema_optimal import DiseaseTheorySchema
 from .profiler.metadata_schemas.cot_schema import CoTModelSchema
 from .graph_builder import GraphBuilder
+from .run_ledger import RunLedger, EXTRACT, GRAPH_WRITE, FAILED
+from .extraction_store import ExtractionStore, get_schema_version, rebuild_graph_from_store
+from .metrics import metrics
+from . import tracing
 
 VERSION = "1.0.0"
 
@@ -20,40 +27,114 @@ def ensure_nltk_punkt():
 
 ensure_nltk_punkt()
 
+# retrieval settings of the pipeline (besides devices, precision and the per-run options), shared with the benchmark stand-ins
+RETRIEVAL_SETTINGS = dict(
+    chunk_info_to_compare = "direct",
+    field_info_to_compare = "description",
+    include_choice_every = 1,
+    embedding_model_id = "pritamdeka/S-PubMedBert-MS-MARCO",
+    n_keywords = 13,
+    top_k = 5,
+    chunk_size = 1200,
+    chunk_overlap = 256,
+    mmr_param = 1.0,
+    pydantic_form = DiseaseTheorySchema,
+    keyphrase_range = (1, 1),
+    relevance_threshold = 0.8,
+    return_scores = True,
+)
+
 class DiseaseTheoryPipeline:
-    def __init__(self, neo4j_config, verbose=False, use_cot=True):
+    def __init__(self, neo4j_config, verbose=False, use_cot=True, answerable_threshold=None, extraction_mode="sequential",
+                 response_cache_path=None, ledger_path=None, results_store_path=None, incremental=False,
+                 llm_device="cuda:0", embedding_device=None, embedding_precision="fp32", lexical_weight=0.0, retriever=None, form_filler=None,
+                 context_token_budget=None, context_tokenizer=None):
+        """extraction_mode: "sequential" (one generation per field) or "whole_form" (one generation for all fields, CoT only).
+        response_cache_path: sqlite file for caching llm responses, so re-runs on the same papers skip generation.
+        ledger_path: sqlite run ledger, records per-paper stage status and extraction results so process_corpus can resume.
+        results_store_path: directory of the extraction store, every extraction is appended so the graph can be rebuilt from it.
+        incremental: re-extract only the fields whose fingerprint (schema, prompts, retrieval and model settings) changed
+        since the paper's previous extraction in the ledger or store, and reuse the rest.
+        llm_device, embedding_device: where the models are loaded (embedding_device None: cuda:1 if there are two gpus, else cuda:0).
+        embedding_precision: "fp32", "fp16" or "int8" for the embedding model, which is shared process wide (see embedding_registry).
+        lexical_weight: weight of the bm25 ranking fused with the dense ranking in retrieval, 0 for dense only (see Retrieval).
+        retriever, form_filler: already built components (or stand-ins with the same interface) to use instead of building them.
+        context_token_budget: max llm tokens of a field's retrieved context, the top chunks are packed into it and the last one
+        cut at a sentence boundary (see ContextPacker). None: the top_k chunks as they are.
+        context_tokenizer: tokenizer counting those tokens, by default the form filler's llm tokenizer.
+        neo4j_config can be None for extraction-only pipelines, see corpus_runner."""
         self.verbose = verbose
         self.use_cot = use_cot
+        self.extraction_mode = extraction_mode
+        if extraction_mode not in ("sequential", "whole_form"):
+            raise ValueError(f"Unknown extraction_mode: {extraction_mode}")
+        if extraction_mode == "whole_form" and not use_cot:
+            raise ValueError("extraction_mode='whole_form' requires use_cot=True")
 
         self.graph_builder = GraphBuilder(neo4j_config)
+        self.ledger = RunLedger(ledger_path) if ledger_path else None
+        self.incremental = incremental
+        self.reuse_stats = {"reused_fields": 0, "extracted_fields": 0}
+        self._field_fingerprints = None
+        self._stored_records = None
+        self.last_timings = {}
 
-        self.retriever = Retrieval(
-            chunk_info_to_compare = "direct",
-            field_info_to_compare = "description",
-            include_choice_every = 1,
-            embedding_model_id = "pritamdeka/S-PubMedBert-MS-MARCO",
-            n_keywords = 13,
-            top_k = 5,
-            chunk_size = 1200,
-            chunk_overlap = 256,
-            mmr_param = 1.0,
-            pydantic_form=DiseaseTheorySchema,
-            keyphrase_range = (1, 1),
-            relevance_threshold=0.8,
-            return_scores=True
+        if retriever is not None:
+            self.retriever = retriever
+        else:
+            self.retriever = self._make_retriever(answerable_threshold, embedding_device, embedding_precision, lexical_weight)
+
+        self.response_cache = ResponseCache(response_cache_path) if response_cache_path else None
+
+        if form_filler is not None:
+            self.form_filler = form_filler
+        else:
+            self.form_filler = self._make_form_filler(answerable_threshold, llm_device)
+
+        self.results_store = None
+        if results_store_path:
+            # versioned by the form filler's schema, which an injected form filler can change
+            self.results_store = ExtractionStore(results_store_path, schema_version=get_schema_version(self.form_filler.pydantic_form),
+                                                 pipeline_version=VERSION)
+
+        if context_token_budget is not None:
+            tokenizer = context_tokenizer if context_tokenizer is not None else self.form_filler.llm_model.tokenizer.tokenizer
+            self.retriever.context_packer = ContextPacker(tokenizer, context_token_budget)
+
+    def _make_retriever(self, answerable_threshold, embedding_device, embedding_precision, lexical_weight=0.0):
+        return Retrieval(
+            **RETRIEVAL_SETTINGS,
+            answerable_threshold=answerable_threshold,
+            embedding_device=embedding_device,
+            embedding_precision=embedding_precision,
+            lexical_weight=lexical_weight
         )
 
-        llm, sampler = initialize_llm(deterministic=True)
+    def _make_form_filler(self, answerable_threshold, llm_device):
+        llm, sampler = initialize_llm(deterministic=True, device=llm_device)
+
+        if self.extraction_mode == "whole_form":
+            return WholeFormFiller(
+                outlines_llm = llm,
+                outlines_sampler = sampler,
+                cot_schema = CoTModelSchema,
+                pydantic_form=DiseaseTheorySchema,
+                verbose=self.verbose,
+                response_cache=self.response_cache
+            )
 
-        self.form_filler = SequentialFormFiller(
+        return SequentialFormFiller(
             outlines_llm = llm,
             outlines_sampler = sampler,
             pydantic_form=DiseaseTheorySchema,
             max_tokens=2000,
             verbose=self.verbose,
-            use_cot=use_cot,
-            use_json_constraints=use_cot,
-            cot_schema=CoTModelSchema if use_cot else None
+            use_cot=self.use_cot,
+            use_json_constraints=self.use_cot,
+            cot_schema=CoTModelSchema if self.use_cot else None,
+            skip_empty_context=True,
+            answerability_check=self.retriever.check_answerable if answerable_threshold is not None else None,
+            response_cache=self.response_cache
         )
 
     def get_context_wrapper(self, **kwargs):
@@ -99,7 +180,13 @@ class DiseaseTheoryPipeline:
         """Extract reasoning from form filler field fillers (CoT mode)."""
         reasoning_dict = {}
         
-        if not self.use_cot or not hasattr(self.form_filler, 'field_fillers'):
+        if not self.use_cot:
+            return reasoning_dict
+
+        if hasattr(self.form_filler, 'reasoning'): # whole form mode
+            return {field_name: reasoning for field_name, reasoning in self.form_filler.reasoning.items() if reasoning}
+
+        if not hasattr(self.form_filler, 'field_fillers'):
             return reasoning_dict
         
         for field_name, field_filler in self.form_filler.field_fillers.items():
@@ -109,14 +196,71 @@ class DiseaseTheoryPipeline:
         return reasoning_dict
 
     def process_document(self, paper_path, progress_callback=None):
+        with tracing.paper_scope(), metrics.timer("pipeline_process_document_seconds"):
+            return self._process_document(paper_path, progress_callback)
 
-        paper = load_xml(paper_path)
-        self.retriever.set_document(paper)
+    def field_fingerprints(self):
+        """Fingerprint per field of everything that decides its extracted value, see form_filling.field_fingerprints."""
+        if self._field_fingerprints is None:
+            self._field_fingerprints = self.form_filler.field_fingerprints(self.retriever.settings())
+        return self._field_fingerprints
 
-        result = self.form_filler.forward(
-            get_context=self.get_context_wrapper,
-            progress_callback=progress_callback
-        )
+    def previous_record(self, paper_id):
+        """The paper's last stored extraction, from the ledger or else the extraction store, or None."""
+        if self.ledger is not None:
+            record = self.ledger.load_record(paper_id)
+            if record is not None:
+                return record
+        if self.results_store is not None:
+            if self._stored_records is None:
+                self._stored_records = self.results_store.latest() # read once per run
+            return self._stored_records.get(paper_id)
+        return None
+
+    def _reusable_fields(self, paper_id):
+        """Fields of the previous extraction whose fingerprint still matches, and that record."""
+        record = self.previous_record(paper_id)
+        if record is None:
+            return [], None
+        previous_fingerprints = record.get("field_fingerprints") or {}
+        reusable = [fieldname for fieldname, fingerprint in self.field_fingerprints().items()
+                    if previous_fingerprints.get(fieldname) == fingerprint and fieldname in record["form"]]
+        return reusable, record
+
+    def _process_document(self, paper_path, progress_callback=None):
+        self.last_timings = {}
+        paper_id = get_paper_id(paper_path)
+
+        reused_fields, record = [], None
+        if self.incremental:
+            reused_fields, record = self._reusable_fields(paper_id)
+            self.reuse_stats["reused_fields"] += len(reused_fields)
+            self.reuse_stats["extracted_fields"] += len(self.field_fingerprints()) - len(reused_fields)
+            if len(reused_fields) == len(self.field_fingerprints()):
+                if self.verbose:
+                    print(f"All fields of {paper_id} unchanged, reusing the previous extraction")
+                self.last_evidence = record["evidence"]
+                self.last_reasoning = record["reasoning"]
+                return self.form_filler.pydantic_form(**record["form"]), paper_id
+
+        start = time.perf_counter()
+        with metrics.timer("pipeline_stage_seconds", stage="load_xml"):
+            paper = load_xml(paper_path)
+        self.last_timings["load_xml"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with metrics.timer("pipeline_stage_seconds", stage="set_document"):
+            self.retriever.set_document(paper)
+        self.last_timings["set_document"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with metrics.timer("pipeline_stage_seconds", stage="form_filling"):
+            result = self.form_filler.forward(
+                get_context=self.get_context_wrapper,
+                exclude_fields=reused_fields,
+                progress_callback=progress_callback
+            )
+        self.last_timings["form_filling"] = time.perf_counter() - start
 
         
         raw_field_evidence_map = getattr(self.form_filler, "evidence", {})
@@ -148,29 +292,177 @@ class DiseaseTheoryPipeline:
         # Extract reasoning data for CoT mode
         reasoning_data = self._extract_reasoning_data()
         self.last_reasoning = reasoning_data
-        
-        paper_id = os.path.splitext(os.path.basename(paper_path))[0].split("_")[0]
+
+        if reused_fields:
+            # merge the reused fields of the previous extraction back in, in schema order
+            merged = {**{fieldname: record["form"][fieldname] for fieldname in reused_fields}, **form_to_dict(result)}
+            result = self.form_filler.pydantic_form(**{fieldname: merged[fieldname] for fieldname in self.form_filler.pydantic_form.model_fields})
+            for fieldname in reused_fields:
+                self.last_evidence[fieldname] = record["evidence"].get(fieldname, {})
+                self.last_reasoning.pop(fieldname, None) # field fillers still hold the reasoning of an earlier paper
+                if record["reasoning"].get(fieldname):
+                    self.last_reasoning[fieldname] = record["reasoning"][fieldname]
+
+        metrics.inc("pipeline_papers_processed")
 
         return result, paper_id
 
-    def process_and_store(self, paper_path, progress_callback=None):
-        """Process document and store in graph database."""
+    def extract_record(self, paper_path, progress_callback=None):
+        """Extraction of one paper as a plain dict (paper_id, form, evidence, reasoning, timings, field_fingerprints),
+        the unit corpus_runner workers send back."""
         result, paper_id = self.process_document(paper_path, progress_callback)
-        
-        # Convert pydantic result to dict for graph builder
-        if hasattr(result, 'model_dump'):
-            form_dict = result.model_dump()
-        elif hasattr(result, 'dict'):
-            form_dict = result.dict()
-        else:
-            form_dict = dict(result)
-        
-        # Store in graph with evidence and reasoning
-        self.graph_builder.populate_graph_from_form(
-            form_dict=form_dict,
-            paper_id_for_graph=paper_id,
-            evidence_dict=self.last_evidence,
-            reasoning_dict=self.last_reasoning
-        )
-        
-        return result, paper_id
\ No newline at end of file
+        return {
+            "paper_id": paper_id,
+            "form": form_to_dict(result),
+            "evidence": self.last_evidence,
+            "reasoning": self.last_reasoning,
+            "timings": self.last_timings,
+            "field_fingerprints": self.field_fingerprints(),
+        }
+
+    def generation_stats(self):
+        """Fields generated vs short-circuited so far, and the estimated GPU-seconds the skips saved.
+        With a context token budget also the prefill tokens the packing saved."""
+        stats = dict(self.form_filler.skip_stats)
+        stats["estimated_seconds_saved"] = self.form_filler.estimated_seconds_saved()
+        if self.incremental:
+            stats.update(self.reuse_stats)
+        if self.response_cache is not None:
+            stats["response_cache"] = self.response_cache.stats()
+        context_packer = getattr(self.retriever, "context_packer", None)
+        if context_packer is not None:
+            stats["context_packing"] = {**context_packer.stats, "prefill_tokens_saved": context_packer.tokens_saved()}
+        return stats
+
+    def process_and_store(self, paper_path, progress_callback=None):
+        """Process document and store in graph database. Stage status and the extraction go to the run ledger, if set."""
+        paper_id = get_paper_id(paper_path)
+        if self.ledger is not None:
+            self.ledger.register(paper_id, paper_path)
+        result, paper_id = self._extract(paper_path, paper_id, progress_callback)
+        self._write_graph(paper_id, form_to_dict(result), self.last_evidence, self.last_reasoning)
+        return result, paper_id
+
+    def _extract(self, paper_path, paper_id, progress_callback=None):
+        if self.ledger is not None:
+            self.ledger.start(paper_id, EXTRACT)
+        start = time.perf_counter()
+        try:
+            result, paper_id = self.process_document(paper_path, progress_callback)
+        except Exception as e:
+            if self.ledger is not None:
+                self.ledger.fail(paper_id, EXTRACT, e, time.perf_counter() - start)
+            raise
+        form_dict = form_to_dict(result)
+        field_fingerprints = self.field_fingerprints()
+        if self.results_store is not None:
+            self.results_store.append(paper_id, form_dict, self.last_evidence, self.last_reasoning, timings=self.last_timings,
+                                      field_fingerprints=field_fingerprints)
+        if self.ledger is not None:
+            self.ledger.save_extraction(paper_id, form_dict, self.last_evidence, self.last_reasoning, self.last_timings, field_fingerprints)
+            self.ledger.finish(paper_id, EXTRACT, time.perf_counter() - start)
+        return result, paper_id
+
+    def _write_graph(self, paper_id, form_dict, evidence_dict, reasoning_dict):
+        if self.ledger is not None:
+            self.ledger.start(paper_id, GRAPH_WRITE)
+        start = time.perf_counter()
+        try:
+            # Store in graph with evidence and reasoning
+            self.graph_builder.populate_graph_from_form(
+                form_dict=form_dict,
+                paper_id_for_graph=paper_id,
+                evidence_dict=evidence_dict,
+                reasoning_dict=reasoning_dict
+            )
+        except Exception as e:
+            if self.ledger is not None:
+                self.ledger.fail(paper_id, GRAPH_WRITE, e, time.perf_counter() - start)
+            raise
+        if self.ledger is not None:
+            self.ledger.finish(paper_id, GRAPH_WRITE, time.perf_counter() - start)
+
+    def process_corpus(self, paper_paths, max_attempts=3, progress_callback=None):
+        """Process and store every paper, resuming from the run ledger: papers with both stages done are skipped,
+        a paper whose extraction is done only gets its graph write (re)done from the stored result, and stages
+        that already failed max_attempts times are left alone. Errors are recorded, not raised. Returns the ledger summary.
+        With incremental=True, done papers with changed field fingerprints are extracted again (changed fields only);
+        their graph write adds the new values, use rebuild_graph_from_store on an empty graph to also drop the old ones."""
+        if self.ledger is None:
+            raise ValueError("process_corpus needs a run ledger, pass ledger_path")
+        n_interrupted = self.ledger.reset_interrupted()
+        if n_interrupted and self.verbose:
+            print(f"Resuming run, {n_interrupted} stages were interrupted")
+
+        for paper_path in paper_paths:
+            paper_id = get_paper_id(paper_path)
+            self.ledger.register(paper_id, paper_path)
+            if self.incremental and self.ledger.is_done(paper_id, EXTRACT):
+                reusable, _ = self._reusable_fields(paper_id)
+                if len(reusable) < len(self.field_fingerprints()):
+                    self.ledger.reset(paper_id)
+            if self.ledger.is_done(paper_id):
+                continue
+            try:
+                if not self.ledger.is_done(paper_id, EXTRACT):
+                    if self.ledger.attempts(paper_id, EXTRACT) >= max_attempts:
+                        continue
+                    self._extract(paper_path, paper_id, progress_callback)
+                if self.ledger.attempts(paper_id, GRAPH_WRITE) >= max_attempts:
+                    continue
+                self.retry_graph_write(paper_id)
+            except Exception as e:
+                print(f"Failed on {paper_path}: {e}")
+        if self.results_store is not None:
+            self.results_store.flush()
+        return self.ledger.summary()
+
+    def retry_graph_write(self, paper_id):
+        """(Re)writes a paper to the graph from its stored extraction, without running the llm again."""
+        extraction = self.ledger.load_extraction(paper_id)
+        if extraction is None:
+            raise ValueError(f"No stored extraction for paper {paper_id}")
+        form_dict, evidence_dict, reasoning_dict = extraction
+        self._write_graph(paper_id, form_dict, evidence_dict, reasoning_dict)
+
+    def rebuild_graph_from_store(self, current_schema_only=True, batch_size=500):
+        """Bulk loads every paper of the extraction store into the graph, e.g. after a schema mapping change
+        or a database migration. Records of older schema versions are skipped unless current_schema_only=False."""
+        if self.results_store is None:
+            raise ValueError("rebuild_graph_from_store needs an extraction store, pass results_store_path")
+        schema_version = self.results_store.schema_version if current_schema_only else None
+        return rebuild_graph_from_store(self.results_store, self.graph_builder, schema_version, batch_size, self.verbose)
+
+    def retry_failed_graph_writes(self):
+        """Retries every failed graph write in the ledger, e.g. after neo4j was down. Returns the paper ids still failing."""
+        still_failing = []
+        for paper_id, _ in self.ledger.papers_with_status(GRAPH_WRITE, FAILED):
+            try:
+                self.retry_graph_write(paper_id)
+            except Exception as e:
+                print(f"Graph write failed again for {paper_id}: {e}")
+                still_failing.append(paper_id)
+        return still_failing
+
+    def close(self):
+        """Flushes the extraction store, closes the ledger and the graph connection, and releases the shared embedding model."""
+        if self.results_store is not None:
+            self.results_store.close()
+        if self.ledger is not None:
+            self.ledger.close()
+        self.graph_builder.close()
+        if hasattr(self.retriever, "close"):
+            self.retriever.close()
+
+
+def get_paper_id(paper_path):
+    return os.path.splitext(os.path.basename(paper_path))[0].split("_")[0]
+
+
+def form_to_dict(result):
+    # Convert pydantic result to dict for graph builder
+    if hasattr(result, 'model_dump'):
+        return result.model_dump()
+    if hasattr(result, 'dict'):
+        return result.dict()
+    return dict(result)
\ No newline at end of file
@@ -1,6 +1,14 @@
+import collections
+import hashlib
+import json
+import os
+import shutil
 import dspy
-import weave
+import typing
+from pydantic import PrivateAttr
 from llama_index.core import VectorStoreIndex
+from llama_index.core import StorageContext, load_index_from_storage
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from llama_index.llms.ollama import Ollama
 from llama_index.embeddings.ollama import OllamaEmbedding
 
@@ -35,6 +43,10 @@ from llama_index.core.extractors import (
 )
 
 from .chunking import chunk_by_headers_and_clean
+from .embedding_registry import registry as embedding_registry
+from .ollama_embedding import BatchedOllamaEmbedding
+from ... import tracing
+from ...metrics import metrics
 
 def set_openai_api_key():
     import openai
@@ -42,6 +54,58 @@ def set_openai_api_key():
     openai.api_key = API_KEY
 
 
+class SharedEmbedding(BaseEmbedding):
+    """ llama_index embedding on a sentence-transformers model from the shared embedding registry """
+    _model: typing.Any = PrivateAttr()
+
+    def __init__(self, model_name, device=None, precision="fp32", **kwargs):
+        super().__init__(model_name=model_name, **kwargs)
+        self._model = embedding_registry.acquire(model_name, device, precision)
+
+    def _get_query_embedding(self, query):
+        return self._model.encode(query, normalize_embeddings=True).tolist()
+
+    def _get_text_embedding(self, text):
+        return self._model.encode(text, normalize_embeddings=True).tolist()
+
+    def _get_text_embeddings(self, texts):
+        return self._model.encode(texts, batch_size=self.embed_batch_size, normalize_embeddings=True).tolist()
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def release(self, unload=False):
+        embedding_registry.release(self._model, unload=unload)
+
+
+_llama_embeddings = {} # one llama_index embedding per model, instead of one per document
+
+
+def get_llama_embedding(embed_model, device=None, precision="fp32", cache_path=None):
+    """ openai embedding names go to openai, sentence-transformers ids ("org/name") to the shared registry, the rest to ollama
+    (batched requests, cached in the sqlite file cache_path if given) """
+    key = (embed_model, device, precision, cache_path)
+    if key not in _llama_embeddings:
+        if embed_model in ["text-embedding-3-small", "text-embedding-3-large"]:
+            set_openai_api_key()
+            _llama_embeddings[key] = OpenAIEmbedding(model=embed_model)
+        elif "/" in embed_model:
+            _llama_embeddings[key] = SharedEmbedding(embed_model, device=device, precision=precision)
+        else:
+            _llama_embeddings[key] = BatchedOllamaEmbedding(embed_model, cache_path=cache_path)
+    return _llama_embeddings[key]
+
+
+def release_llama_embeddings(unload=False):
+    """ drops the registry references held by the llama_index embeddings """
+    for embedding in _llama_embeddings.values():
+        if isinstance(embedding, SharedEmbedding):
+            embedding.release(unload=unload)
+        elif isinstance(embedding, BatchedOllamaEmbedding):
+            embedding.close()
+    _llama_embeddings.clear()
+
+
 class VectorStoreSimple():
     """ using LlamaIndex module """
     def __init__(self, document, llm):
@@ -69,9 +133,22 @@ class VectorStoreSimple():
 
 
 
-class VectorStoreWeave(weave.Model):
+_indexes = collections.OrderedDict() # index key -> VectorStoreIndex, the most recently used documents
+MAX_CACHED_INDEXES = 8
+
+
+class VectorStoreWeave(tracing.Model):
+    """ One VectorStoreIndex per (document, chunking, embedding model), built on first use and shared by all
+    retriever variants (simple / mmr, fusion, metadata). With persist_dir the index is also saved there
+    (llama_index storage context, embeddings included) and loaded instead of re-embedding the document """
     document: str
     embed_model: str
+    embedding_device: typing.Optional[str] = None
+    embedding_precision: str = "fp32"
+    embedding: typing.Any = None # llama_index embedding for embed_model, passed to the index instead of the global Settings
+    embedding_cache_path: typing.Optional[str] = None # sqlite embedding cache, for ollama models
+    chunker: str = "headers" # "headers": chunk_by_headers_and_clean (+ metadata extractors), "sentences": llama_index SentenceSplitter
+    persist_dir: typing.Optional[str] = None
     chunk_size: int = 2048
     chunk_overlap: int = 128
     similarity_k: int = 3
@@ -86,6 +163,49 @@ class VectorStoreWeave(weave.Model):
 
 
 
+    def index_key(self):
+        """ everything the stored nodes and embeddings depend on """
+        settings = [self.document, self.chunker, self.chunk_size, self.chunk_overlap, self.embed_model, self.embedding_precision]
+        return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()[:24]
+
+    def get_index(self):
+        """ the index of this document, from memory, from persist_dir, or built (and persisted) """
+        if self.index is not None:
+            return self.index
+        self._set_lm_models()
+        key = self.index_key()
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            metrics.inc("rag_index_memory_hits")
+            self.index = _indexes[key]
+            return self.index
+
+        index_dir = os.path.join(self.persist_dir, key) if self.persist_dir else None
+        if index_dir and os.path.exists(os.path.join(index_dir, "docstore.json")):
+            with metrics.timer("rag_index_load_seconds"):
+                self.index = load_index_from_storage(StorageContext.from_defaults(persist_dir=index_dir), embed_model=self.embedding)
+        else:
+            with metrics.timer("rag_index_build_seconds"):
+                if self.chunker == "headers":
+                    self._store_nodes(self.document)
+                elif self.chunker == "sentences":
+                    self._store_text(self.document)
+                else:
+                    raise ValueError(f"Unknown chunker: {self.chunker}")
+            if index_dir:
+                # written next to it and renamed, so a crash never leaves a half written index to load
+                tmp_dir = f"{index_dir}.tmp-{os.getpid()}"
+                self.index.storage_context.persist(persist_dir=tmp_dir)
+                try:
+                    os.replace(tmp_dir, index_dir)
+                except OSError: # persisted by another process in the meantime
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        _indexes[key] = self.index
+        while len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+        return self.index
+
     def _store_nodes(self, document, verbose=False):
         """ indexing with metadata
         
@@ -97,42 +217,38 @@ class VectorStoreWeave(weave.Model):
 
         nodes = chunk_by_headers_and_clean(document, chunk_size=self.chunk_size, chunk_overlap = self.chunk_overlap, verbose = verbose)
         docs = pipeline.run(documents=nodes)
-        self.index = VectorStoreIndex(nodes=docs)
+        self.index = VectorStoreIndex(nodes=docs, embed_model=self.embedding)
 
 
     def _set_lm_models(self):
-        if self.embed_model in ["text-embedding-3-small", "text-embedding-3-large"]:
-            set_openai_api_key()
-            Settings.embed_model = OpenAIEmbedding(model=self.embed_model)
-        else:
-            Settings.embed_model = OllamaEmbedding(model_name=self.embed_model)
+        self.embedding = get_llama_embedding(self.embed_model, self.embedding_device, self.embedding_precision, self.embedding_cache_path)
 
 
     def _store_text(self, document):
         """ indexing without metadata """
         self._set_lm_models()
         text_splitter = SentenceSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
-        self.index = VectorStoreIndex.from_documents([Document(text=document)], transformations=[text_splitter])
+        self.index = VectorStoreIndex.from_documents([Document(text=document)], transformations=[text_splitter], embed_model=self.embedding)
 
 
     def build_retriever(self):
         """ returns a list of "NodeWithScore" objects """
 
-        self._store_text(self.document)
+        index = self.get_index()
         if self.mmr_param < 1:
-            retriever = self.index.as_retriever(
+            retriever = index.as_retriever(
                     vector_store_query_mode="mmr",
                     similarity_top_k = self.similarity_k,
                     vector_store_kwargs={"mmr_threshold": self.mmr_param},
                     )
         else:
-            retriever = self.index.as_retriever(similarity_top_k = self.similarity_k)
+            retriever = index.as_retriever(similarity_top_k = self.similarity_k)
         return retriever
 
 
     def _build_bm25_retriever(self):
 
-        return BM25Retriever.from_defaults(docstore=self.index.docstore, similarity_top_k=self.similarity_k)
+        return BM25Retriever.from_defaults(docstore=self.get_index().docstore, similarity_top_k=self.similarity_k)
 
 
     def build_fusion_retriever(self):
@@ -183,14 +299,13 @@ class VectorStoreWeave(weave.Model):
         
 
     def build_query_engine(self):
-        self._store_nodes(self.document)
-        return self.index.as_retriever(similarity_top_k = self.similarity_k)
+        return self.get_index().as_retriever(similarity_top_k = self.similarity_k)
 
 
     def build_property_graph(self):
         pass
 
 
-    @weave.op()
+    @tracing.op()
     def predict(self):
         pass
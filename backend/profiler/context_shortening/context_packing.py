@@ -0,0 +1,91 @@
+""" Fitting a field's retrieved chunks into a token budget, counted with the llm's tokenizer.
+
+The chunks are taken best first while they fit whole. A chunk that does not fit is cut after its last sentence that does,
+then the remaining (lower ranked) chunks are still tried, so a short one can fill the rest of the budget.
+Token counts of a joined context are taken as the sum of the parts plus the separators, which is close but not exact
+for most tokenizers, so the budget should keep a little headroom to the model's max input length.
+"""
+import re
+
+from ...metrics import metrics
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def sentence_ends(text):
+    """ end offsets of the sentences (or lines) of text, the last one is len(text) """
+    ends = [match.start() for match in SENTENCE_END.finditer(text) if match.start() > 0]
+    return ends + [len(text)]
+
+
+class ContextPacker():
+    def __init__(self, tokenizer, token_budget, separator = "\n...\n", min_partial_tokens = 32):
+        """
+        tokenizer: the llm's (hugging face style) tokenizer, anything with encode(text, add_special_tokens=False) and decode(ids).
+        token_budget: max tokens of the context given to the llm per field.
+        min_partial_tokens: a cut chunk is only added if at least this many tokens of budget are left.
+        """
+        self.tokenizer = tokenizer
+        self.token_budget = token_budget
+        self.separator = separator
+        self.min_partial_tokens = min_partial_tokens
+        self.separator_tokens = self.count(separator)
+        # cumulative over all pack calls, to see how much prefill the budget saves per corpus
+        self.stats = {"fields": 0, "tokens_before": 0, "tokens_after": 0, "chunks_dropped": 0, "chunks_cut": 0}
+
+    def encode(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def count(self, text):
+        return len(self.encode(text))
+
+    def cut(self, text, budget):
+        """ the longest prefix of whole sentences of text within budget tokens, "" if not even the first one fits """
+        end, used = 0, 0
+        for sentence_end in sentence_ends(text):
+            tokens = self.count(text[end:sentence_end])
+            if used + tokens > budget:
+                break
+            end, used = sentence_end, used + tokens
+        return text[:end].rstrip(), used
+
+    def pack(self, chunks, token_counts = None):
+        """
+        chunks: texts, best first. token_counts: their token counts, if already known (counted here otherwise).
+        Returns [(position in chunks, text)] of the packed (possibly cut) chunks, in the order of chunks.
+        """
+        if token_counts is None:
+            token_counts = [self.count(chunk) for chunk in chunks]
+        packed = []
+        used = 0
+        cut = 0
+        for position, (chunk, tokens) in enumerate(zip(chunks, token_counts)):
+            separator = self.separator_tokens if packed else 0
+            remaining = self.token_budget - used - separator
+            if tokens <= remaining:
+                packed.append((position, chunk))
+                used += separator + tokens
+            elif remaining >= self.min_partial_tokens or not packed:
+                text, text_tokens = self.cut(chunk, remaining)
+                if not text and not packed:
+                    # not even the first sentence of the best chunk fits, rather a hard cut than no context
+                    ids = self.encode(chunk)[:remaining]
+                    text, text_tokens = self.tokenizer.decode(ids).strip(), len(ids)
+                if text:
+                    packed.append((position, text))
+                    used += separator + text_tokens
+                    cut += 1
+
+        before = sum(token_counts) + self.separator_tokens * max(len(chunks) - 1, 0)
+        self.stats["fields"] += 1
+        self.stats["tokens_before"] += before
+        self.stats["tokens_after"] += used
+        self.stats["chunks_dropped"] += len(chunks) - len(packed)
+        self.stats["chunks_cut"] += cut
+        metrics.observe("context_packed_tokens", used)
+        metrics.inc("context_prefill_tokens_saved", before - used)
+        return packed
+
+    def tokens_saved(self):
+        """ prefill tokens the budget saved so far, compared to the unpacked top_k contexts """
+        return self.stats["tokens_before"] - self.stats["tokens_after"]
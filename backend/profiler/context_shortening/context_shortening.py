@@ -2,11 +2,31 @@ import dspy
 import pprint
 import torch
 import typing
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from . import RAG
 from .chunking import chunk_by_headers_and_clean
 from . import keybert_functions
+from .embedding_registry import registry as embedding_registry
+from .lexical_index import BM25Index, reciprocal_rank_fusion
+from .retrieval_state import RetrievalState
 from . import get_ontology_descriptions
+from ...metrics import metrics
+from ..form_filling.response_cache import make_cache_key
+from ..form_filling.dspy_x_openai import GPT3, get_api_base
+
+
+def get_cacheable_lm_id(dspy_lm):
+    """ identity of a dspy lm, for caching what it generates. None if it samples (temperature > 0), its outputs are not cached """
+    kwargs = {k : v for k, v in getattr(dspy_lm, "kwargs", {}).items() if "key" not in k}
+    if (kwargs.get("temperature") or 0) > 0:
+        return None
+    if hasattr(dspy_lm, "model_id") and hasattr(dspy_lm, "sampler_id"): # OutlinesHFModel, its kwargs do not name the model
+        return [type(dspy_lm).__name__, dspy_lm.model_id, dspy_lm.sampler_id, kwargs.get("max_tokens")]
+    if isinstance(dspy_lm, GPT3): # the endpoint is set globally, not in the kwargs
+        return [type(dspy_lm).__name__, kwargs.get("model"), get_api_base(), kwargs]
+    return [type(dspy_lm).__name__, kwargs]
 
 
 class ContextShortener():
@@ -44,7 +64,12 @@ class CreateRetrievalPromptSignature(dspy.Signature):
 class RAGShortener(ContextShortener):
     """ Retrieval implemented in the RAG.py file """
 
-    def __init__(self, embed_model, pydantic_form, retriever_type, chunk_size, chunk_overlap, similarity_k, mmr_param):
+    def __init__(self, embed_model, pydantic_form, retriever_type, chunk_size, chunk_overlap, similarity_k, mmr_param, persist_dir = None, embedding_cache_path = None,
+                 response_cache = None):
+        """ retriever_type: "simple", "fusion" or "metadata", all views over the same per-document index (see RAG.VectorStoreWeave).
+        persist_dir: directory where the document indexes are saved, so re-runs load them instead of re-embedding
+        embedding_cache_path: sqlite file caching the embeddings of ollama embedding models
+        response_cache: optional ResponseCache for the llm generated retrieval prompts """
         self.embed_model = embed_model
         self.pydantic_form = pydantic_form
         self.set_description_retrieval_prompt() # default : use description for retrieval
@@ -53,24 +78,47 @@ class RAGShortener(ContextShortener):
         self.chunk_overlap = chunk_overlap
         self.similarity_k = similarity_k
         self.mmr_param = mmr_param
-
-    def generate_retrieval_prompt_using_llm(self, dspy_lm):
-        """ Generate a retrieval prompt for each field using a dspy llm"""
-        dspy.settings.configure(lm=dspy_lm)
-
-        predictor = dspy.Predict(signature=CreateRetrievalPromptSignature)
-
-        # iterate through fields
+        self.persist_dir = persist_dir
+        self.embedding_cache_path = embedding_cache_path
+        self.response_cache = response_cache
+
+    def generate_retrieval_prompt_using_llm(self, dspy_lm, max_concurrency = 8):
+        """ Generate a retrieval prompt for each field using a dspy llm.
+        The prompts only depend on the field and the lm, so with a response_cache they are generated once per (field schema, lm),
+        and the fields missing from the cache are requested concurrently. Sampling lms are not cached """
         fields = self.pydantic_form.__fields__
+        properties = self.pydantic_form.model_json_schema()["properties"]
+        lm_id = get_cacheable_lm_id(dspy_lm)
+        response_cache = self.response_cache if lm_id is not None else None
+        keys = {fieldname : make_cache_key("retrieval_prompt", CreateRetrievalPromptSignature.__doc__, fieldname, properties[fieldname], lm_id)
+                for fieldname in fields}
+
         retrieval_prompts = {}
-        for fieldname in fields:
+        if response_cache is not None:
+            for fieldname, key in keys.items():
+                cached = response_cache.get(key)
+                if cached is not None:
+                    retrieval_prompts[fieldname] = cached
+
+        predictor = dspy.Predict(signature=CreateRetrievalPromptSignature) # shared by the worker threads, the lm is set thread locally
+        def generate(fieldname):
             field = fields[fieldname]
-            
-            retrieval_prompts[fieldname] = predictor(
-                    answer_field_name = fieldname,
-                    answer_field_examples = str(field.examples),
-                    answer_field_description = field.description
-                    ).answer
+            with dspy.settings.context(lm=dspy_lm): # thread local, so fields can be generated from worker threads
+                return predictor(
+                        answer_field_name = fieldname,
+                        answer_field_examples = str(field.examples),
+                        answer_field_description = field.description
+                        ).answer
+
+        missing = [fieldname for fieldname in fields if fieldname not in retrieval_prompts]
+        if missing:
+            with metrics.timer("retrieval_prompt_generation_seconds"), ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+                for fieldname, prompt in zip(missing, executor.map(generate, missing)):
+                    retrieval_prompts[fieldname] = prompt
+                    if response_cache is not None:
+                        response_cache.set(keys[fieldname], prompt)
+        metrics.inc("retrieval_prompt_cache_hits", len(fields) - len(missing))
+        retrieval_prompts = {fieldname : retrieval_prompts[fieldname] for fieldname in fields} # schema order
 
         print("\nretrieval prompts generated (Read through them and make sure they make sense!):")
         pprint.pprint(retrieval_prompts)
@@ -94,21 +142,21 @@ class RAGShortener(ContextShortener):
                                   chunk_overlap = self.chunk_overlap,
                                   similarity_k = self.similarity_k,
                                   mmr_param = self.mmr_param,
+                                  persist_dir = self.persist_dir,
+                                  embedding_cache_path = self.embedding_cache_path,
                                   )
 
-        # # Simple retriever
-        # if self.retriever_type == "simple":
-        #     self.retriever = vs.build_retriever()
-
-        # # Fancy retriever
-        # if self.retriever_type == "fusion":
-        #     self.retriever = vs.build_fusion_retriever()
+        # Simple retriever
+        if self.retriever_type == "simple":
+            self.retriever = vs.build_retriever()
 
-        # # Retriver with metadata (temporary)
-        # if self.retriever_type == "metadata":
-        #     self.retriever = vs.build_query_engine()
+        # Fancy retriever
+        elif self.retriever_type == "fusion":
+            self.retriever = vs.build_fusion_retriever()
 
-        self.retriever = vs.build_query_engine()
+        # Retriver with metadata
+        else:
+            self.retriever = vs.build_query_engine()
 
 
     def __call__(self, **kwargs):
@@ -147,7 +195,16 @@ class Retrieval(ContextShortener):
             maxsum_factor = 1,
             keyphrase_range = (1,1),
             relevance_threshold = 0.0,
-            return_scores = False
+            answerable_threshold = None,
+            return_scores = False,
+            emb_model = None,
+            embedding_device = None,
+            embedding_precision = "fp32",
+            state_dtype = "float16",
+            lexical_weight = 0.0,
+            rrf_k = 60,
+            corpus_term_stats = None,
+            context_packer = None
             ):
         self.chunk_info_to_compare = chunk_info_to_compare
         self.field_info_to_compare = field_info_to_compare
@@ -163,12 +220,31 @@ class Retrieval(ContextShortener):
         self.maxsum_factor = maxsum_factor
         self.keyphrase_range = keyphrase_range
         self.relevance_threshold = relevance_threshold
+        self.answerable_threshold = answerable_threshold # used by check_answerable, defaults to relevance_threshold
         self.return_scores = return_scores
+        self.chunk_scores = {}
+        self.embedding_precision = embedding_precision
+        self.state_dtype = np.dtype(state_dtype) # of the stored keyword embeddings
+        self.state = None # RetrievalState of the current document
+        # hybrid retrieval: with lexical_weight > 0 a bm25 ranking of the chunks is fused with the dense ranking (reciprocal rank fusion),
+        # so chunks naming rare genes or drugs from the field description / examples are not lost. corpus_term_stats: CorpusTermStats for the idf
+        self.lexical_weight = lexical_weight
+        self.rrf_k = rrf_k
+        self.corpus_term_stats = corpus_term_stats
+        self.lexical_index = None
+        self.lexical_queries = {}
+        self.fused_scores = {}
+        # optional ContextPacker: the top_k chunks are cut down to its token budget (counted with the llm tokenizer)
+        self.context_packer = context_packer
+        self.chunk_token_counts = {} # chunk index -> tokens, per document
 
 
         # define embedding model through these version numbers (dont want to handle the long names through args and main.py...
-        self.emb_model = keybert_functions.get_embedding_model(embedding_model_id)
-        self.kw_model = keybert_functions.get_kw_model(self.emb_model)
+        # an already loaded model (anything with a sentence-transformers style encode) can be passed as emb_model instead,
+        # embedding_model_id should then name it, since it is what identifies the model in settings() / field fingerprints.
+        # models are shared process wide through the embedding registry, call close() to release it
+        self.emb_model = keybert_functions.get_embedding_model(embedding_model_id, embedding_device, embedding_precision) if emb_model is None else emb_model
+        self.candidate_cache = keybert_functions.CandidateEmbeddingCache() if chunk_info_to_compare == "keybert" else None
         
         self.descriptions = {}
         self.target_emb = {}
@@ -181,6 +257,46 @@ class Retrieval(ContextShortener):
 
     def set_pydantic_form(self, pydantic_form):
         self.set_target_embeddings(pydantic_form)
+        self.set_lexical_queries(pydantic_form)
+
+    def set_lexical_queries(self, pydantic_form):
+        """ bm25 query text per field: the field info used for the dense query plus the field's examples """
+        self.lexical_queries = {}
+        for fieldname, field in pydantic_form.model_fields.items():
+            description = self.descriptions.get(fieldname) or ""
+            parts = [description] if isinstance(description, str) else [str(part) for part in description]
+            parts += [str(example) for example in (field.examples or [])]
+            self.lexical_queries[fieldname] = " ".join(parts)
+
+    def close(self, unload = False):
+        """ releases the shared embedding model (unload=True frees it if no one else uses it) """
+        if self.emb_model is not None:
+            embedding_registry.release(self.emb_model, unload = unload)
+        self.emb_model = None
+
+    def settings(self):
+        """ everything that decides which context a field gets, for field fingerprints """
+        return {
+            "chunk_info_to_compare": self.chunk_info_to_compare,
+            "field_info_to_compare": self.field_info_to_compare,
+            "include_choice_every": self.include_choice_every,
+            "embedding_model_id": self.embedding_model_id,
+            "n_keywords": self.n_keywords,
+            "top_k": self.top_k,
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "mmr_param": self.mmr_param,
+            "maxsum_factor": self.maxsum_factor,
+            "keyphrase_range": list(self.keyphrase_range),
+            "relevance_threshold": self.relevance_threshold,
+            "answerable_threshold": self.answerable_threshold,
+            # only when enabled, so dense-only fingerprints stay the same as before hybrid retrieval existed
+            **({"lexical_weight": self.lexical_weight, "rrf_k": self.rrf_k} if self.lexical_weight else {}),
+            # lower precision embeddings and stored keyword embeddings change the dense scores
+            **({"embedding_precision": self.embedding_precision} if self.embedding_precision != "fp32" else {}),
+            **({"state_dtype": self.state_dtype.name} if self.state_dtype != np.float16 else {}),
+            **({"context_token_budget": self.context_packer.token_budget} if self.context_packer is not None else {}),
+        }
 
     def set_target_embeddings(self, pydantic_form):
 
@@ -232,40 +348,45 @@ class Retrieval(ContextShortener):
             raise ValueError
 
     def set_document(self, document):
-        self.chunks = chunk_by_headers_and_clean(document, chunk_size = self.chunk_size, chunk_overlap = self.chunk_overlap, verbose=False)
-        self.chunks = [chunk.text for chunk in self.chunks]
-
-        self.keywordss = []
-        self.keyword_scoress = []
-        self.keyword_embeddingss = []
-        self.indices_with_keywords = []
+        with metrics.timer("retrieval_chunking_seconds"):
+            chunks = chunk_by_headers_and_clean(document, chunk_size = self.chunk_size, chunk_overlap = self.chunk_overlap, verbose=False)
+        with metrics.timer("retrieval_embedding_seconds"):
+            self.set_chunks([chunk.text for chunk in chunks], sections = [chunk.metadata.get("section_header") for chunk in chunks])
+        metrics.observe("retrieval_chunks_per_document", self.state.n_chunks)
+
+    def set_chunks(self, chunks, sections = None):
+        """ embed / extract keywords for already chunked text (set_document without the chunking) """
+        keywordss = []
+        keyword_scoress = []
+        keyword_embeddingss = []
+        indices_with_keywords = []
         if self.chunk_info_to_compare == "keybert":
-            for (i, chunk) in enumerate(self.chunks):
-                keywords, scores = keybert_functions.get_keywords(
-                        chunk, 
-                        self.kw_model, 
-                        # kwargs
-                        keyphrase_ngram_range = self.keyphrase_range,
-                        top_n=self.n_keywords,
-                        use_maxsum = self.maxsum_factor>1,
-                        use_mmr = self.mmr_param<1,
-                        diversity = self.mmr_param,
-                        nr_candidates = int(self.n_keywords * self.maxsum_factor),
-                        )
-
-                embs = self.emb_model.encode(keywords)
+            # all chunks at once, each candidate embedded once per document (or cached from earlier ones) and reused for the keywords
+            chunk_keywords = keybert_functions.get_keywords_for_chunks(
+                    chunks,
+                    self.emb_model,
+                    cache = self.candidate_cache,
+                    # kwargs
+                    keyphrase_ngram_range = self.keyphrase_range,
+                    top_n=self.n_keywords,
+                    use_maxsum = self.maxsum_factor>1,
+                    use_mmr = self.mmr_param<1,
+                    diversity = self.mmr_param,
+                    nr_candidates = int(self.n_keywords * self.maxsum_factor),
+                    )
+            for (i, (chunk, (keywords, scores, embs))) in enumerate(zip(chunks, chunk_keywords)):
   
                 if len(keywords)==0: # short chunks may have no keyword. Note that this require som extra index handling
                     print(f"no keyword chunk: ***{chunk}***")
                     continue
-                self.keywordss.append(keywords)
-                self.keyword_scoress.append(scores)
-                self.keyword_embeddingss.append(embs)
-                self.indices_with_keywords.append(i)
+                keywordss.append(keywords)
+                keyword_scoress.append(scores)
+                keyword_embeddingss.append(embs)
+                indices_with_keywords.append(i)
 
         elif self.chunk_info_to_compare == "direct":
             # for each chunk, act as if there is a single kw, embed the chunk and give score 1 (can simplify if keybert is redundant)
-            for (i, chunk) in enumerate(self.chunks):
+            for (i, chunk) in enumerate(chunks):
 
                 if len(chunk)==0: # not sure if this can happen or not
                     continue
@@ -273,65 +394,211 @@ class Retrieval(ContextShortener):
                 keywords, scores = [chunk], [1.0]
                 embs = self.emb_model.encode(keywords)
   
-                self.keywordss.append(keywords)
-                self.keyword_scoress.append(scores)
-                self.keyword_embeddingss.append(embs)
-                self.indices_with_keywords.append(i)
+                keywordss.append(keywords)
+                keyword_scoress.append(scores)
+                keyword_embeddingss.append(embs)
+                indices_with_keywords.append(i)
         else:
             raise ValueError
 
-    def __call__(self, **kwargs):
-        fieldname = kwargs["answer_field_name"]
+        self.set_state(RetrievalState.from_lists(chunks, keywordss, keyword_scoress, keyword_embeddingss, indices_with_keywords,
+                                                 sections = sections, dtype = self.state_dtype,
+                                                 store_keywords = self.chunk_info_to_compare != "direct"))
+
+    def set_state(self, state):
+        """ makes state (from set_chunks or load_state) the current document """
+        self.state = state
+        self.chunk_scores = {} # scores are per document
+        self.fused_scores = {}
+        self.chunk_token_counts = {}
+        if self.lexical_weight:
+            with metrics.timer("retrieval_lexical_index_seconds"):
+                self.lexical_index = BM25Index(state.chunks(), corpus_stats = self.corpus_term_stats)
+
+    def save_state(self, directory):
+        """ stores the current document's chunks and embeddings, see load_state """
+        self.state.save(directory)
+
+    def load_state(self, directory, mmap = True):
+        """ a document stored with save_state (by the same embedding model and settings), instead of set_document """
+        self.set_state(RetrievalState.load(directory, mmap = mmap))
+
+    # the per-document lists of earlier versions, as views on the state
+    @property
+    def chunks(self):
+        return self.state.chunks() if self.state is not None else []
+
+    @property
+    def chunk_sections(self):
+        return self.state.sections if self.state is not None else []
+
+    @property
+    def indices_with_keywords(self):
+        return self.state.chunk_indices.tolist() if self.state is not None else []
+
+    @property
+    def keywordss(self):
+        return [self.state.keywords(j) for j in range(len(self.state.chunk_indices))] if self.state is not None else []
+
+    @property
+    def keyword_scoress(self):
+        return [self.state.keyword_scores(j) for j in range(len(self.state.chunk_indices))] if self.state is not None else []
+
+    @property
+    def keyword_embeddingss(self):
+        return [self.state.keyword_embeddings(j) for j in range(len(self.state.chunk_indices))] if self.state is not None else []
+
+    def add_to_corpus_index(self, corpus_index, paper_id):
+        """ adds the chunks of the current document to a CorpusIndex (no-op if the paper is already in it).
+        In direct mode the chunk embeddings are reused, otherwise the chunks are embedded here """
+        if corpus_index.has_paper(paper_id):
+            return 0
+        state = self.state
+        if self.chunk_info_to_compare == "direct":
+            chunk_indices = state.chunk_indices.tolist()
+            embeddings = np.asarray(state.embeddings, dtype=np.float32) if len(chunk_indices) else np.zeros((0, 1))
+        else:
+            chunk_indices = [i for i in range(state.n_chunks) if state.text_offsets[i + 1] > state.text_offsets[i]]
+            embeddings = self.emb_model.encode([state.chunk(i) for i in chunk_indices])
+        return corpus_index.add(paper_id, embeddings,
+                                texts = [state.chunk(i) for i in chunk_indices],
+                                sections = [state.sections[i] for i in chunk_indices],
+                                chunk_indices = chunk_indices)
+
+    def search_corpus(self, corpus_index, query = None, k = 10, answer_field_name = None, paper_ids = None, sections = None):
+        """ the k most similar chunks across all papers in corpus_index, for a query text or for a form field
+        (compared through the same field info as per-document retrieval) """
+        if query is None:
+            target_emb = np.asarray(self.target_emb[answer_field_name])
+            query_embedding = target_emb if target_emb.ndim == 1 else target_emb.mean(axis=0) # several choices: their centroid
+        else:
+            query_embedding = self.emb_model.encode(query)
+        with metrics.timer("retrieval_corpus_search_seconds"):
+            return corpus_index.search(query_embedding, k = k, paper_ids = paper_ids, sections = sections)
+
+    def score_chunks(self, fieldname):
+        """ relevance score for every chunk with keywords, as (score, chunk index) tuples sorted by decreasing score.
+        Cached per field until the next set_document, so a cheap answerability pass and the retrieval itself share the work."""
+        if fieldname in self.chunk_scores:
+            return self.chunk_scores[fieldname]
 
         chunk_scores = []
-        for kw_i, chunk_i in enumerate(self.indices_with_keywords): # keyword indices and chunk indices can be different
+        state = self.state
+        similarities, _, _ = self.get_keyword_similarities(fieldname) # all keywords at once, then sliced per chunk
+        offsets = state.keyword_offsets.tolist()
+        for kw_i, chunk_i in enumerate(state.chunk_indices.tolist()): # keyword indices and chunk indices can be different
 
-            similarity = keybert_functions.get_similarity_matrix(
-                    self.keyword_embeddingss[kw_i], self.target_emb[fieldname]
-                    )
+            similarity = similarities[offsets[kw_i]:offsets[kw_i + 1]]
 
             chunk_scores.append(
                     # store score and index
-                    (self.calculate_chunk_relevance(similarity, self.keyword_scoress[kw_i]), chunk_i) # store index of corresponding chunk in tuple with the score
+                    (self.calculate_chunk_relevance(similarity, state.keyword_scores(kw_i)), chunk_i) # store index of corresponding chunk in tuple with the score
                     )
 
         chunk_scores = sorted(chunk_scores, key = lambda x: -x[0]) # sort in decreasing order, by score
+        self.chunk_scores[fieldname] = chunk_scores
+        return chunk_scores
+
+    def rank_chunks(self, fieldname):
+        """ the chunks to retrieve from, as (score, chunk index) tuples, best first. score is always the dense score.
+        Dense only: the chunks at or above relevance_threshold. Hybrid: those plus the top_k bm25 matches (even below the threshold),
+        ordered by the reciprocal rank fusion of the dense and bm25 rankings """
+        chunk_scores = self.score_chunks(fieldname)
+        if not self.lexical_weight:
+            return [(score, index) for score, index in chunk_scores if score >= self.relevance_threshold]
+        if fieldname in self.fused_scores:
+            return self.fused_scores[fieldname]
+
+        with metrics.timer("retrieval_lexical_seconds"):
+            lexical_scores = self.lexical_index.scores(self.lexical_queries.get(fieldname, ""))
+            lexical_ranking = [int(index) for index in np.argsort(-lexical_scores, kind="stable") if lexical_scores[index] > 0]
+        dense_scores = {index : score for score, index in chunk_scores}
+        fused = reciprocal_rank_fusion([[index for _, index in chunk_scores], lexical_ranking],
+                                       weights = [1.0, self.lexical_weight], k = self.rrf_k)
+        candidates = {index for score, index in chunk_scores if score >= self.relevance_threshold}
+        candidates.update(lexical_ranking[:self.top_k])
+        ranked = sorted(candidates, key = lambda index: -fused[index])
+        self.fused_scores[fieldname] = [(dense_scores.get(index, 0.0), index) for index in ranked]
+        return self.fused_scores[fieldname]
+
+    def check_answerable(self, **kwargs):
+        """ cheap pass deciding whether a field is answerable at all, before any generation.
+        Returns (answerable, reason). Uses the best chunk score against answerable_threshold (falls back to relevance_threshold).
+        Only the dense scores count, bm25 matches on common words of the description would make every field answerable."""
+        fieldname = kwargs["answer_field_name"]
+        threshold = self.relevance_threshold if self.answerable_threshold is None else self.answerable_threshold
 
+        chunk_scores = self.score_chunks(fieldname)
         if not chunk_scores:
-            return "", [] if self.return_scores else ""
+            return False, "no chunks with keywords in document"
+        best_score = float(chunk_scores[0][0])
+        if best_score < threshold:
+            return False, f"best chunk relevance {best_score:.3f} below answerable threshold {threshold}"
+        return True, ""
+
+    def __call__(self, **kwargs):
+        with metrics.timer("retrieval_query_seconds"):
+            return self.retrieve(**kwargs)
 
-        # Filter chunks based on relevance threshold
-        filtered_scores = [(score, index) for score, index in chunk_scores
-                           if score >= self.relevance_threshold]
+    def retrieve(self, **kwargs):
+        fieldname = kwargs["answer_field_name"]
+
+        if not self.score_chunks(fieldname):
+            return ("", []) if self.return_scores else ""
+
+        # Filter chunks based on relevance threshold (and add lexical matches, for hybrid retrieval)
+        filtered_scores = self.rank_chunks(fieldname)
 
         # Return empty if no chunks meet the threshold
         if not filtered_scores:
-            return "", [] if self.return_scores else ""
+            metrics.inc("retrieval_empty_results")
+            return ("", []) if self.return_scores else ""
 
         # Select top_k from the *filtered* chunks
         k = min(len(filtered_scores), self.top_k)
-        chosen_chunks = [self.chunks[filtered_scores[i][1]] for i in range(k)]
+        chosen_scores = filtered_scores[:k]
+        chosen_chunks = [self.state.chunk(index) for _, index in chosen_scores]
+
+        # fit them into the token budget, best first
+        if self.context_packer is not None:
+            packed = self.context_packer.pack(chosen_chunks, [self.chunk_tokens(index, chunk) for (_, index), chunk in zip(chosen_scores, chosen_chunks)])
+            chosen_scores = [chosen_scores[position] for position, _ in packed]
+            chosen_chunks = [text for _, text in packed]
+            k = len(chosen_chunks)
 
         if self.return_scores:
             # Return tuple: (concatenated_string, list_of_details)
-            chosen_details = [(filtered_scores[i][0], filtered_scores[i][1], self.chunks[filtered_scores[i][1]]) for i in range(k)]
+            chosen_details = [(chosen_scores[i][0], chosen_scores[i][1], chosen_chunks[i]) for i in range(k)]
             # Ensure we return a tuple: (string, list)
             return "\n...\n".join(chosen_chunks), chosen_details
         else:
             # Return only the concatenated string (default behavior for grid search)
             return "\n...\n".join(chosen_chunks)
 
+    def chunk_tokens(self, index, chunk):
+        """ llm tokens of chunk index of the current document, counted once per document """
+        if index not in self.chunk_token_counts:
+            self.chunk_token_counts[index] = self.context_packer.count(chunk)
+        return self.chunk_token_counts[index]
+
+    def get_keyword_similarities(self, fieldname):
+        """ (similarity of every keyword of the document to every target of the field, as one keywords x targets matrix,
+        keyword scores, keyword chunk of every row), for batched scoring """
+        state = self.state
+        segments = torch.repeat_interleave(torch.arange(len(state.chunk_indices)),
+                                           torch.from_numpy(np.diff(state.keyword_offsets).astype(np.int64)))
+        scores = torch.tensor(np.asarray(state.scores))
+        if len(state.chunk_indices) == 0:
+            return torch.zeros((0, len(np.atleast_2d(self.target_emb[fieldname])))), scores, segments
+        similarity = keybert_functions.get_similarity_matrix(np.asarray(state.embeddings, dtype=np.float32), self.target_emb[fieldname])
+        return similarity, scores, segments
+
     def get_similarity_matrices(self, fieldname):
         """this function returns the similarity matrix per chunk - for usage with direct keywords-based classification (as opposed to for retrieval/reranking)"""
-        similarities = []
-
-        for kw_i, chunk_i in enumerate(self.indices_with_keywords): # keyword indices and chunk indices can be different
-
-            similarity = keybert_functions.get_similarity_matrix(
-                    self.keyword_embeddingss[kw_i], self.target_emb[fieldname]
-                    )
-            similarities.append((similarity, self.keyword_scoress[kw_i]))
-        return similarities
+        similarity, _, _ = self.get_keyword_similarities(fieldname)
+        offsets = self.state.keyword_offsets.tolist()
+        return [(similarity[offsets[kw_i]:offsets[kw_i + 1]], self.state.keyword_scores(kw_i))
+                for kw_i in range(len(self.state.chunk_indices))] # keyword indices and chunk indices can be different
 
 
 
@@ -0,0 +1,283 @@
+""" Persistent vector index over the chunk embeddings of every paper in a corpus, for questions across papers
+("all chunks discussing CFTR modulators") instead of within one document.
+
+One directory holds:
+    meta.sqlite     chunk metadata (paper id, section, chunk index, text) and index settings
+    vectors.f32     the normalized embeddings, appended row by row (exact search and rebuilds read it as a memmap)
+    ann.hnswlib / ann.faiss     approximate nearest neighbour index, if hnswlib or faiss is installed
+
+Vectors can be added incrementally, and searches can be restricted to papers and sections. Selective filters
+(at most exact_threshold candidate chunks) are searched exactly, everything else through the ann index.
+
+    index = CorpusIndex("corpus_index/", model_id = retriever.embedding_model_id)
+    retriever.add_to_corpus_index(index, paper_id)   # after set_document
+    index.save()
+    hits = retriever.search_corpus(index, "CFTR modulators", k = 20)
+"""
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+BACKENDS = ("hnswlib", "faiss", "exact")
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def _top_k(scores, k):
+    k = min(k, len(scores))
+    if k == 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class CorpusIndex():
+    def __init__(self, directory, dim = None, model_id = None, backend = "auto", hnsw_m = 32, ef_construction = 200,
+                 ef_search = 128, exact_threshold = 20_000):
+        """
+        dim and model_id are stored with a new index, and checked when an existing one is opened
+        (vectors of different embedding models are not comparable). dim can be left out and is taken from the first add.
+        backend: "hnswlib", "faiss", "exact" or "auto" (the first one installed).
+        """
+        self.directory = directory
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.exact_threshold = exact_threshold
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(os.path.join(directory, "meta.sqlite"), check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, paper_id TEXT NOT NULL, section TEXT, chunk_idx INTEGER, text TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS chunks_paper ON chunks (paper_id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS chunks_section ON chunks (section)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+        info = dict(self.connection.execute("SELECT key, value FROM info").fetchall())
+
+        if model_id is not None and info.get("model_id") not in (None, model_id):
+            raise ValueError(f"{directory} holds embeddings of {info['model_id']}, not {model_id}")
+        self.model_id = info.get("model_id", model_id)
+        stored_dim = int(info["dim"]) if "dim" in info else None
+        if dim is not None and stored_dim not in (None, dim):
+            raise ValueError(f"{directory} holds {stored_dim} dimensional embeddings, not {dim}")
+        self.dim = stored_dim or dim
+
+        if backend == "auto":
+            backend = info.get("backend") or ("hnswlib" if hnswlib is not None else "faiss" if faiss is not None else "exact")
+        if backend not in BACKENDS:
+            raise ValueError(f"backend must be one of {BACKENDS} or auto, got {backend}")
+        if (backend == "hnswlib" and hnswlib is None) or (backend == "faiss" and faiss is None):
+            raise ImportError(f"backend {backend} is not installed")
+        self.backend = backend
+
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.n = self.connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        if self.dim is not None and os.path.exists(self.vectors_path):
+            # an add interrupted between writing vectors and committing their metadata leaves extra rows
+            n_vectors = os.path.getsize(self.vectors_path) // (4 * self.dim)
+            if n_vectors > self.n:
+                with open(self.vectors_path, "r+b") as f:
+                    f.truncate(self.n * 4 * self.dim)
+        self.ann = None
+        self.ann_count = 0
+        if self.dim is not None:
+            self._load_ann(int(info.get("ann_count", 0)))
+            self._save_info()
+
+    def _save_info(self, ann_saved_count = None):
+        """ ann_count is only updated when the ann index itself is saved, it tells how many vectors the file holds """
+        info = {"dim": self.dim, "model_id": self.model_id, "backend": self.backend, "ann_count": ann_saved_count}
+        self.connection.executemany("INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)",
+                                    [(key, str(value)) for key, value in info.items() if value is not None])
+        self.connection.commit()
+
+    def _ann_path(self):
+        return os.path.join(self.directory, "ann." + self.backend)
+
+    def _load_ann(self, saved_count):
+        if self.backend == "exact":
+            return
+        path = self._ann_path()
+        if os.path.exists(path) and 0 < saved_count <= self.n:
+            if self.backend == "hnswlib":
+                self.ann = hnswlib.Index(space="ip", dim=self.dim)
+                self.ann.load_index(path, max_elements=max(self.n, 1024))
+            else:
+                self.ann = faiss.read_index(path)
+            self.ann_count = saved_count
+        else:
+            self._new_ann()
+        self._set_ef()
+        self._add_to_ann(self.ann_count, self.n) # vectors added after the last save
+
+    def _new_ann(self):
+        if self.backend == "hnswlib":
+            self.ann = hnswlib.Index(space="ip", dim=self.dim)
+            self.ann.init_index(max_elements=max(self.n, 1024), ef_construction=self.ef_construction, M=self.hnsw_m)
+        else:
+            self.ann = faiss.IndexHNSWFlat(self.dim, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            self.ann.hnsw.efConstruction = self.ef_construction
+        self.ann_count = 0
+
+    def _set_ef(self, ef_search = None):
+        ef_search = ef_search or self.ef_search
+        if self.backend == "hnswlib":
+            self.ann.set_ef(ef_search)
+        elif self.backend == "faiss":
+            self.ann.hnsw.efSearch = ef_search
+
+    def _add_to_ann(self, start, end):
+        if self.ann is None or end <= start:
+            return
+        vectors = np.array(self._vectors()[start:end])
+        if self.backend == "hnswlib":
+            if end > self.ann.get_max_elements():
+                self.ann.resize_index(max(end, 2 * self.ann.get_max_elements()))
+            self.ann.add_items(vectors, np.arange(start, end))
+        else:
+            self.ann.add(vectors) # faiss hnsw ids are the insertion order, which is the row order
+        self.ann_count = end
+
+    def _vectors(self):
+        if self.n == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.n, self.dim))
+
+    def has_paper(self, paper_id):
+        return self.connection.execute("SELECT 1 FROM chunks WHERE paper_id = ? LIMIT 1", (paper_id,)).fetchone() is not None
+
+    def add(self, paper_id, embeddings, texts, sections = None, chunk_indices = None):
+        """ adds the chunks of one paper. Returns the number of chunks added """
+        embeddings = _normalize(embeddings)
+        if len(embeddings) == 0:
+            return 0
+        if len(texts) != len(embeddings):
+            raise ValueError(f"{len(embeddings)} embeddings but {len(texts)} texts")
+        sections = sections or [None] * len(texts)
+        chunk_indices = chunk_indices if chunk_indices is not None else range(len(texts))
+
+        with self.lock:
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                self._load_ann(0)
+                self._save_info()
+            if embeddings.shape[1] != self.dim:
+                raise ValueError(f"embeddings are {embeddings.shape[1]} dimensional, the index {self.dim}")
+            start = self.n
+            with open(self.vectors_path, "ab") as f:
+                f.write(embeddings.tobytes())
+            self.connection.executemany(
+                "INSERT INTO chunks (id, paper_id, section, chunk_idx, text) VALUES (?, ?, ?, ?, ?)",
+                [(start + i, paper_id, section, int(chunk_idx), text)
+                 for i, (section, chunk_idx, text) in enumerate(zip(sections, chunk_indices, texts))])
+            self.connection.commit()
+            self.n += len(embeddings)
+            self._add_to_ann(start, self.n)
+        return len(embeddings)
+
+    def save(self):
+        """ writes the ann index, so reopening does not have to rebuild it (vectors and metadata are always on disk) """
+        with self.lock:
+            if self.ann is not None and self.ann_count > 0:
+                if self.backend == "hnswlib":
+                    self.ann.save_index(self._ann_path())
+                else:
+                    faiss.write_index(self.ann, self._ann_path())
+            self._save_info(self.ann_count)
+
+    def _filter_ids(self, paper_ids, sections):
+        query = "SELECT id FROM chunks WHERE 1"
+        params = []
+        if paper_ids is not None:
+            query += f" AND paper_id IN ({','.join('?' * len(paper_ids))})"
+            params += list(paper_ids)
+        if sections is not None:
+            query += f" AND section IN ({','.join('?' * len(sections))})"
+            params += list(sections)
+        return np.array([row[0] for row in self.connection.execute(query, params)], dtype=np.int64)
+
+    def _exact(self, query, k, candidate_ids = None, block_rows = 100_000):
+        vectors = self._vectors()
+        if candidate_ids is not None:
+            scores = np.array(vectors[np.sort(candidate_ids)] @ query) if len(candidate_ids) else np.zeros(0, dtype=np.float32)
+            top = _top_k(scores, k)
+            return np.sort(candidate_ids)[top], scores[top]
+        best_ids, best_scores = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        for start in range(0, self.n, block_rows): # blocks, so a large corpus is never fully in memory
+            scores = np.array(vectors[start:start + block_rows] @ query)
+            top = _top_k(scores, k)
+            best_ids = np.concatenate([best_ids, top + start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+        top = _top_k(best_scores, k)
+        return best_ids[top], best_scores[top]
+
+    def _approximate(self, query, k, candidate_ids = None):
+        allowed = None if candidate_ids is None else set(candidate_ids.tolist())
+        fetch = k if allowed is None else min(self.ann_count, max(4 * k, int(k * self.ann_count / max(len(allowed), 1))))
+        while True:
+            fetch = min(fetch, self.ann_count)
+            self._set_ef(max(self.ef_search, fetch))
+            if self.backend == "hnswlib":
+                labels, distances = self.ann.knn_query(query[None, :], k=fetch)
+                ids, scores = labels[0].astype(np.int64), 1.0 - distances[0] # hnswlib ip distance is 1 - dot product
+            else:
+                scores, ids = self.ann.search(query[None, :], fetch)
+                ids, scores = ids[0], scores[0]
+            keep = ids >= 0
+            if allowed is not None:
+                keep &= np.array([i in allowed for i in ids.tolist()], dtype=bool)
+            ids, scores = ids[keep], scores[keep]
+            if len(ids) >= k or fetch >= self.ann_count:
+                return ids[:k], scores[:k]
+            fetch *= 4 # too many filtered out, look further
+
+    def search(self, query_embedding, k = 10, paper_ids = None, sections = None, exact = False):
+        """
+        The k chunks most similar to query_embedding (cosine), as dicts with score, paper_id, section, chunk_idx and text.
+        paper_ids / sections restrict the search to those papers / sections.
+        """
+        if self.n == 0:
+            return []
+        query = _normalize(query_embedding)[0]
+        candidate_ids = None
+        if paper_ids is not None or sections is not None:
+            candidate_ids = self._filter_ids(paper_ids, sections)
+        with self.lock:
+            use_exact = exact or self.ann is None or (candidate_ids is not None and len(candidate_ids) <= self.exact_threshold)
+            if use_exact:
+                ids, scores = self._exact(query, k, candidate_ids)
+            else:
+                ids, scores = self._approximate(query, k, candidate_ids)
+        if len(ids) == 0:
+            return []
+        rows = {row[0] : row[1:] for row in self.connection.execute(
+            f"SELECT id, paper_id, section, chunk_idx, text FROM chunks WHERE id IN ({','.join('?' * len(ids))})", [int(i) for i in ids])}
+        return [{"score": float(score), "paper_id": rows[i][0], "section": rows[i][1], "chunk_idx": rows[i][2], "text": rows[i][3]}
+                for i, score in zip(ids.tolist(), scores.tolist())]
+
+    def stats(self):
+        n_papers = self.connection.execute("SELECT COUNT(DISTINCT paper_id) FROM chunks").fetchone()[0]
+        return {"chunks": self.n, "papers": n_papers, "dim": self.dim, "backend": self.backend, "model_id": self.model_id,
+                "ann_chunks": self.ann_count}
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,109 @@
+""" Process-wide registry of sentence-transformers embedding models, so KeyBERT, Retrieval and the llama_index
+retrievers (RAG.SharedEmbedding) share one copy of each model instead of loading their own.
+
+    model = registry.acquire("pritamdeka/S-PubMedBert-MS-MARCO", device="cuda:1", precision="fp16")
+    ...
+    registry.release(model)     # drop the reference
+    registry.unload_unused()    # free the memory of models nobody holds anymore
+
+precision: "fp32", "fp16" (halves gpu memory, cuda only) or "int8" (dynamic quantization of the linear layers, cpu only).
+"""
+import gc
+import threading
+
+import torch
+from sentence_transformers import SentenceTransformer
+
+PRECISIONS = ("fp32", "fp16", "int8")
+
+
+def default_device():
+    """ the embedder goes on the second gpu if there is one, so it does not compete with the llm on cuda:0 """
+    if torch.cuda.device_count() > 1:
+        return "cuda:1"
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
+def load_embedding_model(model_id, device, precision = "fp32"):
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, got {precision}")
+    if precision == "int8" and device != "cpu":
+        raise ValueError("int8 embedding models are only supported on cpu (torch dynamic quantization)")
+    if precision == "fp16" and not device.startswith("cuda"):
+        raise ValueError("fp16 embedding models are only supported on cuda")
+
+    model = SentenceTransformer(model_id, device=device)
+    if precision == "fp16":
+        model.half()
+    elif precision == "int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    return model
+
+
+class EmbeddingModelRegistry():
+    def __init__(self, loader = load_embedding_model):
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.entries = {} # (model_id, device, precision) -> [model, refcount]
+        self.loads = 0
+
+    def acquire(self, model_id, device = None, precision = "fp32"):
+        """ the shared model, loaded on first use. Every acquire should be paired with a release """
+        key = (model_id, device or default_device(), precision)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = [self.loader(*key), 0]
+                self.entries[key] = entry
+                self.loads += 1
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, model, unload = False):
+        """ drops one reference to model. With unload=True it is freed right away if that was the last one """
+        with self.lock:
+            for key, entry in self.entries.items():
+                if entry[0] is model:
+                    entry[1] = max(0, entry[1] - 1)
+                    if unload and entry[1] == 0:
+                        self._unload(key)
+                    return
+        # models not from the registry (e.g. passed in directly) are left alone
+
+    def unload_unused(self):
+        """ frees every model without references, returns how many """
+        with self.lock:
+            unused = [key for key, entry in self.entries.items() if entry[1] == 0]
+            for key in unused:
+                self._unload(key)
+        return len(unused)
+
+    def unload(self, model_id, device = None, precision = "fp32", force = False):
+        """ frees the model, raises if it is still referenced unless force=True """
+        key = (model_id, device or default_device(), precision)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            if entry[1] > 0 and not force:
+                raise RuntimeError(f"{model_id} on {key[1]} is still used by {entry[1]} references")
+            self._unload(key)
+
+    def _unload(self, key):
+        """ caller holds the lock """
+        device = key[1]
+        del self.entries[key]
+        gc.collect()
+        if device.startswith("cuda"):
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "loads": self.loads,
+                "models": {f"{model_id}@{device}/{precision}" : entry[1] for (model_id, device, precision), entry in self.entries.items()},
+            }
+
+
+registry = EmbeddingModelRegistry()
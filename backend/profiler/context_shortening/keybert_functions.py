@@ -1,15 +1,98 @@
+import collections
+
+import numpy as np
 from keybert import KeyBERT
+from keybert._maxsum import max_sum_distance
+from keybert._mmr import mmr
 from sentence_transformers import SentenceTransformer, util
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
 
 import torch
 
+from .embedding_registry import registry
+
 def get_kw_model(model=None): return KeyBERT(model)
 def get_keywords(text, kw_model, **kwargs): 
     keywords_and_scores = kw_model.extract_keywords(text, **kwargs)
     keywords = [x[0] for x in keywords_and_scores]
     scores = [x[1] for x in keywords_and_scores]
     return keywords, scores
-def get_embedding_model(embedding_model_id = 'all-MiniLM-L6-v2'): return SentenceTransformer(embedding_model_id, device = "cuda:1" if torch.cuda.device_count()>1 else "cuda:0")
+
+
+class CandidateEmbeddingCache():
+    """ embeddings of keyword candidates across documents (the same words come up in every paper), least recently used dropped first """
+    def __init__(self, max_entries = 100_000):
+        self.max_entries = max_entries
+        self.embeddings = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, emb_model, texts):
+        """ matrix of the embeddings of texts, encoding only the ones not cached (each once, in one batch) """
+        missing = [text for text in dict.fromkeys(texts) if text not in self.embeddings]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            for text, embedding in zip(missing, np.asarray(emb_model.encode(missing))):
+                self.embeddings[text] = embedding
+        for text in texts:
+            self.embeddings.move_to_end(text)
+        result = np.stack([self.embeddings[text] for text in texts]) if texts else np.zeros((0, 0), dtype=np.float32)
+        while len(self.embeddings) > self.max_entries:
+            self.embeddings.popitem(last=False)
+        return result
+
+
+def get_keywords_for_chunks(chunks, emb_model, cache = None, keyphrase_ngram_range = (1, 1), stop_words = "english", top_n = 5,
+                            use_maxsum = False, use_mmr = False, diversity = 0.5, nr_candidates = 20):
+    """
+    get_keywords (KeyBERT's extract_keywords) for all chunks of a document at once: the candidates of all chunks come from one
+    vectorizer and every unique candidate is embedded once (or taken from cache), the chunks in one batch.
+    Returns (keywords, scores, keyword embeddings) per chunk, the embeddings are the candidates' so they need no second encode.
+    """
+    empty = ([], [], np.zeros((0, 0), dtype=np.float32))
+    try:
+        count = CountVectorizer(ngram_range=keyphrase_ngram_range, stop_words=stop_words).fit(chunks)
+    except ValueError: # no words in any chunk
+        return [empty for _ in chunks]
+    words = count.get_feature_names_out()
+    df = count.transform(chunks)
+
+    chunk_embeddings = np.asarray(emb_model.encode(list(chunks)))
+    used = np.unique(df.nonzero()[1])
+    word_embeddings = np.zeros((len(words), chunk_embeddings.shape[1]), dtype=chunk_embeddings.dtype)
+    if len(used):
+        encode = cache.encode if cache is not None else lambda model, texts: np.asarray(model.encode(texts))
+        word_embeddings[used] = encode(emb_model, [words[i] for i in used])
+
+    results = []
+    for index in range(len(chunks)):
+        candidate_indices = df[index].nonzero()[1]
+        if len(candidate_indices) == 0:
+            results.append(empty)
+            continue
+        candidates = [words[i] for i in candidate_indices]
+        candidate_embeddings = word_embeddings[candidate_indices]
+        chunk_embedding = chunk_embeddings[index].reshape(1, -1)
+        try:
+            if use_mmr:
+                keywords = mmr(chunk_embedding, candidate_embeddings, candidates, top_n, diversity)
+            elif use_maxsum:
+                keywords = max_sum_distance(chunk_embedding, candidate_embeddings, candidates, top_n, nr_candidates)
+            else:
+                distances = cosine_similarity(chunk_embedding, candidate_embeddings)
+                keywords = [(candidates[i], round(float(distances[0][i]), 4)) for i in distances.argsort()[0][-top_n:]][::-1]
+        except ValueError:
+            results.append(empty)
+            continue
+        row = {candidate : i for candidate, i in zip(candidates, candidate_indices)}
+        results.append(([keyword for keyword, _ in keywords],
+                        [score for _, score in keywords],
+                        word_embeddings[[row[keyword] for keyword, _ in keywords]]))
+    return results
+
+def get_embedding_model(embedding_model_id = 'all-MiniLM-L6-v2', device = None, precision = "fp32"): return registry.acquire(embedding_model_id, device, precision) # shared, release with registry.release
 def get_similarity_matrix(kw_embeddings, target_embeddings):  return util.cos_sim(kw_embeddings, target_embeddings)
 
 
@@ -0,0 +1,112 @@
+""" Lexical (BM25) scoring of chunks, to complement the dense scores for rare terms like gene and drug names,
+which general embedding models tend to blur together.
+
+BM25Index is built once per document from its chunks: a compact inverted index in CSR form, one array of chunk ids and
+one of precomputed term weights per posting, so scoring a query is a few numpy slices. With only a handful of chunks per
+document the idf is noisy, so document frequencies can also come from a whole corpus (CorpusTermStats).
+"""
+import json
+import math
+import re
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9][a-z0-9\-]*[a-z0-9]|[a-z0-9]")
+STOPWORDS = frozenset("""
+a an and are as at be been but by can did do does for from had has have if in into is it its may more most no not of on or
+such than that the their then there these they this those to was were which while with within without also between both
+each other over under using used use we our study studies patients patient
+""".split())
+
+
+def tokenize(text):
+    """ lowercase words, keeping internal hyphens and digits (cftr, f508del, il-6), without stopwords """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class CorpusTermStats():
+    """ document frequencies over many chunks (e.g. a whole corpus), for a more stable idf than a single paper gives """
+    def __init__(self):
+        self.n_chunks = 0
+        self.document_frequency = {}
+
+    def add(self, chunks):
+        for chunk in chunks:
+            self.n_chunks += 1
+            for term in set(tokenize(chunk)):
+                self.document_frequency[term] = self.document_frequency.get(term, 0) + 1
+
+    def idf(self, term, extra_chunks = 0, extra_df = 0):
+        n = self.n_chunks + extra_chunks
+        df = self.document_frequency.get(term, 0) + extra_df
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"n_chunks": self.n_chunks, "document_frequency": self.document_frequency}, f)
+
+    @classmethod
+    def load(cls, path):
+        stats = cls()
+        with open(path) as f:
+            data = json.load(f)
+        stats.n_chunks = data["n_chunks"]
+        stats.document_frequency = data["document_frequency"]
+        return stats
+
+
+class BM25Index():
+    def __init__(self, chunks, k1 = 1.5, b = 0.75, corpus_stats = None):
+        """ chunks: list of strings. corpus_stats: optional CorpusTermStats for the idf (the document's own chunks are added to it) """
+        self.n_chunks = len(chunks)
+        tokenized = [tokenize(chunk) for chunk in chunks]
+        chunk_lengths = np.array([len(tokens) for tokens in tokenized], dtype=np.float32)
+        average_length = float(chunk_lengths.mean()) if self.n_chunks and chunk_lengths.sum() else 1.0
+
+        postings = {} # term -> {chunk id: term frequency}
+        for chunk_id, tokens in enumerate(tokenized):
+            for token in tokens:
+                term_postings = postings.setdefault(token, {})
+                term_postings[chunk_id] = term_postings.get(chunk_id, 0) + 1
+
+        self.vocabulary = {}
+        indptr = [0]
+        chunk_ids = []
+        weights = []
+        idf = []
+        for term_id, (term, term_postings) in enumerate(postings.items()):
+            self.vocabulary[term] = term_id
+            df = len(term_postings)
+            if corpus_stats is None:
+                idf.append(math.log(1 + (self.n_chunks - df + 0.5) / (df + 0.5)))
+            else:
+                idf.append(corpus_stats.idf(term, extra_chunks = self.n_chunks, extra_df = df))
+            for chunk_id, tf in term_postings.items():
+                chunk_ids.append(chunk_id)
+                weights.append(tf * (k1 + 1) / (tf + k1 * (1 - b + b * chunk_lengths[chunk_id] / average_length)))
+            indptr.append(len(chunk_ids))
+
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.chunk_ids = np.array(chunk_ids, dtype=np.int32)
+        self.weights = np.array(weights, dtype=np.float32) * np.repeat(np.array(idf, dtype=np.float32), np.diff(self.indptr))
+
+    def scores(self, query):
+        """ bm25 score of every chunk for the query text """
+        scores = np.zeros(self.n_chunks, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            scores[self.chunk_ids[start:end]] += self.weights[start:end] # a term occurs once per chunk in its postings
+        return scores
+
+
+def reciprocal_rank_fusion(rankings, weights = None, k = 60):
+    """ rankings: lists of item ids, best first. Returns {item: sum of weight / (k + rank)} """
+    weights = weights or [1.0] * len(rankings)
+    fused = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, item in enumerate(ranking, start = 1):
+            fused[item] = fused.get(item, 0.0) + weight / (k + rank)
+    return fused
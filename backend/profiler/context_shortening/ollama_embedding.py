@@ -0,0 +1,138 @@
+""" llama_index embedding for Ollama models that sends the texts in batches of batch_size, max_concurrency batches at a time,
+instead of one small request after the other, and keeps the embeddings in a sqlite cache keyed by the hash of (model, text),
+so re-indexing a document costs no requests at all.
+
+    embedding = BatchedOllamaEmbedding("nomic-embed-text", batch_size=64, max_concurrency=4, cache_path="cache/embeddings.sqlite")
+    VectorStoreIndex(nodes, embed_model=embedding)
+"""
+import collections
+import hashlib
+import os
+import sqlite3
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from ollama import Client
+from pydantic import PrivateAttr
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+from ...metrics import metrics
+
+
+class EmbeddingCache():
+    """ float32 vectors in a sqlite file, keyed by text hash """
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self.connection.commit()
+
+    def get_many(self, keys):
+        """ {key: vector} for the keys in the cache """
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500): # below sqlite's limit on query parameters
+                part = keys[i:i + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part).fetchall()
+                found.update((key, np.frombuffer(vector, dtype=np.float32).tolist()) for key, vector in rows)
+        return found
+
+    def set_many(self, items):
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                                        [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items])
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class BatchedOllamaEmbedding(BaseEmbedding):
+    batch_size: int = 64
+    max_concurrency: int = 4
+    memory_entries: int = 10_000
+    base_url: str = "http://localhost:11434"
+    _client: typing.Any = PrivateAttr()
+    _cache: typing.Any = PrivateAttr()
+    _memory: typing.Any = PrivateAttr()
+    _executor: typing.Any = PrivateAttr()
+
+    def __init__(self, model_name, base_url=None, batch_size=64, max_concurrency=4, cache_path=None, **kwargs):
+        """ base_url defaults to $OLLAMA_HOST or localhost. cache_path: sqlite file, None for an in-memory cache only """
+        base_url = base_url or os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+        if not base_url.startswith("http"):
+            base_url = f"http://{base_url}"
+        # llama_index hands over at most embed_batch_size texts per call, enough here to keep every concurrent request busy
+        super().__init__(model_name=model_name, base_url=base_url, batch_size=batch_size, max_concurrency=max_concurrency,
+                         embed_batch_size=min(2048, batch_size * max_concurrency), **kwargs)
+        self._client = Client(host=base_url)
+        self._cache = EmbeddingCache(cache_path) if cache_path else None
+        self._memory = collections.OrderedDict() # the most recent embeddings, e.g. the chunks of the current document
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency) if max_concurrency > 1 else None
+
+    @classmethod
+    def class_name(cls):
+        return "BatchedOllamaEmbedding"
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\n{text}".encode("utf-8")).hexdigest()
+
+    def _embed_batch(self, texts):
+        with metrics.timer("ollama_embedding_request_seconds"):
+            return self._client.embed(model=self.model_name, input=texts).embeddings
+
+    def embed_texts(self, texts):
+        """ embeddings of texts, from the cache where possible and in concurrent batched requests otherwise """
+        keys = [self._key(text) for text in texts]
+        found = {key : self._memory[key] for key in keys if key in self._memory}
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing and self._cache is not None:
+            found.update(self._cache.get_many(missing))
+            missing = [key for key in missing if key not in found]
+        metrics.inc("ollama_embedding_cache_hits", len(found))
+
+        if missing:
+            text_by_key = dict(zip(keys, texts))
+            batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+            requests = [[text_by_key[key] for key in batch] for batch in batches]
+            if self._executor is not None and len(requests) > 1:
+                results = list(self._executor.map(self._embed_batch, requests))
+            else:
+                results = [self._embed_batch(request) for request in requests]
+            new = [(key, vector) for batch, vectors in zip(batches, results) for key, vector in zip(batch, vectors)]
+            found.update(new)
+            if self._cache is not None:
+                self._cache.set_many(new)
+            metrics.inc("ollama_embedding_requests", len(requests))
+
+        for key, vector in found.items():
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+        return [found[key] for key in keys]
+
+    def _get_query_embedding(self, query):
+        return self.embed_texts([query])[0]
+
+    def _get_text_embedding(self, text):
+        return self.embed_texts([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self.embed_texts(texts)
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._cache is not None:
+            self._cache.close()
@@ -0,0 +1,106 @@
+""" Compact per-document state of Retrieval: the chunk texts and the keyword embeddings and scores of the chunks,
+in a few flat arrays instead of parallel lists of small arrays and strings.
+
+    texts           utf-8 bytes of all chunks, chunk i is text_buffer[text_offsets[i]:text_offsets[i + 1]]
+    chunk_indices   int32, the chunks that have keywords (keyword index -> chunk index)
+    keyword_offsets int32, the keywords of keyword chunk j are rows keyword_offsets[j]:keyword_offsets[j + 1] of
+    embeddings      float16 (by default) matrix, one row per keyword
+    scores          float32, keyword scores, one per row
+
+save() writes every array as .npy, load() memory maps them, so a stored document is back without copying or re-embedding.
+"""
+import json
+import os
+
+import numpy as np
+
+ARRAYS = ("text_buffer", "text_offsets", "chunk_indices", "keyword_offsets", "embeddings", "scores", "keyword_buffer", "keyword_text_offsets")
+
+
+def pack_texts(texts):
+    """ (uint8 buffer, int64 offsets) of a list of strings """
+    encoded = [text.encode("utf-8") for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+class RetrievalState():
+    __slots__ = ARRAYS + ("sections",)
+
+    def __init__(self, text_buffer, text_offsets, chunk_indices, keyword_offsets, embeddings, scores,
+                 keyword_buffer = None, keyword_text_offsets = None, sections = None):
+        self.text_buffer = text_buffer
+        self.text_offsets = text_offsets
+        self.chunk_indices = chunk_indices
+        self.keyword_offsets = keyword_offsets
+        self.embeddings = embeddings
+        self.scores = scores
+        self.keyword_buffer = keyword_buffer # keyword texts, only when they are not the chunks themselves
+        self.keyword_text_offsets = keyword_text_offsets
+        self.sections = sections
+
+    @classmethod
+    def from_lists(cls, chunks, keywordss, keyword_scoress, keyword_embeddingss, indices_with_keywords, sections = None,
+                   dtype = np.float16, store_keywords = True):
+        """ from Retrieval's per-chunk lists. store_keywords=False when the keywords are the chunks (direct mode) """
+        text_buffer, text_offsets = pack_texts(chunks)
+        keyword_offsets = np.zeros(len(keywordss) + 1, dtype=np.int32)
+        np.cumsum([len(keywords) for keywords in keywordss], out=keyword_offsets[1:])
+        if keyword_embeddingss:
+            embeddings = np.concatenate([np.asarray(embs, dtype=np.float32).reshape(len(keywords), -1)
+                                         for keywords, embs in zip(keywordss, keyword_embeddingss)]).astype(dtype)
+        else:
+            embeddings = np.zeros((0, 0), dtype=dtype)
+        scores = np.array([score for scores in keyword_scoress for score in scores], dtype=np.float32)
+        keyword_buffer, keyword_text_offsets = None, None
+        if store_keywords:
+            keyword_buffer, keyword_text_offsets = pack_texts([keyword for keywords in keywordss for keyword in keywords])
+        return cls(text_buffer, text_offsets, np.array(indices_with_keywords, dtype=np.int32), keyword_offsets,
+                   embeddings, scores, keyword_buffer, keyword_text_offsets, list(sections) if sections else [None] * len(chunks))
+
+    @property
+    def n_chunks(self):
+        return len(self.text_offsets) - 1
+
+    def chunk(self, i):
+        return self.text_buffer[self.text_offsets[i]:self.text_offsets[i + 1]].tobytes().decode("utf-8")
+
+    def chunks(self):
+        return [self.chunk(i) for i in range(self.n_chunks)]
+
+    def keyword_embeddings(self, j):
+        """ float32 embeddings of the keywords of keyword chunk j """
+        return np.asarray(self.embeddings[self.keyword_offsets[j]:self.keyword_offsets[j + 1]], dtype=np.float32)
+
+    def keyword_scores(self, j):
+        return self.scores[self.keyword_offsets[j]:self.keyword_offsets[j + 1]].tolist()
+
+    def keywords(self, j):
+        if self.keyword_buffer is None:
+            return [self.chunk(self.chunk_indices[j])]
+        return [self.keyword_buffer[self.keyword_text_offsets[k]:self.keyword_text_offsets[k + 1]].tobytes().decode("utf-8")
+                for k in range(self.keyword_offsets[j], self.keyword_offsets[j + 1])]
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAYS if getattr(self, name) is not None)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAYS:
+            array = getattr(self, name)
+            if array is not None:
+                np.save(os.path.join(directory, f"{name}.npy"), array)
+        with open(os.path.join(directory, "state.json"), "w") as f:
+            json.dump({"sections": self.sections, "embedding_dtype": str(self.embeddings.dtype)}, f)
+
+    @classmethod
+    def load(cls, directory, mmap = True):
+        """ with mmap the arrays are read only views on the files, loaded by the os on access """
+        arrays = {}
+        for name in ARRAYS:
+            path = os.path.join(directory, f"{name}.npy")
+            arrays[name] = np.load(path, mmap_mode="r" if mmap else None) if os.path.exists(path) else None
+        with open(os.path.join(directory, "state.json")) as f:
+            info = json.load(f)
+        return cls(sections = info["sections"], **arrays)
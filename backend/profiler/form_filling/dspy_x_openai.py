@@ -1,17 +1,19 @@
 # slightly tweeked file from dspy, to allow for structured output, by using openai.beta
 
-import functools
 import json
 import logging
-from typing import Any, Literal, Optional, cast
+import os
+from typing import Any, Literal, Optional
 
 import backoff
 import openai
 
-from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, cache_turn_on
+from dsp.modules.cache_utils import cache_turn_on
 from dsp.modules.lm import LM
 from dsp.utils.settings import settings
 
+from .response_cache import ResponseCache, TieredResponseCache, make_cache_key, schema_fingerprint
+
 try:
     OPENAI_LEGACY = int(openai.version.__version__[0]) == 0
 except Exception:
@@ -112,17 +114,11 @@ class GPT3(LM):
 
         kwargs = {**self.kwargs, **kwargs}
         if self.model_type == "chat":
-            # caching mechanism requires hashable kwargs
             messages = [{"role": "user", "content": prompt}]
             if self.system_prompt:
                 messages.insert(0, {"role": "system", "content": self.system_prompt})
             kwargs["messages"] = messages
-            if "response_format" in kwargs:
-                response_format = kwargs.pop("response_format")
-                kwargs["response_format_hash"] = hash(response_format)
-            else:
-                response_format = None
-            kwargs = {"stringify_request": json.dumps(kwargs)}
+            response_format = kwargs.pop("response_format", None)
             response = chat_request(response_format = response_format, **kwargs)
 
         else:
@@ -223,76 +219,68 @@ class GPT3(LM):
         return completions
 
 
-#@CacheMemory.cache
-#def cached_gpt3_request_v2(**kwargs):
-#    return openai.Completion.create(**kwargs)
-#
-#
-#@functools.lru_cache(maxsize=None if cache_turn_on else 0)
-#@NotebookCacheMemory.cache
-#def cached_gpt3_request_v2_wrapped(**kwargs):
-#    return cached_gpt3_request_v2(**kwargs)
-#
-#
-#@CacheMemory.cache
-#def _cached_gpt3_turbo_request_v2(response_format,**kwargs) -> OpenAIObject:
-#    if "stringify_request" in kwargs:
-#        kwargs = json.loads(kwargs["stringify_request"])
-#    return cast(OpenAIObject, openai.ChatCompletion.create(response_format = response_format,**kwargs))
-#
-#
-#@functools.lru_cache(maxsize=None if cache_turn_on else 0)
-#@NotebookCacheMemory.cache
-#def _cached_gpt3_turbo_request_v2_wrapped(response_format,**kwargs) -> OpenAIObject:
-#    return _cached_gpt3_turbo_request_v2(response_format = response_format,**kwargs)
-#
-#
-#@CacheMemory.cache
-#def v1_cached_gpt3_request_v2(**kwargs):
-#    return openai.completions.create(**kwargs)
-#
-#
-#@functools.lru_cache(maxsize=None if cache_turn_on else 0)
-#@NotebookCacheMemory.cache
-#def v1_cached_gpt3_request_v2_wrapped(**kwargs):
-#    return v1_cached_gpt3_request_v2(**kwargs)
-
-
-#def v1_cached_gpt3_turbo_request_v2(response_format,**kwargs):
-#@CacheMemory.cache
-@CacheMemory.cache(ignore=["response_format"])
-def v1_cached_gpt3_turbo_request_v2(response_format,**kwargs):
-    #if "response_format" in kwargs:
-    #    response_format = kwargs.pop("response_format")
-    #if "stringify_request" in kwargs: # this is always true
-    kwargs = json.loads(kwargs["stringify_request"])
-    if "response_format_hash" in kwargs:
-        kwargs.pop("response_format_hash")
-        kwargs["response_format"] = response_format
-    #return openai.chat.completions.create(**kwargs)
-    print("------------calling openai-------------")
-    #return openai.beta.chat.completions.parse(**kwargs)
-    return openai.beta.chat.completions.parse(**kwargs).model_dump()
-
-
-@functools.lru_cache(maxsize=None if cache_turn_on else 0)
-@NotebookCacheMemory.cache
-#def v1_cached_gpt3_turbo_request_v2_wrapped(response_format,**kwargs):
-#    return v1_cached_gpt3_turbo_request_v2(response_format = response_format,**kwargs)
-def v1_cached_gpt3_turbo_request_v2_wrapped(**kwargs):
-    return v1_cached_gpt3_turbo_request_v2(**kwargs)
-
-#def chat_request(response_format = None, **kwargs):
-def chat_request(**kwargs):
+###
+# request cache: one explicit layer, bounded memory tier in front of a sqlite tier on disk
+###
+
+DEFAULT_CACHE_PATH = os.path.join(os.environ.get("DSP_CACHEDIR", os.path.join(os.path.expanduser("~"), "cachedir_joblib")), "openai_requests.sqlite")
+
+_request_cache = None
+
+
+def configure_request_cache(path = DEFAULT_CACHE_PATH, memory_entries = 1024, max_entries = 200_000, max_bytes = 1_000_000_000, ttl_seconds = None):
+    """ (re)configure the openai request cache. path = None keeps only the memory tier, memory_entries = 0 only the disk tier """
+    global _request_cache
+    disk_cache = ResponseCache(path, max_entries = max_entries, max_bytes = max_bytes, ttl_seconds = ttl_seconds) if path else None
+    _request_cache = TieredResponseCache(memory_entries = memory_entries, disk_cache = disk_cache, ttl_seconds = ttl_seconds)
+    return _request_cache
+
+
+def get_request_cache():
+    """ the request cache, created with defaults on first use. None when dsp caching is turned off (DSP_CACHEBOOL) """
+    if not cache_turn_on:
+        return None
+    if _request_cache is None:
+        configure_request_cache()
+    return _request_cache
+
+
+def get_api_base():
+    """ the endpoint requests go to. GPT3 sets it globally on the openai module, so it is not in the request kwargs """
+    return str(openai.api_base if OPENAI_LEGACY else openai.base_url)
+
+
+def cached_request(kind, request_fn, response_format, kwargs):
+    """ look up / store a request. The key holds the endpoint, every request kwarg and a fingerprint of the response schema,
+    so the same prompt with two different schemas, or to two servers serving the same model name, are different entries """
+    cache = get_request_cache()
+    if cache is None:
+        return request_fn()
+    key = make_cache_key(kind, get_api_base(), kwargs, schema_fingerprint(response_format))
+    response = cache.get(key)
+    if response is None:
+        response = request_fn()
+        cache.set(key, response)
+    return response
+
+
+def chat_request(response_format = None, **kwargs):
     if OPENAI_LEGACY:
-        raise NotImplementedError
-        #return _cached_gpt3_turbo_request_v2_wrapped(response_format = response_format,**kwargs)
-    #return v1_cached_gpt3_turbo_request_v2_wrapped(response_format = response_format,**kwargs).model_dump()
-    #return v1_cached_gpt3_turbo_request_v2_wrapped(**kwargs).model_dump()
-    return v1_cached_gpt3_turbo_request_v2_wrapped(**kwargs)#.model_dump()
+        raise NotImplementedError # structured output needs openai>=1 (openai.beta.chat.completions.parse)
+
+    def request_fn():
+        print("------------calling openai-------------")
+        if response_format is None:
+            return openai.chat.completions.create(**kwargs).model_dump()
+        return openai.beta.chat.completions.parse(response_format = response_format, **kwargs).model_dump()
+
+    return cached_request("chat", request_fn, response_format, kwargs)
+
 
 def completions_request(**kwargs):
     if OPENAI_LEGACY:
-        return cached_gpt3_request_v2_wrapped(**kwargs)
+        request_fn = lambda: dict(openai.Completion.create(**kwargs))
+    else:
+        request_fn = lambda: openai.completions.create(**kwargs).model_dump()
 
-    return v1_cached_gpt3_request_v2_wrapped(**kwargs).model_dump()
+    return cached_request("completions", request_fn, None, kwargs)
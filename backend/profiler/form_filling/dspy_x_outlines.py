@@ -1,9 +1,15 @@
 from dsp.modules.lm import LM
 import dspy
+import hashlib
+import json
+import time
+import torch
 import outlines
-import weave
 
 from . import regex_handling
+from .response_cache import make_cache_key
+from ...metrics import metrics
+from ... import tracing
 
 
 def openai_to_hf(**kwargs):
@@ -32,7 +38,9 @@ class OutlinesHFModel(LM):
         generator,
         model_string = "unspecified",
         max_tokens=20,
-        kwargs = {}
+        kwargs = {},
+        cache = None,
+        constraint_id = None
     ):
         """wrapper for Hugging Face models
 
@@ -43,6 +51,8 @@ class OutlinesHFModel(LM):
             hf_device_map (str, optional): HF config strategy to load the model.
                 Recommeded to use "auto", which will help loading large models using accelerate. Defaults to "auto".
             model_kwargs (dict, optional): additional kwargs to pass to the model constructor. Defaults to empty dict.
+            cache (ResponseCache, optional): persistent response cache, only used with deterministic samplers.
+            constraint_id (str, optional): regex or json schema the generator is constrained to, part of the cache key.
         """
 
         super().__init__(model_string)
@@ -55,6 +65,7 @@ class OutlinesHFModel(LM):
     
         self.history = []
 
+        kwargs = dict(kwargs) # the default dict is shared between instances, so max_tokens of one generator would leak into the others
 
         if type(generator.sampler)==outlines.samplers.GreedySampler:
             kwargs["temperature"] = 0
@@ -65,6 +76,13 @@ class OutlinesHFModel(LM):
         kwargs["max_tokens"] = max_tokens
         self.kwargs = kwargs
 
+        # cache only when the same prompt always gives the same output
+        deterministic = type(generator.sampler) in (outlines.samplers.GreedySampler, outlines.samplers.BeamSearchSampler)
+        self.cache = cache if deterministic else None
+        self.constraint_id = constraint_id
+        self.model_id = getattr(getattr(getattr(self.model, "model", None), "config", None), "_name_or_path", model_string)
+        self.sampler_id = f"{type(generator.sampler).__name__}:{getattr(generator.sampler, 'samples', 1)}"
+
 
     def basic_request(self, prompt, **kwargs):
         raw_kwargs = kwargs
@@ -81,7 +99,7 @@ class OutlinesHFModel(LM):
 
         return response
 
-    @weave.op
+    @tracing.op
     def _generate(self, prompt, **kwargs):
         kwargs = {**openai_to_hf(**self.kwargs), **openai_to_hf(**kwargs)}
         # print(prompt)
@@ -90,14 +108,31 @@ class OutlinesHFModel(LM):
                 prompt = prompt["messages"][0]["content"]
             except (KeyError, IndexError, TypeError):
                 print("Failed to extract 'content' from the prompt.")
+
+        if self.cache is not None:
+            cache_key = make_cache_key(
+                self.model_id,
+                self.sampler_id,
+                hashlib.sha256(str(self.constraint_id).encode("utf-8")).hexdigest(),
+                hashlib.sha256(str(prompt).encode("utf-8")).hexdigest(),
+                kwargs["max_new_tokens"],
+            )
+            cached_text = self.cache.get(cache_key)
+            if cached_text is not None:
+                metrics.inc("llm_cache_hits")
+                return {"prompt": prompt, "choices": [{"text": cached_text}]}
+
         inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        prefill_seconds = self._time_prefill(inputs) if metrics.enabled and metrics.profile_prefill else None
 
         if 'temperature' in kwargs and kwargs['temperature'] == 0.0:
             kwargs['do_sample'] = False
         
         #outputs = self.model.generate(**inputs, **kwargs)
         #print(kwargs)
+        start = time.perf_counter()
         outputs = self.generator(prompt, max_tokens=kwargs["max_new_tokens"])
+        generate_seconds = time.perf_counter() - start
 
         #print("GENERATED OUTPUT:", outputs)
 
@@ -120,12 +155,36 @@ class OutlinesHFModel(LM):
         #completions = [{"text": c} for c in self.tokenizer.batch_decode(outputs, skip_special_tokens=True)]
         completions = [{"text": outputs}]
 
+        if self.cache is not None:
+            self.cache.set(cache_key, str(outputs))
+
+        if metrics.enabled:
+            metrics.inc("llm_generations")
+            metrics.observe("llm_generate_seconds", generate_seconds)
+            metrics.observe("llm_prompt_tokens", inputs["input_ids"].shape[1])
+            metrics.observe("llm_generated_tokens", len(self.tokenizer.encode(str(outputs), add_special_tokens=False)))
+            if prefill_seconds is not None:
+                metrics.observe("llm_prefill_seconds", prefill_seconds)
+                metrics.observe("llm_decode_seconds", max(0.0, generate_seconds - prefill_seconds))
+
         response = {
             "prompt": prompt,
             "choices": completions,
         }
         return response
 
+    def _time_prefill(self, inputs):
+        """ seconds of one forward pass over the prompt, i.e. what generation pays before the first token.
+        Profiling only: the prefill is paid twice. """
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.no_grad():
+            self.model.model(**inputs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter() - start
+
     def __call__(self, prompt, only_completed=True, return_sorted=False, **kwargs):
         assert only_completed, "for now"
         assert return_sorted is False, "for now"
@@ -137,18 +196,32 @@ class OutlinesHFModel(LM):
         return [c["text"] for c in response["choices"]]
 
 
-def make_dspy_generator(outlines_llm, outlines_generator, max_tokens = 20):
+def make_dspy_generator(outlines_llm, outlines_generator, max_tokens = 20, cache = None, constraint_id = None):
     """ get a dspy generator from outlines llm and generator. """
-    lm = OutlinesHFModel(outlines_llm, outlines_generator, max_tokens = max_tokens)
+    lm = OutlinesHFModel(outlines_llm, outlines_generator, max_tokens = max_tokens, cache = cache, constraint_id = constraint_id)
+    return make_lm_predict(lm)
+
 
-    # Define the predictor.
-    @weave.op()
+def make_lm_predict(lm):
+    """ answer generator calling a (long-lived) dspy predictor with lm.
+    dspy.settings.configure pushes a settings dict on the thread's stack that is never popped, once per field of every paper,
+    so lm is set with settings.context instead (thread local, popped after the call) """
+    @tracing.op()
     def predict(dspy_predictor, **prompt_input):
-        dspy.settings.configure(lm=lm)
-        return dspy_predictor(**prompt_input).answer
+        if dspy.settings.lm is lm:
+            return dspy_predictor(**prompt_input).answer
+        with dspy.settings.context(lm=lm):
+            return dspy_predictor(**prompt_input).answer
     return predict
 
 
+def get_constraint_id(field_type, min_l, max_l, answer_in_quotes, listify_form, pydantic_schema = None):
+    """ the regex or json schema a generator from make_constrained_generator is restricted to, as a string (for cache keys) """
+    if pydantic_schema:
+        return json.dumps(pydantic_schema.model_json_schema(), sort_keys=True)
+    return regex_handling.make_regex_string(field_type, min_l, max_l, answer_in_quotes, listify_form)
+
+
 def make_constrained_generator(field_type, llm_model, min_l, max_l, answer_in_quotes, listify_form, sampler = None, pydantic_schema = None):
     """
     make an outlines generator restricted to a specific type*, potentially with constraints, using regex to describe output restrictions 
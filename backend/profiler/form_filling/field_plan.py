@@ -0,0 +1,49 @@
+""" Per-schema field plan: the parts of a field's prompt that do not depend on the paper, rendered once when a form filler
+gets its form instead of for every field of every paper.
+
+str() of a Literal type with ontology-sized value lists, and of long example lists, is not free, and the form fillers used to
+redo it (and rebuild single-field generation schemas) for every field of every paper.
+"""
+
+
+def render_examples(field, answer_in_quotes = False):
+    """ the examples as shown in the prompt. With answer_in_quotes answers are double quoted, so the examples are too """
+    if field.examples is None:
+        examples = []
+    else:
+        examples = field.examples
+        if answer_in_quotes:
+            examples = [str(example) for example in examples]
+    examples = str(examples)
+    if answer_in_quotes:
+        examples = examples.replace("'",'"')
+    return examples
+
+
+class FieldPlan():
+    __slots__ = ("fieldname", "field_type", "description", "type_string", "examples", "subschema")
+
+    def __init__(self, fieldname, field, answer_in_quotes = False, subschema = None):
+        self.fieldname = fieldname
+        self.field_type = field.annotation
+        self.description = field.description
+        self.type_string = str(field.annotation)
+        self.examples = render_examples(field, answer_in_quotes)
+        self.subschema = subschema # single field schema used for generation (openai), None otherwise
+
+    def prompt_input(self):
+        """ a fresh prompt input dict, the field fillers write the context into it """
+        return {
+               "context":None,
+               "answer_field_name":self.fieldname,
+               "answer_field_description":self.description,
+               "answer_field_type":self.type_string,
+               "answer_field_examples":self.examples
+                }
+
+
+def make_field_plan(pydantic_form, answer_in_quotes = False, make_subschema = None):
+    """ {fieldname : FieldPlan}. make_subschema(fieldname) optionally gives each field its generation schema """
+    return {fieldname : FieldPlan(fieldname, field, answer_in_quotes,
+                                  subschema = make_subschema(fieldname) if make_subschema is not None else None)
+            for fieldname, field in pydantic_form.model_fields.items()}
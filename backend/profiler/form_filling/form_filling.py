@@ -4,16 +4,23 @@ from pydantic_core._pydantic_core import ValidationError as pydantic_ValidationE
 import pydantic
 import typing
 import dspy
-import weave
 import json
 import copy
+import functools
 import pprint
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from difflib import SequenceMatcher
 
-from .dspy_x_outlines import make_dspy_generator, make_constrained_generator
+from .dspy_x_outlines import make_dspy_generator, make_constrained_generator, get_constraint_id
 from .dspy_x_openai import GPT3
+from .response_cache import make_cache_key, schema_fingerprint
+from .literal_repair import LiteralMatcher
+from .field_plan import make_field_plan
 from . import listify_pydantic
+from ...metrics import metrics
+from ... import tracing
 
 class OpenAIFormFillSignature(dspy.Signature):
     # dspy signature (prompt template) for sequential form filling (i.e. one field at a time), field-agnistic.
@@ -148,7 +155,60 @@ class CoTFormFillSignature(dspy.Signature):
     answer_field_examples = dspy.InputField() 
     answer = dspy.OutputField()
 
+class CoTWholeFormFillSignature(dspy.Signature):
+    """
+    You are an expert biomedical information extractor analyzing scientific literature.
+
+    CONTEXT
+    =======
+    {context}
+
+    TASK: Fill out every field of the form below in one JSON object.
+    FIELDS
+    ------
+    {form_fields}
+
+    OUTPUT SCHEMA
+    -------------
+    One key per field, each holding:
+    {{
+    "reasoning": "<Explain your analysis for this field>",
+    "evidence": {{"<term>": "<verbatim quote containing term>"}},
+    "final_answer": ["<term1>", "<term2>", "<term3>"]
+    }}
+
+    EXTRACTION RULES
+    ----------------
+    1. Select the 1-3 MOST relevant terms per field (NEVER more than 3)
+    2. Evidence MUST be exact quotes containing the term
+    3. If a field is not answered by the context, give empty evidence and an empty final_answer
+
+    Return ONLY valid JSON - no markdown, no extra text.
+    """
+    context = dspy.InputField()
+    form_fields = dspy.InputField()
+    answer = dspy.OutputField()
+
 # Simple schema for JSON mode without CoT
+def get_llm_id(outlines_llm, sampler):
+    """ model and sampler identity, as part of field fingerprints """
+    model_id = getattr(getattr(getattr(outlines_llm, "model", None), "config", None), "_name_or_path", type(outlines_llm).__name__)
+    sampler_id = f"{type(sampler).__name__}:{getattr(sampler, 'samples', 1)}"
+    return model_id, sampler_id
+
+
+def field_fingerprints(pydantic_form, settings, per_field_settings = None):
+    """
+    {fieldname : fingerprint} of what determines a field's extracted value: its json schema (description, type,
+    examples, constraints) and the extraction settings (model, prompts, retrieval, ...).
+    A result can be reused for a field as long as its fingerprint is unchanged.
+    """
+    properties = pydantic_form.model_json_schema()["properties"]
+    per_field_settings = per_field_settings or {}
+    return {fieldname : make_cache_key(properties[fieldname], settings, per_field_settings.get(fieldname))[:16]
+            for fieldname in pydantic_form.model_fields}
+
+
 class SimpleAnswerSchema(pydantic.BaseModel):
     answer: str
 
@@ -352,8 +412,16 @@ class SequentialFormFiller(dspy.Module):
                  verbose = False,
                  use_cot = False,
                  use_json_constraints = False,
-                 cot_schema = None
+                 cot_schema = None,
+                 skip_empty_context = True,
+                 answerability_check = None,
+                 response_cache = None
                  ):
+        """
+        skip_empty_context: return the not-mentioned answer without calling the llm when retrieval gives no context (json/CoT modes only).
+        answerability_check: optional cheap pass, called with the prompt input before retrieval, returning (answerable, reason).
+        response_cache: optional ResponseCache, so re-runs with a deterministic sampler skip generation.
+        """
         self.llm_model = outlines_llm
         self.sampler = outlines_sampler
         self.verbose = verbose
@@ -364,6 +432,12 @@ class SequentialFormFiller(dspy.Module):
         self.use_cot = use_cot
         self.use_json_constraints = use_json_constraints
         self.cot_schema = cot_schema
+        self.skip_empty_context = skip_empty_context
+        self.answerability_check = answerability_check
+        self.response_cache = response_cache
+
+        # cumulative over all forward calls, to see how much generation the short-circuit saves per corpus
+        self.skip_stats = {"generated_fields": 0, "skipped_fields": 0, "generation_seconds": 0.0}
         
         # Signature selection logic
         if use_cot and cot_schema:
@@ -383,6 +457,10 @@ class SequentialFormFiller(dspy.Module):
     def set_pydantic_form(self, pydantic_form):
         """ Prepares generator for each field typ in the pydantic form """
         self.pydantic_form = pydantic_form
+        # closest allowed answer lookups, for repairing generations outside the Literal values
+        self.literal_matchers = {fieldname : LiteralMatcher(field.annotation.__args__)
+                                 for fieldname, field in pydantic_form.model_fields.items()
+                                 if typing.get_origin(field.annotation) == typing.Literal}
 
         self.dspy_generators = {}
 
@@ -396,7 +474,7 @@ class SequentialFormFiller(dspy.Module):
             field_type, min_l, max_l = get_constraints_from_field(fields[fieldname])
 
             # Create generator key that accounts for mode
-            generator_key = (field_type, min_l, max_l, self.use_cot, self.use_json_constraints, self.listify_form, self.answer_in_quotes)
+            generator_key = self.get_generator_key(fields[fieldname])
 
             # only make a new generator if it is not equal to one already generated
             if not generator_key in self.dspy_generators:
@@ -419,6 +497,7 @@ class SequentialFormFiller(dspy.Module):
                             pydantic_schema=schema_for_generator)
                     
                     generator_max_tokens = 2500 if self.use_cot else 200
+                    constraint_id = get_constraint_id(field_type, min_l, max_l, self.answer_in_quotes, self.listify_form, pydantic_schema=schema_for_generator)
                 else:
                     # Original regex mode
                     outlines_generator = make_constrained_generator(
@@ -431,21 +510,31 @@ class SequentialFormFiller(dspy.Module):
                             sampler = self.sampler)
                     
                     generator_max_tokens = self.max_tokens
+                    constraint_id = get_constraint_id(field_type, min_l, max_l, self.answer_in_quotes, self.listify_form)
                 
-                self.dspy_generators[generator_key] = make_dspy_generator(self.llm_model, outlines_generator, max_tokens = generator_max_tokens)
+                self.dspy_generators[generator_key] = make_dspy_generator(self.llm_model, outlines_generator, max_tokens = generator_max_tokens,
+                                                                          cache = self.response_cache, constraint_id = constraint_id)
         if self.verbose:
             print("Finished generating generators.")
 
+        self.prepare_field_plan()
         self.prepare_field_fillers()
 
+    def get_generator_key(self, field):
+        """ fields with equal keys share a generator """
+        field_type, min_l, max_l = get_constraints_from_field(field)
+        return (field_type, min_l, max_l, self.use_cot, self.use_json_constraints, self.listify_form, self.answer_in_quotes)
+
+    def prepare_field_plan(self):
+        """ prompt parts of every field that do not depend on the paper, see field_plan """
+        self.field_plan = make_field_plan(self.pydantic_form, self.answer_in_quotes)
+
     def prepare_field_fillers(self):
         self.field_fillers = {}
         fields = self.pydantic_form.model_fields
         for fieldname in fields:
             field = fields[fieldname]
-            field_type, min_l, max_l = get_constraints_from_field(field)
-            generator_key = (field_type, min_l, max_l, self.use_cot, self.use_json_constraints, self.listify_form, self.answer_in_quotes)
-            generator = self.dspy_generators[generator_key]
+            generator = self.dspy_generators[self.get_generator_key(field)]
             self.field_fillers[fieldname] = FieldFiller(
                     answer_generator = generator,
                     signature = self.signature,
@@ -455,14 +544,60 @@ class SequentialFormFiller(dspy.Module):
                     use_cot = self.use_cot
                     )
 
+    def field_fingerprints(self, retrieval_settings = None):
+        """ per field fingerprint of schema and generation settings, see field_fingerprints """
+        settings = {
+            "filler": type(self).__name__,
+            "llm": get_llm_id(self.llm_model, self.sampler),
+            "signature": self.signature.__name__,
+            "instructions": self.signature.instructions,
+            "cot_schema": schema_fingerprint(self.cot_schema),
+            "max_tokens": self.max_tokens,
+            "retrieval": retrieval_settings,
+        }
+        fields = self.pydantic_form.model_fields
+        per_field = {fieldname : self.get_generator_key(fields[fieldname]) for fieldname in fields}
+        return field_fingerprints(self.pydantic_form, settings, per_field)
+
     def re_set_pydantic_form(self,pydantic_form):
-        """after shufling literal values, there is no need to remake field filleds since they do not use order"""
+        """after shufling literal values, there is no need to remake field filleds since they do not use order.
+        The prompts do show the order, so the field plan is remade"""
         if self.pydantic_form is None:
             self.set_pydantic_form(pydantic_form)
         self.pydantic_form = pydantic_form
+        self.prepare_field_plan()
+
 
+    def not_mentioned_output(self):
+        """ the answer a field gets when nothing relevant is found. None if the mode has no such value (regex constrained types) """
+        if self.use_cot:
+            return ["Not specified"]
+        if self.use_json_constraints:
+            return "Not specified"
+        return None
 
-    @weave.op()
+    def skip_field(self, fieldname, reason):
+        """ short-circuit a field without invoking the generator, recording why """
+        if self.verbose:
+            print(f"    --SKIP--: {fieldname}: {reason}")
+        self.skip_reasons[fieldname] = reason
+        self.skip_stats["skipped_fields"] += 1
+        metrics.inc("form_fields_skipped")
+        self.field_fillers[fieldname].last_cot_data = {
+            "reasoning": f"Skipped without generation: {reason}.",
+            "evidence": {},
+            "final_answer": []
+        }
+        return self.not_mentioned_output()
+
+    def estimated_seconds_saved(self):
+        """ skipped fields times the mean generation time of the fields that were generated """
+        generated = self.skip_stats["generated_fields"]
+        if generated == 0:
+            return 0.0
+        return self.skip_stats["skipped_fields"] * self.skip_stats["generation_seconds"] / generated
+
+    @tracing.op()
     def forward(self, get_context, exclude_fields = [], progress_callback=None):
 
         pydantic_form = get_subschema(self.pydantic_form, exclude_fields = exclude_fields)
@@ -470,6 +605,8 @@ class SequentialFormFiller(dspy.Module):
         fields = pydantic_form.model_fields
         output_dict = {}
         self.contexts = {}
+        self.skip_reasons = {}
+        can_skip = self.not_mentioned_output() is not None
         
         # Evidence tracking for CoT mode
         if self.use_cot:
@@ -482,29 +619,28 @@ class SequentialFormFiller(dspy.Module):
             field = fields[fieldname]
             field_type = field.annotation
 
-            if field.examples is None:
-                examples = []
-            else:
-                examples = field.examples
-                if self.answer_in_quotes:
-                    examples = [str(example) for example in examples]
-            examples = str(examples)
-            if self.answer_in_quotes:
-                examples = examples.replace("'",'"') # answering is in double quotes TODO should probably drop that just to not have to do this thing)
-
             # make prompt input
-            prompt_input = {
-                           "context":None,
-                           "answer_field_name":fieldname,
-                           "answer_field_description":field.description,
-                           "answer_field_type":str(field_type),
-                           "answer_field_examples":examples
-                            }
-            context = get_context(**prompt_input)
+            prompt_input = self.field_plan[fieldname].prompt_input()
+            # cheap pass: decide whether the field is answerable at all before retrieving and generating
+            answerable, reason = True, ""
+            if can_skip and self.answerability_check is not None:
+                answerable, reason = self.answerability_check(**prompt_input)
+
+            context = get_context(**prompt_input) if answerable else ""
             self.contexts[fieldname] = context
 
             # generate output
-            output = self.field_fillers[fieldname](prompt_input, context, field_type)
+            if not answerable:
+                output = self.skip_field(fieldname, reason)
+            elif can_skip and self.skip_empty_context and not context.strip():
+                output = self.skip_field(fieldname, "no context passed the relevance threshold")
+            else:
+                start = time.perf_counter()
+                output = self.field_fillers[fieldname](prompt_input, context, field_type)
+                generation_seconds = time.perf_counter() - start
+                self.skip_stats["generation_seconds"] += generation_seconds
+                self.skip_stats["generated_fields"] += 1
+                metrics.observe("form_field_generation_seconds", generation_seconds, field=fieldname)
 
             # Handle evidence tracking for CoT mode
             if self.use_cot:
@@ -558,22 +694,17 @@ class SequentialFormFiller(dspy.Module):
                     if typing.get_origin(field_type) == typing.Literal: # i have only seen this problem in Literal fields
                         allowed_answers = field_type.__args__
                         if not predicted_string in allowed_answers: # only alter the field(s) with the problem
-                            
-                            best_similarity  = -1.0
-                            best_ans = None
-                            for ans in allowed_answers:
-                                similarity = SequenceMatcher(None, ans, predicted_string).ratio()
-                                if similarity > best_similarity:
-                                    best_similarity = similarity
-                                    best_ans = ans
+
+                            matcher = self.literal_matchers.get(name)
+                            if matcher is None or matcher.allowed_answers != allowed_answers:
+                                matcher = LiteralMatcher(allowed_answers)
+                            best_ans, method = matcher.match(predicted_string)
 
                             output_dict[name] = best_ans
-                            
+
                             print("!!!!! Failed to generate allowable answer. Finding closest allowable answer instead")
                             print("Predicted answer:", predicted_string, "while closest match is", best_ans)
-                            # log this 
-                            with open("output_log.txt", "a") as file:
-                                file.write(f"\nfound closest match: {predicted_string} -> {best_ans}\n")
+                            metrics.inc("literal_repairs", field = name, method = method)
                 output = pydantic_form(**output_dict)
 
         torch.cuda.empty_cache()
@@ -602,17 +733,27 @@ class SequentialFormFiller(dspy.Module):
         return copy
 
 
+SCHEMA_CACHE_SIZE = 1024 # derived schemas kept, per kind (subschemas, whole form schemas)
+
+
 def get_subschema(original_schema: pydantic.BaseModel, exclude_fields: list = [], remove_maxlength_and_examples = False):
-    """Get a pydantic form with fewer fields"""
+    """Get a pydantic form with fewer fields.
+    Memoized: the same (schema, excluded fields, flag) gives the same class, instead of a new class on every call"""
+    return _get_subschema(original_schema, frozenset(exclude_fields), remove_maxlength_and_examples)
+
+
+@functools.lru_cache(maxsize = SCHEMA_CACHE_SIZE)
+def _get_subschema(original_schema, exclude_fields, remove_maxlength_and_examples):
 
     # Extract the fields from the original schema
     original_fields = original_schema.__annotations__
     # Filter the fields based on the provided list
     new_fields = {}
+    schema_properties = original_schema.schema()["properties"]
     for field in original_fields:
         if not field in exclude_fields:
 
-            properties = original_schema.schema()["properties"][field]
+            properties = schema_properties[field]
             #print(properties)
             if remove_maxlength_and_examples:
                 # this is needed for openai api
@@ -631,6 +772,201 @@ def get_subschema(original_schema: pydantic.BaseModel, exclude_fields: list = []
     NewSchema = pydantic.create_model('NewSchema', **new_fields)
     return NewSchema
 
+@functools.lru_cache(maxsize = SCHEMA_CACHE_SIZE)
+def get_whole_form_schema(pydantic_form, cot_schema):
+    """ one schema holding a cot_schema object (reasoning/evidence/final_answer) for every field of pydantic_form """
+    fields = pydantic_form.model_fields
+    new_fields = {fieldname : (cot_schema, pydantic.Field(description = fields[fieldname].description)) for fieldname in fields}
+    return pydantic.create_model(f'WholeForm_{pydantic_form.__name__}', **new_fields)
+
+
+def merge_contexts(contexts, separator = "\n...\n", max_chunks = None):
+    """ union of retrieved contexts, without duplicate chunks.
+    Chunks are taken rank by rank across the fields, so every field keeps its best chunks if max_chunks cuts the union short."""
+    chunk_lists = [context.split(separator) for context in contexts if context]
+    merged = []
+    for rank in range(max((len(chunks) for chunks in chunk_lists), default=0)):
+        for chunks in chunk_lists:
+            if rank < len(chunks) and chunks[rank] not in merged:
+                merged.append(chunks[rank])
+    if max_chunks is not None:
+        merged = merged[:max_chunks]
+    return separator.join(merged)
+
+
+class WholeFormFiller(dspy.Module):
+    """
+    Local (outlines) counterpart of OpenAIFormFiller: the whole form is decoded in one constrained generation.
+    Retrieval still runs per field, and the union of the contexts is fed to the llm once.
+    Exposes contexts, evidence and reasoning per field like SequentialFormFiller in CoT mode.
+    With exclude_fields the generation is constrained to the remaining fields only (generators are kept per set of
+    excluded fields, MAX_CACHED_GENERATORS of them), so incremental re-extraction does not regenerate reused fields.
+    """
+    MAX_CACHED_GENERATORS = 8
+
+    def __init__(self,
+                 outlines_llm,
+                 outlines_sampler,
+                 cot_schema,
+                 pydantic_form = None,
+                 max_tokens = 6000,
+                 max_context_chunks = None,
+                 verbose = False,
+                 response_cache = None
+                 ):
+        self.llm_model = outlines_llm
+        self.sampler = outlines_sampler
+        self.cot_schema = cot_schema
+        self.max_tokens = max_tokens
+        self.max_context_chunks = max_context_chunks
+        self.verbose = verbose
+        self.response_cache = response_cache
+        self.use_cot = True
+        self.signature = CoTWholeFormFillSignature
+
+        self.skip_stats = {"generated_fields": 0, "skipped_fields": 0, "generation_seconds": 0.0}
+
+        if not pydantic_form is None:
+            self.set_pydantic_form(pydantic_form)
+
+    def set_pydantic_form(self, pydantic_form):
+        """ Prepares a single generator for the whole form """
+        self.pydantic_form = pydantic_form
+        self.generators = OrderedDict() # frozenset of excluded fields -> (whole form schema, dspy generator)
+        self.whole_form_schema, self.dspy_generator = self.get_generator(frozenset())
+        self.predictor = dspy.Predict(signature=self.signature)
+        self.field_plan = make_field_plan(pydantic_form)
+
+    def get_generator(self, exclude_fields):
+        """ (whole form schema, dspy generator) constrained to the fields not in exclude_fields """
+        if exclude_fields in self.generators:
+            self.generators.move_to_end(exclude_fields)
+            return self.generators[exclude_fields]
+        pydantic_form = get_subschema(self.pydantic_form, exclude_fields = exclude_fields) if exclude_fields else self.pydantic_form
+        whole_form_schema = get_whole_form_schema(pydantic_form, self.cot_schema)
+
+        outlines_generator = make_constrained_generator(
+                llm_model=self.llm_model,
+                field_type=None,
+                min_l=None,
+                max_l=None,
+                answer_in_quotes=False,
+                listify_form=False,
+                sampler=self.sampler,
+                pydantic_schema=whole_form_schema)
+        dspy_generator = make_dspy_generator(self.llm_model, outlines_generator, max_tokens = self.max_tokens,
+                                             cache = self.response_cache,
+                                             constraint_id = get_constraint_id(None, None, None, False, False, pydantic_schema=whole_form_schema))
+        self.generators[exclude_fields] = (whole_form_schema, dspy_generator)
+        while len(self.generators) > self.MAX_CACHED_GENERATORS:
+            self.generators.popitem(last=False)
+        return whole_form_schema, dspy_generator
+
+    def re_set_pydantic_form(self, pydantic_form):
+        if self.pydantic_form is None:
+            self.set_pydantic_form(pydantic_form)
+        self.pydantic_form = pydantic_form
+        self.field_plan = make_field_plan(pydantic_form)
+
+    def estimated_seconds_saved(self):
+        generated = self.skip_stats["generated_fields"]
+        if generated == 0:
+            return 0.0
+        return self.skip_stats["skipped_fields"] * self.skip_stats["generation_seconds"] / generated
+
+    def field_fingerprints(self, retrieval_settings = None):
+        """ per field fingerprint of schema and generation settings, see field_fingerprints.
+        Fields are generated together here, but the other fields' schemas are only a weak influence, so they are left out """
+        settings = {
+            "filler": type(self).__name__,
+            "llm": get_llm_id(self.llm_model, self.sampler),
+            "instructions": self.signature.instructions,
+            "cot_schema": schema_fingerprint(self.cot_schema),
+            "max_tokens": self.max_tokens,
+            "max_context_chunks": self.max_context_chunks,
+            "retrieval": retrieval_settings,
+        }
+        return field_fingerprints(self.pydantic_form, settings)
+
+    @tracing.op()
+    def forward(self, get_context, exclude_fields = [], progress_callback=None):
+
+        pydantic_form = get_subschema(self.pydantic_form, exclude_fields = exclude_fields)
+        fields = pydantic_form.model_fields
+
+        # retrieve per field, then generate once
+        field_contexts = []
+        form_fields = []
+        for fieldname in fields:
+            plan = self.field_plan[fieldname]
+            field_contexts.append(get_context(**plan.prompt_input()))
+            form_fields.append(f"- {fieldname}: {plan.description}")
+
+        context = merge_contexts(field_contexts, max_chunks = self.max_context_chunks)
+        # evidence lookup in the pipeline searches the context given to the llm, which is the union for every field
+        self.contexts = {fieldname : context for fieldname in fields}
+        self.evidence = {}
+        self.reasoning = {}
+
+        if not context.strip():
+            if self.verbose:
+                print("    --SKIP--: no context passed the relevance threshold for any field")
+            self.skip_stats["skipped_fields"] += len(fields)
+            parsed = {fieldname : None for fieldname in fields}
+        else:
+            if self.verbose:
+                print("    --INFO--: whole form context length in chars:", len(context))
+            whole_form_schema, dspy_generator = self.get_generator(frozenset(exclude_fields) & frozenset(self.pydantic_form.model_fields))
+            start = time.perf_counter()
+            raw_llm_output = dspy_generator(self.predictor, context = context, form_fields = "\n".join(form_fields))
+            self.skip_stats["generation_seconds"] += time.perf_counter() - start
+            self.skip_stats["generated_fields"] += len(fields)
+
+            # the generator is constrained to the remaining fields, excluded ones are not generated
+            try:
+                parsed = whole_form_schema.model_validate_json(str(raw_llm_output))
+                parsed = {fieldname : getattr(parsed, fieldname) for fieldname in fields}
+            except (json.JSONDecodeError, pydantic.ValidationError) as e:
+                print("WARNING: Failed to parse whole form CoT JSON")
+                print(f"Error: {e}")
+                parsed = {fieldname : None for fieldname in fields}
+
+            if self.verbose:
+                print(f"    --CoT--: Raw LLM Output: {raw_llm_output}")
+
+        output_dict = {}
+        for i, fieldname in enumerate(fields):
+            field_cot = parsed[fieldname]
+            if field_cot is None:
+                self.evidence[fieldname] = {}
+                self.reasoning[fieldname] = ""
+                output_dict[fieldname] = "Not specified"
+            else:
+                self.evidence[fieldname] = field_cot.evidence
+                self.reasoning[fieldname] = field_cot.reasoning
+                output_dict[fieldname] = ", ".join(field_cot.final_answer) if field_cot.final_answer else "Not specified"
+
+            if progress_callback:
+                try:
+                    progress_callback((i + 1) / len(fields), text=f"Processed field {i+1}/{len(fields)}: {fieldname}")
+                except Exception as e:
+                    if self.verbose:
+                        print(f"Error calling progress_callback: {e}")
+
+        output = pydantic_form(**output_dict)
+        torch.cuda.empty_cache()
+        return output
+
+    def deepcopy(self):
+        """ avoid copying llm_model """
+        lm = self.llm_model
+        self.llm_model = None
+        copy = super().deepcopy()
+        self.llm_model = lm
+        copy.llm_model = lm
+        return copy
+
+
 ###
 # openai
 ### 
@@ -652,6 +988,7 @@ class OpenAIFormFiller(dspy.Module):
                               )
         self.verbose = verbose
         self.listify_form = listify_form
+        self.predictor = dspy.Predict(signature=OpenAIFormFillSignature)
 
 
         if not pydantic_form is None:
@@ -664,7 +1001,7 @@ class OpenAIFormFiller(dspy.Module):
             self.set_pydantic_form(pydantic_form)
         self.pydantic_form = pydantic_form
 
-    @weave.op()
+    @tracing.op()
     def forward(self, get_context, exclude_fields = []):
 
         pydantic_form = get_subschema(self.pydantic_form, exclude_fields = exclude_fields, remove_maxlength_and_examples = True)
@@ -685,9 +1022,6 @@ class OpenAIFormFiller(dspy.Module):
 
 
 
-        # prepare generation
-        dspy.settings.configure(lm=self.lm) 
-        predictor = dspy.Predict(signature=signature)
         # prepare context
         context = get_context()
         self.contexts = context
@@ -699,9 +1033,10 @@ class OpenAIFormFiller(dspy.Module):
 
 
         # generate answer
-        answer = predictor(context = context,
-                           config = {"response_format" : pydantic_form},
-                           ).answer
+        with dspy.settings.context(lm=self.lm):
+            answer = self.predictor(context = context,
+                                    config = {"response_format" : pydantic_form},
+                                    ).answer
         
         if self.verbose:
             print("!")
@@ -722,7 +1057,7 @@ class OpenAIFormFiller(dspy.Module):
 # openai sequential
 ###
 
-@weave.op()
+@tracing.op()
 def openAIFieldFiller(prompt_input, # used for retrieval and generation
                       context,
                       field_type,
@@ -730,7 +1065,8 @@ def openAIFieldFiller(prompt_input, # used for retrieval and generation
                       lm,
                       subschema, # used for generation, and NOT retrieval
                       listify=False,
-                      verbose=False
+                      verbose=False,
+                      predictor=None # long-lived dspy.Predict of the signature, made here if not given
                       ):
 
         # retireve chunks
@@ -740,15 +1076,16 @@ def openAIFieldFiller(prompt_input, # used for retrieval and generation
             print("              Form input    : ", prompt_input)
 
         # prepare generation
-        dspy.settings.configure(lm=lm) 
-        predictor = dspy.Predict(signature=signature)
+        if predictor is None:
+            predictor = dspy.Predict(signature=signature)
         # prepare context
         prompt_input["context"] = context
 
-        # generate answer
-        answer = predictor(**prompt_input,
-                           config = {"response_format" : subschema},
-                           ).answer
+        # generate answer. settings.context is thread local, so fields can be filled from worker threads
+        with dspy.settings.context(lm=lm):
+            answer = predictor(**prompt_input,
+                               config = {"response_format" : subschema},
+                               ).answer
 
         if listify:
             raise NotImplementedError
@@ -765,87 +1102,82 @@ def openAIFieldFiller(prompt_input, # used for retrieval and generation
 
 class OpenAISequentialFormFiller(dspy.Module):
     """
+    One openai request per field. forward runs them one after the other,
+    forward_concurrent / forward_batch issue them from a thread pool (max_concurrency requests in flight).
+    Rate limit errors are retried with exponential backoff inside GPT3.request, per request.
+    api_key / api_base can point the lm to any openai compatible server (e.g. a local mock server).
     """
     def __init__(self,
                  model_id,
                  pydantic_form = None,
                  listify_form = False,
                  max_tokens = 50,
-                 verbose = False
+                 verbose = False,
+                 max_concurrency = 8,
+                 api_key = None,
+                 api_base = None
                  ):
         self.model_id = model_id
         self.lm = GPT3(model=model_id, 
+                              api_key=api_key,
+                              api_base=api_base,
                               max_tokens=max_tokens,
                               )
         self.signature = ListedFormFillSignature if listify_form else FormFillSignature
         self.verbose = verbose
         self.max_tokens = max_tokens
         self.listify_form = listify_form
+        self.max_concurrency = max_concurrency
+        self.predictor = dspy.Predict(signature=self.signature) # shared by all fields and worker threads, the lm is set thread locally
         if not pydantic_form is None:
             self.set_pydantic_form(pydantic_form)
 
     def set_pydantic_form(self, pydantic_form):
         self.pydantic_form = pydantic_form
+        self.field_plan = make_field_plan(pydantic_form, make_subschema = self.generation_subschema)
     def re_set_pydantic_form(self, pydantic_form):
         if self.pydantic_form is None:
             self.set_pydantic_form(pydantic_form)
         self.pydantic_form = pydantic_form
+        self.field_plan = make_field_plan(pydantic_form, make_subschema = self.generation_subschema)
 
-    @weave.op()
-    def forward(self, get_context, exclude_fields = []):
+    def generation_subschema(self, fieldname):
+        """ the field alone, without the stuff openai cant handle """
+        all_other_fields = [name for name in self.pydantic_form.model_fields if name != fieldname]
+        return get_subschema(self.pydantic_form, exclude_fields = all_other_fields, remove_maxlength_and_examples = True)
+
+    def prepare_field_requests(self, get_context, exclude_fields = []):
+        """ retrieve context for every field and build the openAIFieldFiller kwargs. Returns (pydantic_form, contexts, requests) """
 
         pydantic_form = get_subschema(self.pydantic_form, exclude_fields = exclude_fields) # keep examples as is for now (for retrieval)
 
         fields = pydantic_form.model_fields
-        output_dict = {}
-        self.contexts = {}
+        contexts = {}
+        requests = {}
 
-        # iterate through fields
-        if self.verbose:
-            print("--INFO--:starting to iterate through fields")
         for fieldname in fields:
-            field = fields[fieldname]
-            field_type = field.annotation
-
-            if field.examples is None:
-                examples = []
-            else:
-                examples = field.examples
-            examples = str(examples)
+            plan = self.field_plan[fieldname]
 
             # make prompt input
-            prompt_input = {
-                           "context":None, 
-                           "answer_field_name":fieldname, 
-                           "answer_field_description":field.description, 
-                           "answer_field_type":str(field_type),
-                           "answer_field_examples":examples
-                            }
+            prompt_input = plan.prompt_input()
 
             context = get_context(**prompt_input)
-            self.contexts[fieldname] = context
-        
-            all_other_fields = list(self.pydantic_form.model_fields.keys())
-            all_other_fields.remove(fieldname)
-            subschema = get_subschema(self.pydantic_form, exclude_fields = all_other_fields, remove_maxlength_and_examples = True) # for generation, remove the stuff openai cant handle
+            contexts[fieldname] = context
 
-            # generate output
-            output = openAIFieldFiller(
+            requests[fieldname] = dict(
                       prompt_input = prompt_input,
                       context = context,
-                      field_type = field_type,
+                      field_type = plan.field_type,
                       signature = self.signature,
                       lm = self.lm,
-                      subschema = subschema,
+                      subschema = plan.subschema, # for generation, and NOT retrieval
                       listify=self.listify_form,
                       verbose=self.verbose,
+                      predictor=self.predictor,
                       )
+        return pydantic_form, contexts, requests
 
-            output_dict[fieldname] = output
-
-        if self.verbose:
-            print("--INFO--: fields iterated")
-
+    def make_output(self, pydantic_form, output_dict):
         # listify form
         if self.listify_form:
             pydantic_form = listify_pydantic.conlistify_pydantic_model(pydantic_form, min_length=1)
@@ -857,9 +1189,54 @@ class OpenAISequentialFormFiller(dspy.Module):
             output = pydantic_form(**output_dict)
         else:
             output = pydantic_form(**{name : val.__str__() for name, val in output_dict.items()})
+        return output
+
+    @tracing.op()
+    def forward(self, get_context, exclude_fields = []):
+
+        # iterate through fields
+        if self.verbose:
+            print("--INFO--:starting to iterate through fields")
+        pydantic_form, self.contexts, requests = self.prepare_field_requests(get_context, exclude_fields = exclude_fields)
+
+        # generate output
+        output_dict = {fieldname : openAIFieldFiller(**request) for fieldname, request in requests.items()}
+
+        if self.verbose:
+            print("--INFO--: fields iterated")
+
+        output = self.make_output(pydantic_form, output_dict)
         torch.cuda.empty_cache()
         return output
 
+    def forward_concurrent(self, get_context, exclude_fields = []):
+        """ same as forward, but with all field requests of the paper in flight at once """
+        return self.forward_batch([get_context], exclude_fields = exclude_fields)[0]
+
+    def forward_batch(self, get_contexts, exclude_fields = []):
+        """
+        Fill one form per get_context function, with the field requests of all papers issued concurrently.
+        Retrieval runs in the calling thread, paper by paper in order, so a get_context may set its document on a shared retriever on first call.
+        Generation for a paper starts while the contexts of the next papers are retrieved.
+        Returns the forms in the order of get_contexts. self.contexts becomes a list with the contexts of every paper.
+        """
+        self.contexts = []
+        pending = []
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            for get_context in get_contexts:
+                pydantic_form, contexts, requests = self.prepare_field_requests(get_context, exclude_fields = exclude_fields)
+                self.contexts.append(contexts)
+                futures = {fieldname : executor.submit(openAIFieldFiller, **request) for fieldname, request in requests.items()}
+                pending.append((pydantic_form, futures))
+
+            outputs = []
+            for pydantic_form, futures in pending:
+                output_dict = {fieldname : future.result() for fieldname, future in futures.items()}
+                outputs.append(self.make_output(pydantic_form, output_dict))
+
+        torch.cuda.empty_cache()
+        return outputs
+
     def deepcopy(self):
         """ avoid copying llm_model """
         if self.verbose:
@@ -897,6 +1274,7 @@ class DirectKeywordSimilarityFiller(dspy.Module):
                  ):
         self.verbose = verbose
         self.order = order
+        self.allowed_indices = {} # fieldname -> (targets they were computed for, target keywords, allowed index tensor)
         if listify_form:
             raise NotImplementedError # not yet (but could be relatively easy)
         self.listify_form = listify_form
@@ -925,7 +1303,7 @@ class DirectKeywordSimilarityFiller(dspy.Module):
                     listify = self.listify_form,
                     )
 
-    @weave.op()
+    @tracing.op()
     def forward(self, context_shortener, exclude_fields = []):
 
         pydantic_form = get_subschema(self.pydantic_form, exclude_fields = exclude_fields)
@@ -965,53 +1343,49 @@ class DirectKeywordSimilarityFiller(dspy.Module):
         torch.cuda.empty_cache()
         return output
 
-    def get_best_answer_for_field(self, context_shortener, fieldname, field_type):
+    def get_allowed_indices(self, context_shortener, fieldname, field_type):
+        """ (lower cased target keywords, tensor of the indices of the targets that are allowed answers), computed once per field and targets """
+        targets = context_shortener.descriptions[fieldname] # strings to match (e.g. ontology node labels or allowed answers)
+        cached = self.allowed_indices.get(fieldname)
+        if cached is not None and cached[0] is targets:
+            return cached[1], cached[2]
 
-        target_keywords = context_shortener.descriptions[fieldname] # strings to match (e.g. ontology node labels or allowed answers)
-        target_keywords = [t.lower() for t in target_keywords] # to lower, to match the allowed answers
+        target_keywords = [t.lower() for t in targets] # to lower, to match the allowed answers
         if getattr(field_type, "__origin__", None) is typing.Literal:
-            allowed_answers = field_type.__args__
-
-
+            allowed_answers = set(field_type.__args__)
+            target_set = set(target_keywords)
             for ans in allowed_answers:
-                assert ans in target_keywords # if not all allowed answers are in the targets, it will not be possible to predict them (could still try predicting the others in certain cases i guess - e.g. ignoring "other", then predict other if best match is not good (future work)
-            allowed_indices = []
-            for i, kw in enumerate(target_keywords):
-                if kw in allowed_answers:
-                    allowed_indices.append(i)
+                assert ans in target_set # if not all allowed answers are in the targets, it will not be possible to predict them (could still try predicting the others in certain cases i guess - e.g. ignoring "other", then predict other if best match is not good (future work)
+            allowed_indices = [i for i, kw in enumerate(target_keywords) if kw in allowed_answers]
         else:
             allowed_indices = list(range(len(target_keywords)))
+        allowed_indices = torch.tensor(allowed_indices, dtype=torch.long)
+        self.allowed_indices[fieldname] = (targets, target_keywords, allowed_indices)
+        return target_keywords, allowed_indices
 
+    def get_best_answer_for_field(self, context_shortener, fieldname, field_type):
 
-        # get similarities
-        similarities = context_shortener.get_similarity_matrices(fieldname)
-
-        # prep similarities:
-        prepared_similarities = []
-        for (similarity, kw_scores) in similarities:
-            
-            # only keep allowed answers
-            similarity = similarity[:,allowed_indices]
-
-            # clip minimum to 0, to ignore negatives when using norms later
-            similarity = similarity.clip(min=0)
+        target_keywords, allowed_indices = self.get_allowed_indices(context_shortener, fieldname, field_type)
 
-            # adjust for keyword scores
-            kw_scores = torch.Tensor(kw_scores)
-            similarity = torch.matmul(similarity.T, kw_scores)
+        # get similarities, all keywords of the document in one matrix
+        similarity, kw_scores, segments = context_shortener.get_keyword_similarities(fieldname)
 
-            prepared_similarities.append(similarity)
+        # only keep allowed answers, clip minimum to 0, to ignore negatives when using norms later
+        similarity = similarity.index_select(1, allowed_indices).clamp(min=0)
 
-        # to numpy array
-        prepared_similarities = np.array([sim.numpy() for sim in prepared_similarities])
+        # adjust for keyword scores, summed per chunk: chunks x allowed answers
+        n_chunks = int(segments[-1]) + 1 if len(segments) else 0
+        prepared_similarities = torch.zeros((n_chunks, len(allowed_indices)), dtype=similarity.dtype)
+        prepared_similarities.index_add_(0, segments, similarity * kw_scores.to(similarity.dtype)[:, None])
 
         # calculate which answer/node matches the chunks best
         best_match_index = self.calculate_best_match(prepared_similarities)
-        best_string = target_keywords[allowed_indices[best_match_index]]
+        best_string = target_keywords[int(allowed_indices[best_match_index])]
         #print("best string:", best_string)
         return best_string
 
     def calculate_best_match(self, similarities):
-        scores_per_node = np.linalg.norm(similarities, ord=self.order, axis=0)
-        am = np.argmax(scores_per_node)
+        """ similarities: chunks x answers. The answer with the largest norm over the chunks """
+        scores_per_node = torch.linalg.vector_norm(torch.as_tensor(similarities), ord=self.order, dim=0)
+        am = int(torch.argmax(scores_per_node))
         return am
\ No newline at end of file
@@ -1,8 +1,10 @@
+import functools
 from pydantic import BaseModel, Field, conlist, create_model, constr
 import pydantic
 from typing import Type
 import typing
 
+@functools.lru_cache(maxsize=256) # memoized, so the same form is not turned into a new class on every call
 def conlistify_pydantic_model(original_class: Type[BaseModel], min_length=1) -> Type[BaseModel]:
     """ given a pydantic model, make a new one where all the fields have list type of the original fields type.
     Conlist is used to ensure at least min_length entries in each field.
@@ -0,0 +1,65 @@
+""" Closest allowed answer of a Literal field, for the rare generations outside the allowed values.
+
+LiteralMatcher is built once per field: an exact match set, a map of normalized forms (case, whitespace, quotes and
+punctuation ignored), and a trigram index that narrows ontology-sized value lists down to a few candidates, which are
+then ranked by difflib similarity like a full scan would. Short lists are always scanned in full.
+"""
+import re
+from difflib import SequenceMatcher
+
+NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize(text):
+    return NON_WORD.sub(" ", str(text).lower()).strip()
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class LiteralMatcher():
+    def __init__(self, allowed_answers, full_scan_below = 64, n_candidates = 32):
+        self.allowed_answers = tuple(allowed_answers)
+        self.allowed = set(self.allowed_answers)
+        self.full_scan_below = full_scan_below
+        self.n_candidates = n_candidates
+
+        self.normalized = {}
+        for answer in self.allowed_answers:
+            self.normalized.setdefault(normalize(answer), answer) # first one wins, like the scan
+        self.trigram_index = {}
+        if len(self.allowed_answers) >= full_scan_below:
+            for i, answer in enumerate(self.allowed_answers):
+                for trigram in trigrams(normalize(answer)):
+                    self.trigram_index.setdefault(trigram, []).append(i)
+
+    def match(self, predicted):
+        """ (allowed answer, how it was found: "exact", "normalized", "fuzzy" or "scan") """
+        if predicted in self.allowed:
+            return predicted, "exact"
+        normalized = normalize(predicted)
+        if normalized in self.normalized:
+            return self.normalized[normalized], "normalized"
+
+        candidates = self.allowed_answers
+        method = "scan"
+        if self.trigram_index:
+            counts = {}
+            for trigram in trigrams(normalized):
+                for i in self.trigram_index.get(trigram, ()):
+                    counts[i] = counts.get(i, 0) + 1
+            if counts:
+                best = sorted(counts, key = lambda i: (-counts[i], i))[:self.n_candidates]
+                candidates = [self.allowed_answers[i] for i in sorted(best)] # in declaration order, so ties go to the first like the scan
+                method = "fuzzy"
+
+        best_similarity = -1.0
+        best_answer = None
+        for answer in candidates:
+            similarity = SequenceMatcher(None, answer, predicted).ratio()
+            if similarity > best_similarity:
+                best_similarity = similarity
+                best_answer = answer
+        return best_answer, method
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+def make_cache_key(*parts):
+    """ stable key from json-serializable parts (model id, sampler, constraint, prompt, ...) """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def schema_fingerprint(schema):
+    """ stable hash of a structured output schema: a pydantic model class, a json schema dict, or None """
+    if schema is None:
+        return None
+    if hasattr(schema, "model_json_schema"):
+        schema = schema.model_json_schema()
+    return hashlib.sha256(json.dumps(schema, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ResponseCache():
+    """
+    Persistent key-value store for llm responses, backed by a single sqlite file.
+    Values are json, zlib compressed. The store is bounded by max_entries and max_bytes,
+    and the least recently used entries are evicted first. Entries older than ttl_seconds (if set) count as misses.
+    Hits only note their access time in memory, the notes are written (one commit) with the next set, eviction or close,
+    or after touch_flush_every hits, so reads do not each pay for a commit.
+    Only use it for deterministic generation, a cached answer is returned as is.
+    """
+    def __init__(self, path, max_entries = 200_000, max_bytes = 1_000_000_000, ttl_seconds = None, touch_flush_every = 256):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.touch_flush_every = touch_flush_every
+        self.touches = {} # key -> last access not yet written
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL, created REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.connection.commit()
+
+        # running totals, so eviction does not need to scan the table on every insert
+        self.n_entries, self.n_bytes = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+    def get(self, key):
+        return self.get_with_created(key)[0]
+
+    def get_with_created(self, key):
+        """ (value, time it was stored), (None, None) on a miss """
+        with self.lock:
+            row = self.connection.execute("SELECT value, size, created FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is not None and self.ttl_seconds is not None and now - row[2] > self.ttl_seconds:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.connection.commit()
+                self.n_entries -= 1
+                self.n_bytes -= row[1]
+                self.evictions += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None, None
+            self.hits += 1
+            self.touches[key] = now
+            if len(self.touches) >= self.touch_flush_every:
+                self._flush_touches()
+                self.connection.commit()
+        return json.loads(zlib.decompress(row[0])), row[2]
+
+    def _flush_touches(self):
+        """ write the pending last_access updates. Caller holds the lock and commits """
+        if self.touches:
+            self.connection.executemany("UPDATE responses SET last_access = ? WHERE key = ?",
+                                        [(accessed, key) for key, accessed in self.touches.items()])
+            self.touches = {}
+
+    def set(self, key, value):
+        blob = zlib.compress(json.dumps(value).encode("utf-8"))
+        with self.lock:
+            old = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.n_entries -= 1
+                self.n_bytes -= old[0]
+            now = time.time()
+            self.touches.pop(key, None)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access, created) VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, now))
+            self.n_entries += 1
+            self.n_bytes += len(blob)
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        """ drop least recently used entries until within bounds. Caller holds the lock """
+        self._flush_touches() # so recently read entries are not evicted as if they were unused
+        while self.n_entries > self.max_entries or self.n_bytes > self.max_bytes:
+            n_to_drop = max(1, self.n_entries - self.max_entries, self.n_entries // 100) # evict in batches
+            rows = self.connection.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT ?", (n_to_drop,)).fetchall()
+            if not rows:
+                break
+            self.connection.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key, _ in rows])
+            self.n_entries -= len(rows)
+            self.n_bytes -= sum(size for _, size in rows)
+            self.evictions += len(rows)
+
+    def clear(self):
+        with self.lock:
+            self.touches = {}
+            self.connection.execute("DELETE FROM responses")
+            self.connection.commit()
+            self.n_entries, self.n_bytes = 0, 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": self.n_entries,
+            "bytes": self.n_bytes,
+        }
+
+    def close(self):
+        with self.lock:
+            self._flush_touches()
+            self.connection.commit()
+            self.connection.close()
+
+
+class TieredResponseCache():
+    """
+    Bounded in-memory LRU tier in front of an optional ResponseCache on disk.
+    Disk hits are promoted to memory, keeping the time they were stored on disk. Both tiers honour ttl_seconds.
+    """
+    def __init__(self, memory_entries = 1024, disk_cache = None, ttl_seconds = None):
+        self.memory_entries = memory_entries
+        self.disk_cache = disk_cache
+        self.ttl_seconds = ttl_seconds
+        self.memory = OrderedDict() # key -> (created, value)
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and self.ttl_seconds is not None and time.time() - entry[0] > self.ttl_seconds:
+                del self.memory[key]
+                entry = None
+            if entry is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+
+        value, created = self.disk_cache.get_with_created(key) if self.disk_cache is not None else (None, None)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._set_memory(key, value, created) # a promotion does not restart the ttl
+        return value
+
+    def set(self, key, value):
+        self._set_memory(key, value)
+        if self.disk_cache is not None:
+            self.disk_cache.set(key, value)
+
+    def _set_memory(self, key, value, created = None):
+        if self.memory_entries <= 0:
+            return
+        with self.lock:
+            self.memory[key] = (time.time() if created is None else created, value)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        stats = {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+        }
+        if self.disk_cache is not None:
+            stats["disk"] = self.disk_cache.stats()
+        return stats
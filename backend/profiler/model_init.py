@@ -1,12 +1,12 @@
 from transformers import AutoModelForCausalLM, AutoTokenizer
 import outlines
 
-def initialize_llm(deterministic=False):
+def initialize_llm(deterministic=False, device="cuda:0"):
     model_id = "hugging-quants/Meta-Llama-3.1-8B-Instruct-GPTQ-INT4"
     tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
     
     model_kwargs = {
-        "device_map": "cuda:0",
+        "device_map": device,
         "torch_dtype": "auto",
         "trust_remote_code": True
     }
@@ -18,7 +18,7 @@ def initialize_llm(deterministic=False):
             exllama_config.max_input_len = 4096
             model_kwargs["exllama_config"] = exllama_config
         except ImportError:
-            model_kwargs["max_memory"] = {0: "24GB"}
+            model_kwargs["max_memory"] = {int(device.split(":")[1]) if device.startswith("cuda:") else device: "24GB"}
     
     model = AutoModelForCausalLM.from_pretrained(
         model_id,
@@ -0,0 +1,169 @@
+""" Durable record of a corpus run, so a crashed or interrupted run can be resumed.
+
+One sqlite file holds, per paper, the status of every stage (extract, graph_write) with timings, attempts and the last error,
+and the extraction result (form, evidence, reasoning). A paper whose extraction is done never needs the llm again:
+a failed graph write is retried from the stored result.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+EXTRACT = "extract"
+GRAPH_WRITE = "graph_write"
+STAGES = (EXTRACT, GRAPH_WRITE)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class RunLedger():
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS stages ("
+            "paper_id TEXT NOT NULL, stage TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "seconds REAL, error TEXT, updated REAL NOT NULL, PRIMARY KEY (paper_id, stage))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS papers ("
+            "paper_id TEXT PRIMARY KEY, paper_path TEXT, form TEXT, evidence TEXT, reasoning TEXT, timings TEXT, field_fingerprints TEXT, "
+            "updated REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS stages_status ON stages (stage, status)")
+        self.connection.commit()
+
+    def register(self, paper_id, paper_path):
+        """ adds the paper with all stages pending, no-op if already known """
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO papers (paper_id, paper_path, updated) VALUES (?, ?, ?)", (paper_id, paper_path, now))
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO stages (paper_id, stage, status, updated) VALUES (?, ?, ?, ?)",
+                [(paper_id, stage, PENDING, now) for stage in STAGES])
+            self.connection.commit()
+
+    def status(self, paper_id, stage):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status FROM stages WHERE paper_id = ? AND stage = ?", (paper_id, stage)).fetchone()
+        return row[0] if row else None
+
+    def attempts(self, paper_id, stage):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT attempts FROM stages WHERE paper_id = ? AND stage = ?", (paper_id, stage)).fetchone()
+        return row[0] if row else 0
+
+    def is_done(self, paper_id, stage = None):
+        """ whether stage (or every stage, if None) finished for the paper """
+        stages = STAGES if stage is None else (stage,)
+        return all(self.status(paper_id, s) == DONE for s in stages)
+
+    def reset(self, paper_id, stages = STAGES):
+        """ back to pending with no attempts, e.g. when the paper has to be extracted again after a schema change """
+        with self.lock:
+            self.connection.executemany(
+                "UPDATE stages SET status = ?, attempts = 0, error = NULL, updated = ? WHERE paper_id = ? AND stage = ?",
+                [(PENDING, time.time(), paper_id, stage) for stage in stages])
+            self.connection.commit()
+
+    def start(self, paper_id, stage):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE stages SET status = ?, attempts = attempts + 1, error = NULL, updated = ? WHERE paper_id = ? AND stage = ?",
+                (RUNNING, time.time(), paper_id, stage))
+            self.connection.commit()
+
+    def finish(self, paper_id, stage, seconds = None):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE stages SET status = ?, seconds = ?, updated = ? WHERE paper_id = ? AND stage = ?",
+                (DONE, seconds, time.time(), paper_id, stage))
+            self.connection.commit()
+
+    def fail(self, paper_id, stage, error, seconds = None):
+        """ error: an exception (stored with traceback) or a message """
+        if isinstance(error, BaseException):
+            error = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+        with self.lock:
+            self.connection.execute(
+                "UPDATE stages SET status = ?, seconds = ?, error = ?, updated = ? WHERE paper_id = ? AND stage = ?",
+                (FAILED, seconds, str(error), time.time(), paper_id, stage))
+            self.connection.commit()
+
+    def save_extraction(self, paper_id, form_dict, evidence, reasoning, timings = None, field_fingerprints = None):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE papers SET form = ?, evidence = ?, reasoning = ?, timings = ?, field_fingerprints = ?, updated = ? WHERE paper_id = ?",
+                (json.dumps(form_dict, default=str), json.dumps(evidence, default=str), json.dumps(reasoning, default=str),
+                 json.dumps(timings or {}), json.dumps(field_fingerprints or {}), time.time(), paper_id))
+            self.connection.commit()
+
+    def load_extraction(self, paper_id):
+        """ (form_dict, evidence, reasoning) of a finished extraction, or None """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT form, evidence, reasoning FROM papers WHERE paper_id = ?", (paper_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return tuple(json.loads(value) for value in row)
+
+    def load_record(self, paper_id):
+        """ the stored extraction as a dict like the extraction store's records (form, evidence, reasoning, field_fingerprints), or None """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT form, evidence, reasoning, field_fingerprints FROM papers WHERE paper_id = ?", (paper_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        form, evidence, reasoning, fingerprints = row
+        return {"paper_id": paper_id, "form": json.loads(form), "evidence": json.loads(evidence),
+                "reasoning": json.loads(reasoning), "field_fingerprints": json.loads(fingerprints or "{}")}
+
+    def papers_with_status(self, stage, status):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT p.paper_id, p.paper_path FROM stages s JOIN papers p ON p.paper_id = s.paper_id "
+                "WHERE s.stage = ? AND s.status = ? ORDER BY p.paper_id", (stage, status)).fetchall()
+        return rows
+
+    def reset_interrupted(self):
+        """ stages left running by a crashed run count as failed, so they are retried. Call once at startup """
+        with self.lock:
+            n = self.connection.execute(
+                "UPDATE stages SET status = ?, error = ?, updated = ? WHERE status = ?",
+                (FAILED, "interrupted", time.time(), RUNNING)).rowcount
+            self.connection.commit()
+        return n
+
+    def errors(self, stage = None):
+        query = "SELECT paper_id, stage, attempts, error FROM stages WHERE status = ?"
+        params = (FAILED,)
+        if stage is not None:
+            query += " AND stage = ?"
+            params += (stage,)
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def summary(self):
+        """ {stage: {status: count}} """
+        with self.lock:
+            rows = self.connection.execute("SELECT stage, status, COUNT(*) FROM stages GROUP BY stage, status").fetchall()
+        summary = {stage : {} for stage in STAGES}
+        for stage, status, count in rows:
+            summary.setdefault(stage, {})[status] = count
+        return summary
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,79 @@
+""" Switch for weave tracing, read once at import time from KNOWDISEASE_TRACING:
+
+    on        every op is traced (default, same as decorating with weave.op directly)
+    off       ops are the plain functions and weave is never imported, so tracing costs nothing
+    sample:N  only ops called inside every N'th paper_scope() are traced (e.g. sample:100 traces 1 in 100 papers)
+
+Use tracing.op instead of weave.op, and tracing.Model instead of weave.Model.
+"""
+import contextlib
+import contextvars
+import functools
+import itertools
+import os
+
+import pydantic
+
+
+def _parse_mode(value):
+    value = value.strip().lower()
+    if value in ("on", "1", "true", ""):
+        return "on", 1
+    if value in ("off", "0", "false"):
+        return "off", 1
+    if value.startswith("sample:"):
+        every = int(value.split(":", 1)[1])
+        if every < 1:
+            raise ValueError(f"KNOWDISEASE_TRACING sample rate must be >= 1, got {value}")
+        return "sample", every
+    raise ValueError(f"KNOWDISEASE_TRACING must be on, off or sample:N, got {value}")
+
+
+MODE, SAMPLE_EVERY = _parse_mode(os.environ.get("KNOWDISEASE_TRACING", "on"))
+
+if MODE != "off":
+    import weave
+
+# whether ops called in the current paper are traced (sample mode). Outside any paper_scope everything is traced.
+_trace_current = contextvars.ContextVar("knowdisease_trace_current", default=True)
+_paper_counter = itertools.count()
+
+
+@contextlib.contextmanager
+def paper_scope():
+    """ marks the processing of one paper, so sample mode can trace 1 in SAMPLE_EVERY papers """
+    if MODE != "sample":
+        yield True
+        return
+    traced = next(_paper_counter) % SAMPLE_EVERY == 0
+    token = _trace_current.set(traced)
+    try:
+        yield traced
+    finally:
+        _trace_current.reset(token)
+
+
+def op(fn = None, **op_kwargs):
+    """ drop-in for weave.op, usable both as @op and @op() """
+    if fn is None:
+        return lambda f: op(f, **op_kwargs)
+    if MODE == "off":
+        return fn
+    traced = weave.op(fn, **op_kwargs)
+    if MODE == "on":
+        return traced
+
+    @functools.wraps(fn)
+    def sampled(*args, **kwargs):
+        if _trace_current.get():
+            return traced(*args, **kwargs)
+        return fn(*args, **kwargs)
+    return sampled
+
+
+class _UntracedModel(pydantic.BaseModel):
+    """ stands in for weave.Model when tracing is off """
+    model_config = pydantic.ConfigDict(arbitrary_types_allowed=True, protected_namespaces=())
+
+
+Model = _UntracedModel if MODE == "off" else weave.Model
@@ -0,0 +1,74 @@
+""" Context packing into a per-field token budget, on the fixture papers with the hashing embedder: context tokens per
+field before and after packing, chunks dropped or cut, prefill tokens saved, and the time packing adds to retrieval.
+Tokens are counted with --tokenizer (a hugging face tokenizer id, e.g. the llm's) or a word/punctuation stand-in.
+
+    python -m benchmarks.context_packing --budgets 256 512 1024 --repeat 3 [--tokenizer hugging-quants/Meta-Llama-3.1-8B-Instruct-GPTQ-INT4]
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import time
+
+from backend.data.xml_loader import load_xml
+from backend.profiler.context_shortening.context_packing import ContextPacker
+from backend.profiler.metadata_schemas.disease_theory_schema_optimal import DiseaseTheorySchema
+
+from .fakes import FakeTokenizer, make_fake_retriever
+from .pipeline_benchmark import FIXTURES
+
+
+def retrieve_all(retriever, documents, repeat):
+    """ seconds per field query, context per (document, field) of the last pass """
+    fieldnames = list(DiseaseTheorySchema.model_fields)
+    timings = []
+    contexts = {}
+    for _ in range(repeat):
+        for i, document in enumerate(documents):
+            retriever.set_document(document)
+            for fieldname in fieldnames:
+                start = time.perf_counter()
+                contexts[i, fieldname] = retriever(answer_field_name = fieldname)[0]
+                timings.append(time.perf_counter() - start)
+    return timings, contexts
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--fixtures", default=FIXTURES)
+    ap.add_argument("--budgets", nargs="+", type=int, default=[256, 512, 1024])
+    ap.add_argument("--tokenizer", default=None, help="hugging face tokenizer id, instead of the word/punctuation stand-in")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    else:
+        tokenizer = FakeTokenizer()
+    documents = [load_xml(path) for path in sorted(glob.glob(os.path.join(args.fixtures, "*.xml")))]
+    retriever = make_fake_retriever()
+
+    timings, unpacked = retrieve_all(retriever, documents, args.repeat)
+    report = {"unpacked": {"retrieval_ms": 1000 * statistics.mean(timings)}}
+    for budget in args.budgets:
+        retriever.context_packer = ContextPacker(tokenizer, budget)
+        timings, packed = retrieve_all(retriever, documents, args.repeat)
+        stats = retriever.context_packer.stats
+        report[f"budget={budget}"] = {
+            "retrieval_ms": 1000 * statistics.mean(timings),
+            "tokens_per_field_before": stats["tokens_before"] / stats["fields"],
+            "tokens_per_field_after": stats["tokens_after"] / stats["fields"],
+            "max_tokens_after": max(len(tokenizer.encode(context, add_special_tokens=False)) for context in packed.values()),
+            "prefill_tokens_saved_per_pass": retriever.context_packer.tokens_saved() / args.repeat,
+            "chunks_dropped": stats["chunks_dropped"],
+            "chunks_cut": stats["chunks_cut"],
+            "fields_unchanged": sum(packed[key] == unpacked[key] for key in packed) / len(packed),
+        }
+    retriever.context_packer = None
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
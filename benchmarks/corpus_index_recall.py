@@ -0,0 +1,121 @@
+""" Recall and latency of the corpus-level ann index against exact (brute force) search.
+
+Builds a CorpusIndex per backend over synthetic clustered embeddings (chunks of --papers papers, like sentence embeddings
+of topically related text), then compares the top --k of every query with the exact top k.
+Also times incremental adds after reopening, and searches filtered to a subset of papers.
+
+    python -m benchmarks.corpus_index_recall --chunks 100000 --dim 384 --queries 200 --ef 32 64 128 256
+"""
+import argparse
+import json
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from backend.profiler.context_shortening import corpus_index as corpus_index_module
+from backend.profiler.context_shortening.corpus_index import CorpusIndex
+
+from .pipeline_benchmark import percentile
+
+
+def make_embeddings(n, dim, n_clusters, rng):
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    assignment = rng.integers(0, n_clusters, n)
+    return centers[assignment] + 0.8 * rng.standard_normal((n, dim)).astype(np.float32), centers
+
+
+def fill(index, embeddings, chunks_per_paper, start = 0):
+    for paper_start in range(start, start + len(embeddings), chunks_per_paper):
+        rows = embeddings[paper_start - start : paper_start - start + chunks_per_paper]
+        index.add(f"paper{paper_start // chunks_per_paper}", rows, texts = [""] * len(rows), sections = ["results"] * len(rows))
+
+
+def timed_searches(index, queries, k, **kwargs):
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        hits = index.search(query, k = k, **kwargs)
+        latencies.append(time.perf_counter() - start)
+        results.append([(hit["paper_id"], hit["text"], round(hit["score"], 4)) for hit in hits])
+    return results, latencies
+
+
+def recall(results, truth):
+    """ share of the exact top k found, compared by score (ties between identical chunks count either way) """
+    found = []
+    for result, exact in zip(results, truth):
+        kth_score = exact[-1][2] if exact else 0
+        found.append(sum(1 for hit in result if hit[2] >= kth_score - 1e-4) / max(len(exact), 1))
+    return statistics.mean(found)
+
+
+def latency_summary(latencies):
+    return {"p50_ms": 1000 * percentile(latencies, 50), "p95_ms": 1000 * percentile(latencies, 95)}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chunks", type=int, default=100_000)
+    ap.add_argument("--dim", type=int, default=384)
+    ap.add_argument("--chunks-per-paper", type=int, default=25)
+    ap.add_argument("--clusters", type=int, default=200)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--ef", type=int, nargs="+", default=[32, 64, 128, 256])
+    ap.add_argument("--filter-papers", type=float, default=0.1, help="share of papers in filtered searches")
+    ap.add_argument("--output", default=None)
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(0)
+    embeddings, centers = make_embeddings(args.chunks, args.dim, args.clusters, rng)
+    queries = centers[rng.integers(0, args.clusters, args.queries)] + 0.8 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    n_papers = -(-args.chunks // args.chunks_per_paper)
+    filter_papers = [f"paper{i}" for i in rng.choice(n_papers, max(1, int(args.filter_papers * n_papers)), replace=False)]
+
+    backends = [backend for backend, module in (("hnswlib", corpus_index_module.hnswlib), ("faiss", corpus_index_module.faiss)) if module is not None]
+    report = {"chunks": args.chunks, "dim": args.dim, "k": args.k, "queries": args.queries, "backends": {}}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        exact_index = CorpusIndex(f"{tmp}/exact", dim = args.dim, backend = "exact")
+        start = time.perf_counter()
+        fill(exact_index, embeddings, args.chunks_per_paper)
+        report["exact_build_seconds"] = time.perf_counter() - start
+        truth, exact_latencies = timed_searches(exact_index, queries, args.k)
+        truth_filtered, exact_filtered_latencies = timed_searches(exact_index, queries, args.k, paper_ids = filter_papers)
+        report["exact"] = latency_summary(exact_latencies)
+        report["exact_filtered"] = latency_summary(exact_filtered_latencies)
+
+        for backend in backends:
+            half = (args.chunks // 2) // args.chunks_per_paper * args.chunks_per_paper
+            index = CorpusIndex(f"{tmp}/{backend}", dim = args.dim, backend = backend, exact_threshold = 0) # always ann
+            start = time.perf_counter()
+            fill(index, embeddings[:half], args.chunks_per_paper)
+            index.save()
+            index.close()
+            index = CorpusIndex(f"{tmp}/{backend}", backend = backend, exact_threshold = 0)
+            reopen_seconds = time.perf_counter() - start
+            fill(index, embeddings[half:], args.chunks_per_paper, start = half) # incremental adds after reopening
+            build_seconds = time.perf_counter() - start
+
+            runs = {}
+            for ef in args.ef:
+                index.ef_search = ef
+                results, latencies = timed_searches(index, queries, args.k)
+                filtered, filtered_latencies = timed_searches(index, queries, args.k, paper_ids = filter_papers)
+                runs[ef] = {
+                    f"recall@{args.k}": recall(results, truth), **latency_summary(latencies),
+                    f"filtered_recall@{args.k}": recall(filtered, truth_filtered),
+                    "filtered": latency_summary(filtered_latencies),
+                }
+            report["backends"][backend] = {"build_seconds": build_seconds, "half_build_and_reopen_seconds": reopen_seconds, "ef_search": runs}
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+""" Throughput of corpus_runner with 1, 2, 4, ... worker processes, on CPU with the fake models of benchmarks/fakes.py.
+
+The fixtures are copied under --papers distinct paper ids. --fake-generation-ms simulates llm time per field
+(a sleep, like a gpu bound worker waiting on its device), so the speedup shows how well scheduling and aggregation scale.
+
+    python -m benchmarks.corpus_scaling --workers 1 2 4 --papers 48 --fake-generation-ms 20
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import tempfile
+
+from backend.corpus_runner import run_corpus
+
+from .fakes import FakeWorkerFactory, make_recording_graph_builder
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def make_corpus(directory, n_papers, fixtures = FIXTURES):
+    fixture_paths = sorted(glob.glob(os.path.join(fixtures, "*.xml")))
+    paper_paths = []
+    for i in range(n_papers):
+        paper_path = os.path.join(directory, f"{20000000 + i}_ascii_pmcoa.xml")
+        shutil.copy(fixture_paths[i % len(fixture_paths)], paper_path)
+        paper_paths.append(paper_path)
+    return paper_paths
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--papers", type=int, default=48)
+    ap.add_argument("--fake-generation-ms", type=float, default=20.0, help="simulated generation time per field")
+    ap.add_argument("--fail", nargs="*", default=[], help="paper ids whose extraction always fails")
+    ap.add_argument("--output", default=None)
+    args = ap.parse_args()
+
+    report = {"papers": args.papers, "fake_generation_ms": args.fake_generation_ms, "runs": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        paper_paths = make_corpus(tmp, args.papers)
+        for n_workers in args.workers:
+            run_dir = os.path.join(tmp, f"run_{n_workers}")
+            summary = run_corpus(
+                paper_paths,
+                FakeWorkerFactory(args.fake_generation_ms / 1000, fail_paper_ids = args.fail),
+                make_recording_graph_builder,
+                devices = [("cpu", "cpu")] * n_workers,
+                ledger_path = os.path.join(run_dir, "ledger.sqlite"),
+                results_store_path = os.path.join(run_dir, "results"),
+                verbose = False,
+            )
+            report["runs"][n_workers] = summary
+
+    baseline = report["runs"].get(min(args.workers))
+    for n_workers, summary in report["runs"].items():
+        # without worker startup, which is a one-off cost per run
+        if baseline["processing_papers_per_second"] == 0:
+            # nothing extracted in the baseline run (all failed), the summaries show why
+            summary["speedup"] = summary["scaling_efficiency"] = None
+            continue
+        speedup = summary["processing_papers_per_second"] / baseline["processing_papers_per_second"]
+        summary["speedup"] = speedup
+        summary["scaling_efficiency"] = speedup * min(args.workers) / n_workers
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+""" Compare sequential (one generation per field) and whole form (one generation per paper) extraction on the local llm.
+
+Run from the repository root:
+    python -m benchmarks.extraction_modes path/to/xml_folder --gold gold.json --output modes.json
+
+gold.json (optional) maps paper id to a form dict, e.g. {"12345": {"disease_name": "cystic fibrosis", ...}}.
+Without gold answers, the agreement between the two modes is reported instead of accuracy.
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import time
+
+from backend.pipeline import DiseaseTheoryPipeline
+from backend.graph_builder import normalize_and_split_values
+from backend.profiler.form_filling.form_filling import WholeFormFiller
+from backend.profiler.metadata_schemas.cot_schema import CoTModelSchema
+from backend.profiler.metadata_schemas.disease_theory_schema_optimal import DiseaseTheorySchema
+
+# the graph is never written here, so no database is needed
+DUMMY_NEO4J_CONFIG = {"uri": "bolt://localhost:7687", "user": "neo4j", "password": "neo4j"}
+
+
+def to_terms(value):
+    """ same normalization as the graph builder, so scores reflect what ends up in the graph """
+    return set(normalize_and_split_values(value))
+
+
+def term_f1(predicted, expected):
+    predicted, expected = to_terms(predicted), to_terms(expected)
+    if not predicted and not expected:
+        return 1.0
+    if not predicted or not expected:
+        return 0.0
+    overlap = len(predicted & expected)
+    if overlap == 0:
+        return 0.0
+    precision, recall = overlap / len(predicted), overlap / len(expected)
+    return 2 * precision * recall / (precision + recall)
+
+
+def mean_f1(forms, references):
+    scores = [term_f1(forms[paper_id][field], references[paper_id].get(field))
+              for paper_id in forms if paper_id in references
+              for field in forms[paper_id]]
+    return statistics.mean(scores) if scores else None
+
+
+def run_mode(pipeline, paper_paths):
+    latencies = []
+    forms = {}
+    for paper_path in paper_paths:
+        start = time.perf_counter()
+        result, paper_id = pipeline.process_document(paper_path)
+        latencies.append(time.perf_counter() - start)
+        forms[paper_id] = result.model_dump()
+    return forms, latencies
+
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    return {
+        "papers": len(ordered),
+        "mean_seconds": statistics.mean(ordered),
+        "p50_seconds": ordered[len(ordered) // 2],
+        "p95_seconds": ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+        "papers_per_second": len(ordered) / sum(ordered) if sum(ordered) else None,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("xml_folder")
+    ap.add_argument("--gold", help="json file with reference forms per paper id")
+    ap.add_argument("--max-papers", type=int, default=None)
+    ap.add_argument("--output", default=None, help="write the report as json to this path")
+    args = ap.parse_args()
+
+    paper_paths = sorted(glob.glob(os.path.join(args.xml_folder, "*.xml")))[:args.max_papers]
+    gold = json.load(open(args.gold)) if args.gold else None
+
+    pipeline = DiseaseTheoryPipeline(DUMMY_NEO4J_CONFIG, use_cot=True)
+    sequential_form_filler = pipeline.form_filler
+    sequential_forms, sequential_latencies = run_mode(pipeline, paper_paths)
+
+    # share the loaded llm, only the form filler differs
+    pipeline.form_filler = WholeFormFiller(
+        outlines_llm = sequential_form_filler.llm_model,
+        outlines_sampler = sequential_form_filler.sampler,
+        cot_schema = CoTModelSchema,
+        pydantic_form = DiseaseTheorySchema,
+    )
+    whole_forms, whole_latencies = run_mode(pipeline, paper_paths)
+
+    report = {
+        "sequential": summarize(sequential_latencies),
+        "whole_form": summarize(whole_latencies),
+    }
+    if gold:
+        report["sequential"]["mean_term_f1"] = mean_f1(sequential_forms, gold)
+        report["whole_form"]["mean_term_f1"] = mean_f1(whole_forms, gold)
+    else:
+        report["agreement_term_f1"] = mean_f1(whole_forms, sequential_forms)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+""" Deterministic CPU stand-ins for the heavy parts of the pipeline (embedding model, llm generation, neo4j), for benchmarks. """
+import json
+import re
+import time
+import zlib
+
+import numpy as np
+from dsp.modules.lm import LM
+
+from backend.graph_builder import GraphBuilder
+from backend.profiler.form_filling.form_filling import SequentialFormFiller
+
+
+class HashingEmbedder():
+    """ bag of hashed words and word bigrams, l2 normalized. Same encode interface as a SentenceTransformer """
+    def __init__(self, dim = 384):
+        self.dim = dim
+
+    def encode(self, sentences, **kwargs):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        embeddings = np.zeros((len(sentences), self.dim), dtype=np.float32)
+        for i, sentence in enumerate(sentences):
+            words = re.findall(r"\w+", sentence.lower())
+            for token in words + [a + " " + b for a, b in zip(words, words[1:])]:
+                embeddings[i, zlib.crc32(token.encode("utf-8")) % self.dim] += 1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.where(norms == 0, 1.0, norms)
+        return embeddings[0] if single else embeddings
+
+
+class FakeTokenizer():
+    """ words and punctuation (with their leading whitespace) as tokens, roughly the counts of an llm tokenizer on english.
+    encode gives the token strings, so decode is a join """
+    TOKEN = re.compile(r"\s*(?:\w+|[^\w\s])|\s+$")
+
+    def encode(self, text, add_special_tokens = False):
+        return self.TOKEN.findall(text)
+
+    def decode(self, ids):
+        return "".join(ids)
+
+
+def fake_cot_generator(generation_seconds = 0.0):
+    """ answer generator with the same call signature as make_dspy_generator's predict.
+    Answers with the longest capitalized or all-caps words of the context, quoting the sentence they appear in. """
+    def predict(dspy_predictor, **prompt_input):
+        if generation_seconds:
+            time.sleep(generation_seconds)
+        context = prompt_input["context"] or ""
+        sentences = re.split(r"(?<=[.!?])\s+", context)
+        evidence = {}
+        for sentence in sentences:
+            for word in re.findall(r"\b[A-Z][A-Za-z0-9-]{3,}\b", sentence):
+                if len(evidence) < 3 and word not in evidence:
+                    evidence[word] = sentence
+        return json.dumps({
+            "reasoning": f"Deterministic fake answer for {prompt_input['answer_field_name']}.",
+            "evidence": evidence,
+            "final_answer": list(evidence),
+        })
+    return predict
+
+
+class FakeDspLM(LM):
+    """ dsp language model answering instantly with answer(prompt, **kwargs), for measuring everything around generation """
+    def __init__(self, answer):
+        super().__init__("fake")
+        self.answer = answer
+
+    def basic_request(self, prompt, **kwargs):
+        return [self.answer(prompt, **kwargs)]
+
+    def __call__(self, prompt, only_completed=True, return_sorted=False, **kwargs):
+        return self.basic_request(prompt, **kwargs)
+
+
+class FakeGeneratorFormFiller(SequentialFormFiller):
+    """ SequentialFormFiller with the outlines generators replaced by fake_cot_generator (CoT mode), no llm needed """
+    def __init__(self, pydantic_form, cot_schema, generation_seconds = 0.0, **kwargs):
+        self.generator = fake_cot_generator(generation_seconds)
+        super().__init__(outlines_llm = None, outlines_sampler = None, pydantic_form = pydantic_form,
+                         use_cot = True, use_json_constraints = True, cot_schema = cot_schema, **kwargs)
+
+    def set_pydantic_form(self, pydantic_form):
+        self.pydantic_form = pydantic_form
+        self.dspy_generators = {self.get_generator_key(field) : self.generator for field in pydantic_form.model_fields.values()}
+        self.prepare_field_plan()
+        self.prepare_field_fillers()
+
+
+class RecordingSession():
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def run(self, query, **parameters):
+        self.driver.queries.append((query, parameters))
+
+
+class RecordingDriver():
+    """ stand-in for a neo4j driver, keeps every query instead of writing it """
+    def __init__(self):
+        self.queries = []
+
+    def session(self, **kwargs):
+        return RecordingSession(self)
+
+    def close(self):
+        pass
+
+
+def make_fake_retriever(embedding_model = None, relevance_threshold = 0.0, lexical_weight = 0.0):
+    """ Retrieval with the pipeline's settings (RETRIEVAL_SETTINGS), on the hashing embedder unless a sentence-transformers
+    model id is given. The relevance threshold defaults to 0, the hashing embedder's similarities are lower than real ones """
+    from backend.pipeline import RETRIEVAL_SETTINGS
+    from backend.profiler.context_shortening.context_shortening import Retrieval
+    settings = dict(RETRIEVAL_SETTINGS, embedding_model_id = embedding_model or "fake-hashing", relevance_threshold = relevance_threshold)
+    return Retrieval(
+        **settings,
+        emb_model = None if embedding_model else HashingEmbedder(),
+        lexical_weight = lexical_weight,
+    )
+
+
+class FakeWorkerFactory():
+    """ corpus_runner make_worker: a DiseaseTheoryPipeline on the fake retriever and generator.
+    Papers in fail_paper_ids raise on extraction, to exercise retries and failure accounting """
+    def __init__(self, generation_seconds = 0.0, fail_paper_ids = ()):
+        self.generation_seconds = generation_seconds
+        self.fail_paper_ids = set(fail_paper_ids)
+
+    def __call__(self, worker_id, devices):
+        from backend.pipeline import DiseaseTheoryPipeline, get_paper_id
+        from backend.profiler.metadata_schemas.cot_schema import CoTModelSchema
+        from backend.profiler.metadata_schemas.disease_theory_schema_optimal import DiseaseTheorySchema
+
+        pipeline = DiseaseTheoryPipeline(None, retriever = make_fake_retriever(),
+                                         form_filler = FakeGeneratorFormFiller(DiseaseTheorySchema, CoTModelSchema, self.generation_seconds))
+        if self.fail_paper_ids:
+            extract_record = pipeline.extract_record
+            def failing_extract_record(paper_path, **kwargs):
+                if get_paper_id(paper_path) in self.fail_paper_ids:
+                    raise RuntimeError(f"fake failure for {paper_path}")
+                return extract_record(paper_path, **kwargs)
+            pipeline.extract_record = failing_extract_record
+        return pipeline
+
+
+def make_recording_graph_builder():
+    """ corpus_runner make_graph_builder writing to a RecordingDriver """
+    return GraphBuilder(None, driver = RecordingDriver())
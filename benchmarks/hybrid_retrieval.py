@@ -0,0 +1,54 @@
+""" Latency overhead of hybrid (bm25 + dense) retrieval: runs pipeline_benchmark with dense only retrieval and with every
+--lexical-weights value, and compares the embedding stage (which builds the bm25 index) and the retrieval stage.
+Weights are run interleaved for --rounds rounds and the fastest run per weight is kept.
+
+    python -m benchmarks.hybrid_retrieval --lexical-weights 0.5 1.0 --repeat 5 [--embedding-model pritamdeka/S-PubMedBert-MS-MARCO]
+"""
+import argparse
+import json
+
+from . import pipeline_benchmark
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--lexical-weights", nargs="+", type=float, default=[1.0])
+    ap.add_argument("--fixtures", default=pipeline_benchmark.FIXTURES)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--rounds", type=int, default=3)
+    ap.add_argument("--embedding-model", default=None)
+    ap.add_argument("--relevance-threshold", type=float, default=0.0)
+    ap.add_argument("--output", default=None)
+    args = ap.parse_args()
+
+    weights = [0.0] + [weight for weight in args.lexical_weights if weight != 0.0]
+    reports = {}
+    for _ in range(args.rounds):
+        for weight in weights:
+            benchmark_args = argparse.Namespace(fixtures=args.fixtures, repeat=args.repeat, embedding_model=args.embedding_model,
+                                                fake_generation_ms=0.0, relevance_threshold=args.relevance_threshold,
+                                                lexical_weight=weight, weave_project=None)
+            report = pipeline_benchmark.run(benchmark_args)
+            if weight not in reports or report["papers_per_second"] > reports[weight]["papers_per_second"]:
+                reports[weight] = report
+
+    baseline = reports[0.0]["stages"]
+    summary = {}
+    for weight, report in reports.items():
+        stages = report["stages"]
+        summary[f"lexical_weight={weight}"] = {
+            "embedding_p50_ms": stages["embedding"]["p50_ms"],
+            "retrieval_p50_ms": stages["retrieval"]["p50_ms"],
+            "overhead_ms_per_paper": (stages["embedding"]["mean_ms"] + stages["retrieval"]["mean_ms"]
+                                      - baseline["embedding"]["mean_ms"] - baseline["retrieval"]["mean_ms"]),
+            "papers_per_second": report["papers_per_second"],
+        }
+
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+""" DirectKeywordSimilarityFiller scoring against thousands of ontology targets: the batched implementation against the
+previous per-chunk one (kept below as reference), on the fixture papers with the hashing embedder and keybert keywords.
+Checks that both pick the same answers.
+
+    python -m benchmarks.keyword_similarity --targets 5000 --repeat 5
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import time
+import typing
+
+import numpy as np
+import pydantic
+import torch
+
+from backend.data.xml_loader import load_xml
+from backend.profiler.context_shortening.context_shortening import Retrieval
+from backend.profiler.form_filling.form_filling import DirectKeywordSimilarityFiller
+
+from .fakes import HashingEmbedder
+from .pipeline_benchmark import FIXTURES
+
+
+def reference_best_answer(filler, context_shortener, fieldname, field_type):
+    """ the per-chunk implementation before batching """
+    target_keywords = [t.lower() for t in context_shortener.descriptions[fieldname]]
+    if getattr(field_type, "__origin__", None) is typing.Literal:
+        allowed_indices = [i for i, kw in enumerate(target_keywords) if kw in field_type.__args__]
+    else:
+        allowed_indices = list(range(len(target_keywords)))
+    prepared = []
+    for similarity, kw_scores in context_shortener.get_similarity_matrices(fieldname):
+        similarity = similarity[:, allowed_indices].clip(min=0)
+        prepared.append(torch.matmul(similarity.T, torch.Tensor(kw_scores)))
+    prepared = np.array([sim.numpy() for sim in prepared])
+    best = np.argmax(np.linalg.norm(prepared, ord=filler.order, axis=0))
+    return target_keywords[allowed_indices[best]]
+
+
+def make_form(targets, n_allowed):
+    allowed = tuple(random.Random(0).sample(targets, n_allowed))
+    return pydantic.create_model("OntologyForm",
+                                 ontology_term=(str, pydantic.Field(description="any ontology term")),
+                                 allowed_term=(typing.Literal[allowed], pydantic.Field(description="one of the allowed terms")))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--fixtures", default=FIXTURES)
+    ap.add_argument("--targets", type=int, default=5000, help="ontology targets per field")
+    ap.add_argument("--allowed", type=int, default=500, help="allowed answers of the Literal field")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    documents = [load_xml(path) for path in sorted(glob.glob(os.path.join(args.fixtures, "*.xml")))]
+    vocabulary = sorted({word.lower() for document in documents for word in document.split() if word.isalpha()})
+    rng = random.Random(1)
+    targets = [" ".join(rng.sample(vocabulary, 2)) for _ in range(args.targets)]
+    form = make_form(targets, args.allowed)
+
+    embedder = HashingEmbedder()
+    retriever = Retrieval(chunk_info_to_compare="keybert", field_info_to_compare="description", include_choice_every=1,
+                          embedding_model_id="fake-hashing", n_keywords=13, top_k=5, chunk_size=1200, chunk_overlap=256,
+                          emb_model=embedder)
+    target_embeddings = embedder.encode(targets)
+    retriever.descriptions = {fieldname : targets for fieldname in form.model_fields}
+    retriever.target_emb = {fieldname : target_embeddings for fieldname in form.model_fields}
+    filler = DirectKeywordSimilarityFiller(pydantic_form=form)
+
+    timings = {"reference": [], "batched": []}
+    same = True
+    for _ in range(args.repeat):
+        for document in documents:
+            retriever.set_document(document)
+            for fieldname, field in form.model_fields.items():
+                start = time.perf_counter()
+                expected = reference_best_answer(filler, retriever, fieldname, field.annotation)
+                timings["reference"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                answer = filler.get_best_answer_for_field(retriever, fieldname, field.annotation)
+                timings["batched"].append(time.perf_counter() - start)
+                same = same and answer == expected
+
+    report = {name : {"mean_ms": 1000 * float(np.mean(values)), "p50_ms": 1000 * float(np.median(values))} for name, values in timings.items()}
+    report["speedup"] = report["reference"]["mean_ms"] / report["batched"]["mean_ms"]
+    report["same_answers"] = same
+    report["targets"] = args.targets
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+""" Minimal Ollama embedding server (/api/embed and the older /api/embeddings), for exercising the ollama embeddings
+without an Ollama install. Vectors are deterministic hashes of the text. Counts requests and embedded texts.
+
+    python -m benchmarks.mock_ollama_server --port 11434 --latency 0.05
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .fakes import HashingEmbedder
+
+
+class MockOllamaServer(ThreadingHTTPServer):
+    def __init__(self, port = 0, latency = 0.0, dim = 64):
+        super().__init__(("127.0.0.1", port), MockOllamaHandler)
+        self.latency = latency
+        self.embedder = HashingEmbedder(dim = dim)
+        self.n_requests = 0
+        self.n_texts = 0
+        self.max_in_flight = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        """ serve from a daemon thread, returns the server """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def reset_counts(self):
+        with self.lock:
+            self.n_requests = 0
+            self.n_texts = 0
+            self.max_in_flight = 0
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        texts = request.get("input", request.get("prompt", ""))
+        texts = [texts] if isinstance(texts, str) else texts
+        with server.lock:
+            server.n_requests += 1
+            server.n_texts += len(texts)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency)
+            embeddings = server.embedder.encode(texts).tolist()
+            if self.path.rstrip("/") == "/api/embeddings":
+                self.send_json(200, {"embedding": embeddings[0]})
+            elif self.path.rstrip("/") == "/api/embed":
+                self.send_json(200, {"model": request.get("model", "mock"), "embeddings": embeddings})
+            else:
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=11434)
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    ap.add_argument("--dim", type=int, default=64)
+    args = ap.parse_args()
+    server = MockOllamaServer(args.port, args.latency, args.dim)
+    print(f"Serving on {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+""" Minimal openai compatible chat completions server, for exercising the openai form fillers without network access.
+
+Answers every /chat/completions request with a json object holding a placeholder value for each property of the requested json schema.
+latency simulates the round trip time, rate_limit_every makes every n'th request fail with 429 to exercise backoff.
+
+    python -m benchmarks.mock_openai_server --port 8765 --latency 0.5
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def placeholder_answer(request):
+    schema = request.get("response_format", {}).get("json_schema", {}).get("schema", {})
+    properties = schema.get("properties", {"answer": {}})
+    return {name : f"mock {name}" for name in properties}
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    def __init__(self, port = 0, latency = 0.0, rate_limit_every = 0):
+        super().__init__(("127.0.0.1", port), MockOpenAIHandler)
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.n_requests = 0
+        self.max_in_flight = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/"
+
+    def start(self):
+        """ serve from a daemon thread, returns the server """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with server.lock:
+            server.n_requests += 1
+            n_request = server.n_requests
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency)
+            if server.rate_limit_every and n_request % server.rate_limit_every == 0:
+                self.send_json(429, {"error": {"message": "rate limited", "type": "rate_limit_error", "code": "rate_limit_exceeded"}})
+                return
+            content = json.dumps(placeholder_answer(request))
+            self.send_json(200, {
+                "id": f"chatcmpl-mock-{n_request}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [{"index": 0, "finish_reason": "stop", "logprobs": None,
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency", type=float, default=0.0)
+    ap.add_argument("--rate-limit-every", type=int, default=0)
+    args = ap.parse_args()
+    server = MockOpenAIServer(args.port, args.latency, args.rate_limit_every)
+    print(f"mock openai server on {server.base_url}")
+    server.serve_forever()
@@ -0,0 +1,74 @@
+""" Requests and time for indexing the fixture papers with ollama embeddings, against the local mock ollama server:
+llama_index's OllamaEmbedding one text per request and with its default batches, then BatchedOllamaEmbedding
+without a cache, and twice with a sqlite cache (the second pass should not send any request).
+
+    python -m benchmarks.ollama_embedding_batching --latency 0.05 --batch-size 64 --max-concurrency 4
+"""
+import argparse
+import glob
+import json
+import os
+import tempfile
+import time
+
+from llama_index.core import VectorStoreIndex
+from llama_index.embeddings.ollama import OllamaEmbedding
+
+from backend.data.xml_loader import load_xml
+from backend.profiler.context_shortening.chunking import chunk_by_headers_and_clean
+from backend.profiler.context_shortening.ollama_embedding import BatchedOllamaEmbedding
+
+from .mock_ollama_server import MockOllamaServer
+from .pipeline_benchmark import FIXTURES
+
+
+def index_papers(documents, embedding, chunk_size):
+    for document in documents:
+        nodes = chunk_by_headers_and_clean(document, chunk_size=chunk_size, chunk_overlap=0, verbose=False)
+        VectorStoreIndex(nodes=nodes, embed_model=embedding)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--fixtures", default=FIXTURES)
+    ap.add_argument("--latency", type=float, default=0.05, help="simulated seconds per request")
+    ap.add_argument("--chunk-size", type=int, default=300)
+    ap.add_argument("--batch-size", type=int, default=64)
+    ap.add_argument("--max-concurrency", type=int, default=4)
+    args = ap.parse_args()
+
+    documents = [load_xml(path) for path in sorted(glob.glob(os.path.join(args.fixtures, "*.xml")))]
+    server = MockOllamaServer(latency=args.latency).start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, "embeddings.sqlite")
+        variants = [
+            ("ollama_one_per_request", lambda: OllamaEmbedding(model_name="mock-embed", base_url=server.base_url, embed_batch_size=1)),
+            ("ollama_default_batches", lambda: OllamaEmbedding(model_name="mock-embed", base_url=server.base_url)),
+            ("batched", lambda: BatchedOllamaEmbedding("mock-embed", base_url=server.base_url, batch_size=args.batch_size,
+                                                       max_concurrency=args.max_concurrency)),
+            ("batched_cache_cold", lambda: BatchedOllamaEmbedding("mock-embed", base_url=server.base_url, batch_size=args.batch_size,
+                                                                  max_concurrency=args.max_concurrency, cache_path=cache_path)),
+            ("batched_cache_warm", lambda: BatchedOllamaEmbedding("mock-embed", base_url=server.base_url, batch_size=args.batch_size,
+                                                                  max_concurrency=args.max_concurrency, cache_path=cache_path)),
+        ]
+        report = {}
+        for name, make_embedding in variants:
+            embedding = make_embedding()
+            server.reset_counts()
+            start = time.perf_counter()
+            index_papers(documents, embedding, args.chunk_size)
+            report[name] = {
+                "seconds": time.perf_counter() - start,
+                "requests": server.n_requests,
+                "texts": server.n_texts,
+                "max_in_flight": server.max_in_flight,
+            }
+            if isinstance(embedding, BatchedOllamaEmbedding):
+                embedding.close()
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
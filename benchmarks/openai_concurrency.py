@@ -0,0 +1,62 @@
+""" Sequential vs concurrent field requests of OpenAISequentialFormFiller, against the local mock openai server.
+
+    python -m benchmarks.openai_concurrency --papers 10 --latency 0.5 --max-concurrency 16
+"""
+import argparse
+import json
+import time
+import uuid
+
+from backend.profiler.form_filling.form_filling import OpenAISequentialFormFiller
+from backend.profiler.metadata_schemas.disease_theory_schema_optimal import DiseaseTheorySchema
+
+from .mock_openai_server import MockOpenAIServer
+
+
+def make_get_context(paper_index, run_id):
+    # unique contexts, so no request is answered from the request cache
+    def get_context(**kwargs):
+        return f"run {run_id} paper {paper_index}: context for {kwargs['answer_field_name']}"
+    return get_context
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--papers", type=int, default=10)
+    ap.add_argument("--latency", type=float, default=0.5, help="simulated seconds per request")
+    ap.add_argument("--rate-limit-every", type=int, default=0, help="answer every n'th request with 429")
+    ap.add_argument("--max-concurrency", type=int, default=16)
+    args = ap.parse_args()
+
+    server = MockOpenAIServer(latency=args.latency, rate_limit_every=args.rate_limit_every).start()
+    form_filler = OpenAISequentialFormFiller(
+        "gpt-4o-mini",
+        pydantic_form=DiseaseTheorySchema,
+        max_concurrency=args.max_concurrency,
+        api_key="mock",
+        api_base=server.base_url,
+    )
+
+    report = {}
+
+    run_id = uuid.uuid4().hex
+    n_requests = server.n_requests
+    start = time.perf_counter()
+    for i in range(args.papers):
+        form_filler.forward(make_get_context(i, run_id))
+    report["sequential"] = {"seconds": time.perf_counter() - start, "requests": server.n_requests - n_requests}
+
+    run_id = uuid.uuid4().hex
+    n_requests = server.n_requests
+    server.max_in_flight = 0
+    start = time.perf_counter()
+    form_filler.forward_batch([make_get_context(i, run_id) for i in range(args.papers)])
+    report["concurrent"] = {"seconds": time.perf_counter() - start, "requests": server.n_requests - n_requests,
+                            "max_in_flight": server.max_in_flight}
+
+    print(json.dumps(report, indent=2))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+""" End-to-end benchmark of the extraction pipeline, timing every stage separately.
+
+Stages per paper: load_xml, chunking, embedding, retrieval (scoring all fields), generation, graph_write.
+By default the embedding model, the llm and neo4j are replaced by the deterministic CPU stand-ins in benchmarks/fakes.py,
+so the numbers reflect the python side of the pipeline and are comparable between commits.
+Use --embedding-model to time a real sentence-transformers model instead.
+Tracing follows KNOWDISEASE_TRACING (on, off, sample:N), see benchmarks/tracing_overhead.py for a comparison of the modes.
+
+    python -m benchmarks.pipeline_benchmark --repeat 5 --output bench.json
+"""
+import argparse
+import glob
+import json
+import os
+import resource
+import statistics
+import sys
+import time
+
+from backend.data.xml_loader import load_xml
+from backend.graph_builder import GraphBuilder
+from backend.metrics import metrics
+from backend import tracing
+from backend.profiler.context_shortening.chunking import chunk_by_headers_and_clean
+from backend.profiler.metadata_schemas.cot_schema import CoTModelSchema
+from backend.profiler.metadata_schemas.disease_theory_schema_optimal import DiseaseTheorySchema
+
+from .fakes import FakeGeneratorFormFiller, RecordingDriver, make_fake_retriever
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+STAGES = ["load_xml", "chunking", "embedding", "retrieval", "generation", "graph_write"]
+
+
+def percentile(values, q):
+    """ nearest rank percentile """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024 # bytes on macos, kilobytes on linux
+
+
+def make_components(args):
+    # same retrieval settings as DiseaseTheoryPipeline
+    retriever = make_fake_retriever(args.embedding_model, relevance_threshold = args.relevance_threshold, lexical_weight = args.lexical_weight)
+    form_filler = FakeGeneratorFormFiller(DiseaseTheorySchema, CoTModelSchema, generation_seconds = args.fake_generation_ms / 1000)
+    graph_builder = GraphBuilder(None, driver = RecordingDriver())
+    return retriever, form_filler, graph_builder
+
+
+def process_paper(paper_path, retriever, form_filler, graph_builder, timings):
+    def timed(stage, fn, *fn_args, **fn_kwargs):
+        start = time.perf_counter()
+        result = fn(*fn_args, **fn_kwargs)
+        timings[stage].append(time.perf_counter() - start)
+        return result
+
+    paper = timed("load_xml", load_xml, paper_path)
+    chunks = timed("chunking", chunk_by_headers_and_clean, paper, chunk_size = retriever.chunk_size, chunk_overlap = retriever.chunk_overlap, verbose = False)
+    timed("embedding", retriever.set_chunks, [chunk.text for chunk in chunks])
+
+    fieldnames = list(DiseaseTheorySchema.model_fields)
+    contexts = timed("retrieval", lambda: {fieldname : retriever(answer_field_name = fieldname)[0] for fieldname in fieldnames})
+
+    result = timed("generation", form_filler.forward, get_context = lambda **kwargs: contexts[kwargs["answer_field_name"]])
+
+    paper_id = os.path.splitext(os.path.basename(paper_path))[0].split("_")[0]
+    timed("graph_write", graph_builder.populate_graph_from_form,
+          form_dict = result.model_dump(), paper_id_for_graph = paper_id,
+          evidence_dict = form_filler.evidence, reasoning_dict = {})
+
+
+def run(args):
+    paper_paths = sorted(glob.glob(os.path.join(args.fixtures, "*.xml")))
+    if not paper_paths:
+        raise FileNotFoundError(f"no xml fixtures in {args.fixtures}")
+
+    retriever, form_filler, graph_builder = make_components(args)
+    timings = {stage : [] for stage in STAGES}
+
+    # warm up once, so one-off costs (imports, model loading, nltk data) do not end up in the percentiles
+    process_paper(paper_paths[0], retriever, form_filler, graph_builder, {stage : [] for stage in STAGES})
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for paper_path in paper_paths:
+            with tracing.paper_scope():
+                process_paper(paper_path, retriever, form_filler, graph_builder, timings)
+    total_seconds = time.perf_counter() - start
+    n_papers = len(paper_paths) * args.repeat
+
+    return {
+        "papers": n_papers,
+        "total_seconds": total_seconds,
+        "papers_per_second": n_papers / total_seconds,
+        "stages": {
+            stage : {
+                "p50_ms": 1000 * percentile(values, 50),
+                "p95_ms": 1000 * percentile(values, 95),
+                "mean_ms": 1000 * statistics.mean(values),
+                "total_seconds": sum(values),
+            } for stage, values in timings.items()
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "graph_queries": len(graph_builder.driver.queries),
+        "config": {
+            "fixtures": args.fixtures,
+            "repeat": args.repeat,
+            "embedding_model": args.embedding_model or "fake-hashing",
+            "fake_generation_ms": args.fake_generation_ms,
+            "relevance_threshold": args.relevance_threshold,
+            "lexical_weight": args.lexical_weight,
+            "tracing": tracing.MODE if tracing.MODE != "sample" else f"sample:{tracing.SAMPLE_EVERY}",
+            "weave_project": args.weave_project,
+        },
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--fixtures", default=FIXTURES, help="folder of BioC xml files")
+    ap.add_argument("--repeat", type=int, default=5, help="passes over the fixture corpus")
+    ap.add_argument("--embedding-model", default=None, help="sentence-transformers model id, instead of the hashing stand-in")
+    ap.add_argument("--fake-generation-ms", type=float, default=0.0, help="simulated generation time per field")
+    ap.add_argument("--relevance-threshold", type=float, default=0.0)
+    ap.add_argument("--lexical-weight", type=float, default=0.0, help="hybrid retrieval: weight of the bm25 ranking, 0 for dense only")
+    ap.add_argument("--metrics", action="store_true", help="enable the metrics layer and include its snapshot in the report")
+    ap.add_argument("--weave-project", default=None, help="weave.init this project, so traces are actually recorded (tracing on/sample only)")
+    ap.add_argument("--output", default=None, help="write the report as json to this path")
+    args = ap.parse_args()
+
+    if args.weave_project and tracing.MODE != "off":
+        tracing.weave.init(args.weave_project)
+    if args.metrics:
+        metrics.enable()
+    report = run(args)
+    if args.metrics:
+        report["metrics"] = metrics.snapshot()
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
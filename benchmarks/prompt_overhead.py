@@ -0,0 +1,103 @@
+""" Per-paper Python overhead of the sequential form fillers, with an instant fake language model behind the real dspy
+predictors: everything in forward except retrieval and generation (prompt inputs, schemas, dspy prompt rendering, output
+validation). The form has ontology-like Literal fields with many values and fields with long example lists.
+
+    python -m benchmarks.prompt_overhead --papers 50 --literal-values 2000
+"""
+import argparse
+import json
+import random
+import re
+import statistics
+import time
+import typing
+
+import pydantic
+
+from backend.profiler.form_filling.dspy_x_outlines import make_lm_predict
+from backend.profiler.form_filling.form_filling import SequentialFormFiller, OpenAISequentialFormFiller
+
+from .fakes import FakeDspLM
+
+FIELD_NAME = re.compile(r"Answer Field Name: (\w+)")
+
+
+def make_form(n_literal, n_free, literal_values, n_examples):
+    rng = random.Random(0)
+    fields = {}
+    for i in range(n_literal):
+        values = tuple(f"term {i}-{j} {rng.randrange(10**6)}" for j in range(literal_values))
+        fields[f"ontology_term_{i}"] = (typing.Literal[values], pydantic.Field(description = f"ontology term number {i}",
+                                                                                examples = list(values[:n_examples])))
+    for i in range(n_free):
+        fields[f"free_text_{i}"] = (str, pydantic.Field(description = f"free text field number {i}",
+                                                        examples = [f"example {i}-{j}" for j in range(n_examples)]))
+    return pydantic.create_model("OverheadForm", **fields)
+
+
+def first_allowed(field):
+    if typing.get_origin(field.annotation) == typing.Literal:
+        return field.annotation.__args__[0]
+    return "fake answer"
+
+
+class FakeLMFormFiller(SequentialFormFiller):
+    """ SequentialFormFiller (regex mode) with every outlines generator replaced by one fake lm """
+    def __init__(self, pydantic_form, **kwargs):
+        answers = {fieldname : first_allowed(field) for fieldname, field in pydantic_form.model_fields.items()}
+        self.generator = make_lm_predict(FakeDspLM(lambda prompt, **kwargs: '"' + answers[FIELD_NAME.findall(prompt)[-1]] + '"'))
+        super().__init__(outlines_llm = None, outlines_sampler = None, pydantic_form = pydantic_form, **kwargs)
+
+    def set_pydantic_form(self, pydantic_form):
+        self.pydantic_form = pydantic_form
+        self.literal_matchers = {}
+        self.dspy_generators = {self.get_generator_key(field) : self.generator for field in pydantic_form.model_fields.values()}
+        self.prepare_field_plan()
+        self.prepare_field_fillers()
+
+
+def fake_openai_answer(pydantic_form):
+    answers = {fieldname : first_allowed(field) for fieldname, field in pydantic_form.model_fields.items()}
+    def answer(prompt, response_format = None, **kwargs):
+        fieldname = next(iter(response_format.model_fields))
+        return json.dumps({fieldname : answers[fieldname]})
+    return answer
+
+
+def get_context(**prompt_input):
+    return "A short fixed context about a disease, its causes and its treatment."
+
+
+def time_papers(form_filler, papers):
+    form_filler.forward(get_context) # warm up, first calls build the memoized schemas
+    timings = []
+    for _ in range(papers):
+        start = time.perf_counter()
+        form_filler.forward(get_context)
+        timings.append(time.perf_counter() - start)
+    return {"mean_ms": 1000 * statistics.mean(timings), "p50_ms": 1000 * statistics.median(timings)}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--papers", type=int, default=50)
+    ap.add_argument("--literal-fields", type=int, default=4)
+    ap.add_argument("--free-fields", type=int, default=8)
+    ap.add_argument("--literal-values", type=int, default=2000)
+    ap.add_argument("--examples", type=int, default=20)
+    args = ap.parse_args()
+
+    form = make_form(args.literal_fields, args.free_fields, args.literal_values, args.examples)
+    report = {"fields": len(form.model_fields)}
+
+    report["sequential"] = time_papers(FakeLMFormFiller(form), args.papers)
+
+    openai_filler = OpenAISequentialFormFiller("gpt-4o-mini", pydantic_form = form, api_key = "fake")
+    openai_filler.lm = FakeDspLM(fake_openai_answer(form))
+    report["openai_sequential"] = time_papers(openai_filler, args.papers)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+""" Overhead of weave tracing: runs pipeline_benchmark once per KNOWDISEASE_TRACING mode, each in its own process
+(the mode is read at import time), and compares throughput and per-stage latency against tracing off.
+Modes are run interleaved for --rounds rounds and the fastest run per mode is kept, to even out os caching and noise.
+
+    python -m benchmarks.tracing_overhead --modes off on sample:10 --repeat 5 [--weave-project my-project]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+def run_mode(mode, benchmark_args):
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "report.json")
+        env = {**os.environ, "KNOWDISEASE_TRACING": mode}
+        subprocess.run([sys.executable, "-m", "benchmarks.pipeline_benchmark", "--output", output, *benchmark_args],
+                       env=env, check=True, stdout=subprocess.DEVNULL)
+        with open(output) as f:
+            return json.load(f)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--modes", nargs="+", default=["off", "on", "sample:10"])
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--rounds", type=int, default=3)
+    ap.add_argument("--weave-project", default=None)
+    ap.add_argument("--output", default=None)
+    args = ap.parse_args()
+
+    benchmark_args = ["--repeat", str(args.repeat)]
+    if args.weave_project:
+        benchmark_args += ["--weave-project", args.weave_project]
+
+    reports = {}
+    for _ in range(args.rounds):
+        for mode in args.modes:
+            report = run_mode(mode, benchmark_args)
+            if mode not in reports or report["papers_per_second"] > reports[mode]["papers_per_second"]:
+                reports[mode] = report
+    baseline = reports.get("off")
+
+    summary = {}
+    for mode, report in reports.items():
+        summary[mode] = {
+            "papers_per_second": report["papers_per_second"],
+            "stage_p50_ms": {stage : values["p50_ms"] for stage, values in report["stages"].items()},
+        }
+        if baseline is not None:
+            summary[mode]["slowdown_vs_off"] = baseline["papers_per_second"] / report["papers_per_second"]
+
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+""" BatchedOllamaEmbedding against the mock ollama server: one request per batch instead of one per chunk,
+and no request at all when the embeddings are in the sqlite cache. """
+import glob
+import math
+import os
+
+import numpy as np
+import pytest
+
+from backend.data.xml_loader import load_xml
+from backend.profiler.context_shortening.chunking import chunk_by_headers_and_clean
+from backend.profiler.context_shortening.ollama_embedding import BatchedOllamaEmbedding
+from benchmarks.mock_ollama_server import MockOllamaServer
+from benchmarks.pipeline_benchmark import FIXTURES
+
+BATCH_SIZE = 8
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = MockOllamaServer().start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture(scope="module")
+def chunks():
+    paper_path = sorted(glob.glob(os.path.join(FIXTURES, "*.xml")))[0]
+    nodes = chunk_by_headers_and_clean(load_xml(paper_path), chunk_size=300, chunk_overlap=0, verbose=False)
+    texts = list(dict.fromkeys(node.get_text() for node in nodes)) # requests are per distinct text
+    assert len(texts) > BATCH_SIZE
+    return texts
+
+
+def embed(server, chunks, cache_path = None):
+    embedding = BatchedOllamaEmbedding("mock-embed", base_url=server.base_url, batch_size=BATCH_SIZE, max_concurrency=2,
+                                       cache_path=cache_path)
+    server.reset_counts()
+    try:
+        return embedding.get_text_embedding_batch(chunks)
+    finally:
+        embedding.close()
+
+
+def test_one_request_per_batch(server, chunks):
+    vectors = embed(server, chunks)
+    assert len(vectors) == len(chunks)
+    assert server.n_requests == math.ceil(len(chunks) / BATCH_SIZE)
+    assert server.n_texts == len(chunks)
+
+
+def test_warm_cache_sends_no_request(server, chunks, tmp_path):
+    cache_path = str(tmp_path / "embeddings.sqlite")
+    cold = embed(server, chunks, cache_path)
+    assert server.n_requests == math.ceil(len(chunks) / BATCH_SIZE)
+    warm = embed(server, chunks, cache_path)
+    assert server.n_requests == 0
+    np.testing.assert_allclose(warm, cold, rtol=1e-6)